@@ -0,0 +1,225 @@
+"""
+CPU-only diacritic restorer: a syllable lattice decoded with an n-gram LM.
+
+Every unaccented syllable expands to the accented forms that share its
+base form (utils.remove_accent, i.e. utils.ACCENTED_CHARS) and were seen
+in the training corpus. A stupid-backoff n-gram language model scores the
+paths through the lattice and a beam search with Viterbi recombination
+(one hypothesis per LM state) picks the best one.
+
+Train offline from accented Vietnamese text files:
+    python accent_lattice.py data/Teamhub/training_files \\
+        --output models/accent/lattice_lm.json.gz --order 3
+"""
+import argparse
+import gzip
+import heapq
+import json
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Iterable
+
+from utils import AccentEngine, extract_phrases, remove_accent
+
+BOS = "<s>"
+EOS = "</s>"
+# stupid backoff penalty per backed-off order
+BACKOFF = 0.4
+# logprob() memoizes at most this many (context, word) scores
+LOGPROB_CACHE_SIZE = 1000000
+
+
+def iter_sentences(paths: Iterable[str], encoding: str = "utf-8"):
+    """Yield lowercase syllable lists of every phrase in the text files"""
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path)
+                for name in names
+                if name.endswith(".txt")
+            )
+        else:
+            files = [path]
+        for file in files:
+            with open(file, encoding=encoding) as f:
+                for line in f:
+                    for phrase in extract_phrases(line.lower()):
+                        syllables = phrase.split()
+                        if syllables:
+                            yield syllables
+
+
+class NgramModel:
+    """Counts-based n-gram LM with stupid backoff"""
+
+    def __init__(self, order: int, counts: list[dict]) -> None:
+        """
+        args:
+            order(int): n of the n-grams (2 or 3)
+            counts(list): counts[k] maps a (k + 1)-gram joined by "\\t"
+                to its count, for k in range(order)
+        """
+        self.order = order
+        self.counts = counts
+        self.total = sum(c for w, c in counts[0].items() if w != BOS)
+        self.vocab_size = len(counts[0])
+        # history counts[k]: how often a k-gram is followed by any word
+        self.history_counts = [Counter() for _ in range(order)]
+        for k in range(1, order):
+            for gram, count in counts[k].items():
+                self.history_counts[k][gram.rsplit("\t", 1)[0]] += count
+        self._cache = {}
+
+    @classmethod
+    def train(
+        cls,
+        sentences: Iterable[list[str]],
+        order: int = 3,
+        min_count: int = 1,
+    ) -> "NgramModel":
+        counts = [Counter() for _ in range(order)]
+        for sentence in sentences:
+            words = [BOS] * (order - 1) + sentence + [EOS]
+            for k in range(order):
+                for i in range(len(words) - k):
+                    counts[k]["\t".join(words[i:i + k + 1])] += 1
+        counts = [
+            {gram: c for gram, c in level.items() if c >= min_count or k == 0}
+            for k, level in enumerate(counts)
+        ]
+        return cls(order, counts)
+
+    def logprob(self, word: str, context: tuple) -> float:
+        """log P(word | context) with stupid backoff"""
+        key = context + (word,)
+        if key in self._cache:
+            return self._cache[key]
+        penalty = 0.0
+        score = None
+        for k in range(min(len(context), self.order - 1), 0, -1):
+            history = "\t".join(context[-k:])
+            count = self.counts[k].get(history + "\t" + word, 0)
+            if count:
+                score = penalty + math.log(
+                    count / self.history_counts[k][history],
+                )
+                break
+            penalty += math.log(BACKOFF)
+        if score is None:
+            unigram = self.counts[0].get(word, 0) + 1
+            score = penalty + math.log(
+                unigram / (self.total + self.vocab_size + 1),
+            )
+        if len(self._cache) >= LOGPROB_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = score
+        return score
+
+    def save(self, filepath: str) -> None:
+        folder = os.path.dirname(filepath)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with gzip.open(filepath, "wt", encoding="utf-8") as f:
+            json.dump({"order": self.order, "counts": self.counts}, f)
+
+    @classmethod
+    def load(cls, filepath: str) -> "NgramModel":
+        with gzip.open(filepath, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["order"], data["counts"])
+
+
+class LatticeAccentEngine(AccentEngine):
+    """
+    Usage:
+        engine = LatticeAccentEngine.load("models/accent/lattice_lm.json.gz")
+        engine.restore_phrases(["lam sao doi mat khau"])
+    """
+
+    name = "lattice"
+
+    def __init__(self, model: NgramModel, beam_size: int = 8) -> None:
+        self.model = model
+        self.beam_size = beam_size
+        # base form -> accented forms seen in training
+        self.forms = defaultdict(list)
+        for word in model.counts[0]:
+            if word not in (BOS, EOS):
+                self.forms[remove_accent(word)].append(word)
+
+    @classmethod
+    def load(cls, filepath: str, beam_size: int = 8) -> "LatticeAccentEngine":
+        return cls(NgramModel.load(filepath), beam_size)
+
+    def candidates(self, syllable: str) -> list[str]:
+        return self.forms.get(remove_accent(syllable)) or [syllable]
+
+    def decode(self, syllables: list[str]) -> list[str]:
+        """Best accented form of every syllable"""
+        # hypotheses by LM state: state -> (score, output)
+        start = (BOS,) * (self.model.order - 1)
+        beams = {start: (0.0, ())}
+        for syllable in syllables:
+            expanded = {}
+            for state, (score, output) in beams.items():
+                for form in self.candidates(syllable):
+                    new_score = score + self.model.logprob(form, state)
+                    new_state = (state + (form,))[1:]
+                    if (
+                        new_state not in expanded
+                        or new_score > expanded[new_state][0]
+                    ):
+                        expanded[new_state] = (new_score, output + (form,))
+            beams = dict(
+                heapq.nlargest(
+                    self.beam_size,
+                    expanded.items(),
+                    key=lambda item: item[1][0],
+                ),
+            )
+        _, (_, output) = max(
+            beams.items(),
+            key=lambda item: item[1][0] + self.model.logprob(EOS, item[0]),
+        )
+        return list(output)
+
+    def restore_phrases(self, phrases: list[str]) -> list[str]:
+        outputs = []
+        for phrase in phrases:
+            # keep the original spacing so the output aligns with the input
+            parts = re.split("( +)", phrase)
+            syllables = parts[::2]
+            words = [s for s in syllables if s]
+            restored = iter(self.decode(words))
+            parts[::2] = [next(restored) if s else s for s in syllables]
+            outputs.append("".join(parts))
+        return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train the n-gram LM of the lattice accent restorer",
+    )
+    parser.add_argument("corpus", nargs="+", help="accented .txt files/dirs")
+    parser.add_argument("--output", required=True, help="*.json.gz model")
+    parser.add_argument("--order", type=int, default=3)
+    parser.add_argument("--min-count", type=int, default=1)
+    parser.add_argument("--encoding", default="utf-8")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    model = NgramModel.train(
+        iter_sentences(args.corpus, args.encoding),
+        order=args.order,
+        min_count=args.min_count,
+    )
+    model.save(args.output)
+    print(
+        f"Trained order-{model.order} LM: {model.vocab_size} syllables, "
+        f"{sum(len(c) for c in model.counts)} n-grams "
+        f"({time.monotonic() - start:.1f}s) -> {args.output}",
+    )
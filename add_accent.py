@@ -1,11 +1,20 @@
-from keras.models import load_model
-model = load_model('ai_core/model_add_accent/a_best_weight.h5')
-
+import threading
+import time
 from collections import Counter
+from concurrent.futures import Future
+from typing import Optional
 
 import numpy as np
 
 from utils import *
+from ai_configs import (
+    ACCENT_BEAM_SIZE,
+    ACCENT_ENGINE,
+    ACCENT_LM_PATH,
+    ACCENT_MICROBATCH,
+    ACCENT_MICROBATCH_MAX_SIZE,
+    ACCENT_MICROBATCH_MAX_WAIT,
+)
 import string
 import re
 
@@ -13,35 +22,296 @@ alphabet = set('\x00 _' + string.ascii_lowercase + string.digits + ''.join(ACCEN
 
 codec = CharacterCodec(alphabet, MAXLEN)
 
+MODEL_PATH = "ai_core/model_add_accent/a_best_weight.h5"
+_model = None
+# the exception of a failed load, raised again until the next warm_up()
+_model_error: Optional[Exception] = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Load the Keras model on first use (importing keras is slow)"""
+    global _model, _model_error
+    if _model is None:
+        with _model_lock:
+            if _model is None and _model_error is None:
+                try:
+                    from keras.models import load_model
+
+                    _model = load_model(MODEL_PATH)
+                except Exception as e:
+                    _model_error = e
+            if _model_error is not None:
+                raise _model_error
+    return _model
+
+
+def warm_up() -> None:
+    """
+    Load the configured engine and run one prediction. A load that failed
+    before is tried again here, requests only raise its exception.
+    """
+    global _model_error, _engine_error
+    with _model_lock, _engine_lock:
+        _model_error = _engine_error = None
+    get_engine().warm_up()
+
+
+class InferenceStats:
+    """Counters of model.predict calls: throughput and latency"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.batches = 0
+        self.ngrams = 0
+        self.predict_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def record(
+        self,
+        calls: int,
+        ngrams: int,
+        predict_seconds: float,
+        wait_seconds: float = 0.0,
+    ) -> None:
+        with self.lock:
+            self.calls += calls
+            self.batches += 1
+            self.ngrams += ngrams
+            self.predict_seconds += predict_seconds
+            self.wait_seconds += wait_seconds
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            batches = self.batches or 1
+            seconds = self.predict_seconds
+            return {
+                "calls": self.calls,
+                "batches": self.batches,
+                "ngrams": self.ngrams,
+                "mean_batch_size": self.ngrams / batches,
+                "mean_predict_ms": 1000 * seconds / batches,
+                "mean_wait_ms": 1000 * self.wait_seconds / batches,
+                "ngrams_per_second": self.ngrams / seconds if seconds else 0.0,
+            }
+
+
+direct_stats = InferenceStats()
+
+
+def _predict(ngrams: list) -> list[str]:
+    """Run the model once on a batch of ngrams, return the guessed texts"""
+    texts = []
+    for ngram in ngrams:
+        text = " ".join(ngram)
+        text += "\x00" * (MAXLEN - len(text))
+        if INVERT:
+            text = text[::-1]
+        texts.append(text)
+    model = get_model()
+    if len(model.input_shape) == 2:
+        # the model embeds alphabet indices itself
+        inputs = codec.encode_indices_many(texts)
+    else:
+        inputs = codec.encode_many(texts)
+    preds = model.predict(inputs, batch_size=len(texts), verbose=0)
+    decoded = codec.decode_many(np.argmax(preds, axis=-1), calc_argmax=False)
+    rtexts = []
+    for rtext in decoded:
+        rtext = rtext.strip("\x00")
+        if len(rtext) > 0:
+            index = rtext.find("\x00")
+            if index > -1:
+                rtext = rtext[:index]
+        rtexts.append(rtext)
+    return rtexts
+
+
+def guess_many(ngrams: list) -> list[str]:
+    """Guess the accented form of many ngrams with one model.predict"""
+    if not ngrams:
+        return []
+    begin = time.perf_counter()
+    rtexts = _predict(ngrams)
+    direct_stats.record(1, len(ngrams), time.perf_counter() - begin)
+    return rtexts
+
+
 def guess(ngram):
-    text = ' '.join(ngram)
-    text += '\x00' * (MAXLEN - len(text))
-    if INVERT:
-        text = text[::-1]
-    preds = model.predict(np.array([codec.encode(text)]), verbose = 0)
-    rtext = codec.decode(np.argmax(preds, axis=-1)[0], calc_argmax=False).strip('\x00')
+    return guess_many([ngram])[0]
+
+
+class AccentBatcher:
+    """
+    Server-side micro-batcher: ngrams submitted by concurrent callers
+    (e.g. /chat requests running add_accent in worker threads) are merged
+    into shared model.predict batches. A batch is run as soon as it holds
+    max_size ngrams or max_wait seconds after its first request arrived.
+    """
+
+    def __init__(
+        self,
+        max_size: int = ACCENT_MICROBATCH_MAX_SIZE,
+        max_wait: float = ACCENT_MICROBATCH_MAX_WAIT,
+    ) -> None:
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.stats = InferenceStats()
+        self._pending = []  # (ngrams, future, submitted_at)
+        self._cond = threading.Condition()
+        self._thread = None
 
-    if len(rtext)>0:
-        index = rtext.find('\x00')
-        if index>-1:
-            rtext = rtext[:index]
-    return rtext
+    def _start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run,
+                name="accent-batcher",
+                daemon=True,
+            )
+            self._thread.start()
 
+    def guess_many(self, ngrams: list) -> list[str]:
+        """Same as guess_many(), but shares model calls with other threads"""
+        if not ngrams:
+            return []
+        future = Future()
+        with self._cond:
+            self._start()
+            self._pending.append((list(ngrams), future, time.perf_counter()))
+            self._cond.notify()
+        return future.result()
 
-def add_accent(text):
+    def _next_batch(self) -> list:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0][2] + self.max_wait
+            while sum(len(p[0]) for p in self._pending) < self.max_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, size = [], 0
+            while self._pending and (
+                not batch or size + len(self._pending[0][0]) <= self.max_size
+            ):
+                item = self._pending.pop(0)
+                batch.append(item)
+                size += len(item[0])
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            ngrams = [ngram for item in batch for ngram in item[0]]
+            begin = time.perf_counter()
+            try:
+                rtexts = _predict(ngrams)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            wait = sum(begin - submitted_at for _, _, submitted_at in batch)
+            self.stats.record(
+                len(batch),
+                len(ngrams),
+                end - begin,
+                wait / len(batch),
+            )
+            start = 0
+            for item_ngrams, future, _ in batch:
+                future.set_result(rtexts[start : start + len(item_ngrams)])
+                start += len(item_ngrams)
+
+
+batcher = AccentBatcher() if ACCENT_MICROBATCH else None
+
+
+def inference_stats() -> dict:
+    """Throughput / latency of the direct and micro-batched modes"""
+    stats = {"direct": direct_stats.as_dict()}
+    if batcher is not None:
+        stats["microbatch"] = batcher.stats.as_dict()
+    return stats
+
+
+class KerasAccentEngine(AccentEngine):
+    """Seq2seq Keras model over overlapping ngrams, merged by voting"""
+
+    name = "keras"
+
+    def restore_phrases(self, phrases: list[str]) -> list[str]:
+        # predict the ngrams of all phrases in one batch
+        phrase_grams = [
+            list(gen_ngram(phrase, n=NGRAM, pad_words=PAD_WORDS_INPUT))
+            for phrase in phrases
+        ]
+        all_grams = [gram for grams in phrase_grams for gram in grams]
+        predict = batcher.guess_many if batcher is not None else guess_many
+        guessed = iter(predict(all_grams))
+        return [
+            _vote([next(guessed) for _ in grams]) for grams in phrase_grams
+        ]
+
+
+def load_engine(name: str) -> AccentEngine:
+    """Create an accent restoration engine: "keras" or "lattice" """
+    if name == "keras":
+        return KerasAccentEngine()
+    elif name == "lattice":
+        from accent_lattice import LatticeAccentEngine
+
+        return LatticeAccentEngine.load(
+            ACCENT_LM_PATH,
+            beam_size=ACCENT_BEAM_SIZE,
+        )
+    raise ValueError(f"Unknown accent engine: {name}")
+
+
+_engine = None
+_engine_error: Optional[Exception] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> AccentEngine:
+    """
+    The engine selected by ACCENT_ENGINE, created on first use. If that
+    fails, its exception is raised again without loading until warm_up().
+    """
+    global _engine, _engine_error
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None and _engine_error is None:
+                try:
+                    _engine = load_engine(ACCENT_ENGINE)
+                except Exception as e:
+                    _engine_error = e
+            if _engine_error is not None:
+                raise _engine_error
+    return _engine
+
+
+def add_accent(text, engine=None):
     # lowercase the input text as we train the model on lowercase text only
     # but we keep the map of uppercase characters to restore cases in output
     is_uppercase_map = [c.isupper() for c in text]
     text = remove_accent(text.lower())
 
-    outputs = []
     words_or_symbols_list = re.findall('\w[\w ]*|\W+', text)
 
     # print(words_or_symbols_list)
 
+    # restore all phrases with one engine call
+    engine = engine or get_engine()
+    phrases = [w for w in words_or_symbols_list if is_words(w)]
+    restored = iter(engine.restore_phrases(phrases))
+
+    outputs = []
     for words_or_symbols in words_or_symbols_list:
         if is_words(words_or_symbols):
-            outputs.append(_add_accent(words_or_symbols))
+            outputs.append(next(restored))
         else:
             outputs.append(words_or_symbols)
         # print(outputs)
@@ -54,12 +324,15 @@ def add_accent(text):
 
 def _add_accent(phrase):
     grams = list(gen_ngram(phrase.lower(), n=NGRAM, pad_words=PAD_WORDS_INPUT))
+    return _vote(guess_many(grams))
+
 
-    guessed_grams = list(guess(gram) for gram in grams)
-    # print("phrase",phrase,'grams',grams,'guessed_grams',guessed_grams)
+def _vote(guessed_grams: list[str]) -> str:
+    """Merge overlapping guessed ngrams: the most common guess per word wins"""
+    # print('guessed_grams',guessed_grams)
     candidates = [Counter() for _ in range(len(guessed_grams) + NGRAM - 1)]
     for idx, gram in enumerate(guessed_grams):
-        for wid, word in enumerate(re.split(' +', gram)):
+        for wid, word in enumerate(re.split(" +", gram)):
             candidates[idx + wid].update([word])
-    output = ' '.join(c.most_common(1)[0][0] for c in candidates if c)
-    return output.strip('\x00 ')
\ No newline at end of file
+    output = " ".join(c.most_common(1)[0][0] for c in candidates if c)
+    return output.strip("\x00 ")
@@ -16,18 +16,71 @@ SERVICES = ["TokyoTechLab", "Teamhub", "Test"]
 DELIMITER_TOKYOTECHLAB = "Sub Section:"
 FILE_TYPE = ".txt"
 FILE_ENCODING = "utf-8"
-INTRODUCTION_MESSAGE = (
-    f"You are a chatbot of {SERVICE}. "
-    f"Use the below articles on the {SERVICE} to answer the subsequent question. "  # noqa: E501
+CHUNK_WORKERS = 0  # processes formatting documents, 0 = one per CPU core
+CHUNK_POOL_MIN_FILES = 64  # fewer changed files are formatted in-process
+# {service} is replaced by the service answering (see search.py)
+INTRODUCTION_TEMPLATE = (
+    "You are a chatbot of {service}. "
+    "Use the below articles on the {service} to answer the subsequent question. "  # noqa: E501
     "If an answer cannot be found in the articles, write sorry that I cannot answer your request, please contact our support team for further assistance."  # noqa: E501
     r'If an answer is found, add embedding title in this format "[Title](URL)" to the end of an answer and ignore the same title.'  # noqa: E501
 )
-SYSTEM_CONTENT = "You answer questions about {SERVICE}"
+INTRODUCTION_MESSAGE = INTRODUCTION_TEMPLATE.format(service=SERVICE)
+SYSTEM_CONTENT_TEMPLATE = "You answer questions about {service}"
+SYSTEM_CONTENT = SYSTEM_CONTENT_TEMPLATE.format(service=SERVICE)
 
 # CALCULATE EMBEDDING PARAMETERS
 MAX_TOKENS = 1600  # maximum tokens for a section
 BATCH_SIZE = 1000  # up to 2048 embedding inputs per request
 TOKEN_BUDGET = 4096 - 500
+# chunks retrieved per question, packed best first until TOKEN_BUDGET is
+# reached (chunk token counts are stored with the embeddings, so a larger
+# pool costs no extra tokenization)
+CONTEXT_TOP_N = 3
+
+# EMBEDDING REQUESTS OF embed_data (see embedding_scheduler.py)
+EMBEDDING_BATCH_TOKENS = 100000  # maximum tokens of one embedding request
+EMBEDDING_MAX_IN_FLIGHT = 4  # embedding requests sent concurrently
+EMBEDDING_RPM = 3000  # requests per minute, None = no limit
+EMBEDDING_TPM = 1000000  # tokens per minute, None = no limit
+EMBEDDING_MAX_RETRIES = 6  # retries of a failed request, with backoff
+
+# EMBEDDING QA STORE (see embedding.Embedding)
+QA_LOG_MIN_ENTRIES = 1000  # log entries before the log may be compacted
+QA_LOG_COMPACT_RATIO = 0.5  # compact once the log has this many per QA
+
+# APPROXIMATE NEAREST-NEIGHBOUR SEARCH (see ann_index.py)
+ANN_ENABLED = True  # use the IVF index when the embedding store has one
+ANN_MIN_ROWS = 50000  # embed_data builds an IVF index from this many chunks
+ANN_NLIST = 0  # number of IVF lists, 0 = about 4 * sqrt(chunks)
+ANN_NPROBE = 16  # lists scanned per query: higher = better recall, slower
+ANN_RECALL_K = 3  # k used to report recall@k against the exact scan
+
+# QUERY EMBEDDING CACHE (see cache.py)
+EMBEDDING_CACHE_SIZE = 4096  # embeddings kept in memory, 0 = disabled
+EMBEDDING_CACHE_PATH = os.path.join("models", "cache", "query_embeddings.db")
+EMBEDDING_CACHE_DISK_SIZE = 200000  # embeddings kept on disk, 0 = disabled
+EMBEDDING_CACHE_TTL = None  # seconds before an entry expires, None = never
+
+# RESPONSE CACHE (see cache.py)
+RESPONSE_CACHE_SIZE = 1024  # responses kept in memory, 0 = disabled
+# Cosine similarity to reuse the answer of a near-duplicate question, None =
+# reuse exact (normalized) repeats only. With text-embedding-ada-002 unlike
+# questions score high too ("add" vs "remove" a member: 0.95-0.98), so any
+# value must be calibrated: embed pairs of questions of the service that
+# must and must not share an answer, and pick a value above every "must
+# not" pair (see ResponseCache in cache.py).
+RESPONSE_CACHE_THRESHOLD = None
+RESPONSE_CACHE_TTL = 3600  # seconds before an entry expires, None = never
+
+# ASYNC OPENAI CLIENT (see openai_pool.py)
+OPENAI_MAX_CONNECTIONS = 100  # keep-alive connections in the HTTP pool
+OPENAI_MAX_CONCURRENCY = 32  # OpenAI requests in flight per worker
+OPENAI_TIMEOUT = 120  # seconds per request, None = no timeout
+
+# BATCH QUESTIONS (see /chat/batch in main.py)
+CHAT_BATCH_MAX_SIZE = 256  # questions per batch request
+CHAT_BATCH_MAX_CONCURRENCY = 8  # chat completions in flight per batch
 
 # TRAINING PARAMETERS
 CONTEXT_WINDOW = 4096  # Context window for the LLM.
@@ -61,6 +114,13 @@ if SERVICE in SERVICES:
             "embeddings",
             f"{SERVICE}.csv",
         )
+        # Binary embedding store (see embedding_store.py)
+        FOLDERPATH_EMBEDDING_STORE = os.path.join(
+            "models",
+            SERVICE,
+            "embeddings",
+            f"{SERVICE}.store",
+        )
         # For evaluation
         FOLDERPATH_QUESTION = os.path.join(
             "data",
@@ -79,4 +139,35 @@ if SERVICE in SERVICES:
 else:
     raise ValueError("SERVICE must be in SERVICES")
 
-ERROR_MESSAGE = "Sorry, I cannot answer your request"
\ No newline at end of file
+ERROR_MESSAGE = "Sorry, I cannot answer your request"
+
+# Unaccented Vietnamese questions (see utils.is_unaccented_vietnamese):
+# restore accents and retrieve for both the raw and the accented text
+# concurrently, then answer once from the better-scoring context, instead
+# of retrying after an ERROR_MESSAGE answer. Costs an add_accent run and a
+# second embedding request per such question.
+SPECULATIVE_ACCENT = False
+
+# SERVER ADMINISTRATION
+# value of the X-Admin-Token header of the /admin endpoints, None = disabled
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# seconds between checks for a new embedding store version, 0 = no checks
+INDEX_RELOAD_INTERVAL = 10
+# SERVICES answered by one server process (see service_registry.py), each
+# index loaded on first use; when the loaded indexes map more than
+# INDEX_MEMORY_BUDGET bytes (memory-mapped arrays included, resident or
+# not) the least recently used ones are unloaded
+SERVED_SERVICES = SERVICES
+INDEX_MEMORY_BUDGET = 2 * 1024**3  # None = no limit
+# sampling profiler of POST /admin/profile (see profiler.py)
+PROFILE_FOLDERPATH = os.path.join("models", "profiles")
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_MAX_SECONDS = 300  # longest capture
+
+# ACCENT MODEL INFERENCE (see add_accent.py)
+ACCENT_ENGINE = "keras"  # "keras" (seq2seq model) or "lattice" (n-gram LM)
+ACCENT_LM_PATH = os.path.join("models", "accent", "lattice_lm.json.gz")
+ACCENT_BEAM_SIZE = 8  # hypotheses kept by the lattice decoder
+ACCENT_MICROBATCH = False  # merge ngrams of concurrent requests into batches
+ACCENT_MICROBATCH_MAX_SIZE = 512  # ngrams per model.predict batch
+ACCENT_MICROBATCH_MAX_WAIT = 0.005  # seconds a request waits for a batch
\ No newline at end of file
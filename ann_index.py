@@ -0,0 +1,245 @@
+"""
+Approximate nearest-neighbour search with an inverted-file (IVF) index.
+
+The unit-normalized vectors are clustered with spherical k-means into
+`nlist` lists. A query scores the centroids, scans only the `nprobe` best
+lists and ranks their members exactly. nprobe trades recall for latency:
+nprobe == nlist is an exact (but slower) scan.
+"""
+import json
+import math
+import time
+from typing import Optional
+
+import numpy as np
+from retrieval import normalize_rows, top_k_indices
+
+# rows assigned to centroids at once, bounds the (rows, nlist) score matrix
+ASSIGN_CHUNK_SIZE = 8192
+
+
+def default_nlist(n_rows: int) -> int:
+    """Rule of thumb: about 4 * sqrt(n) lists"""
+    return max(1, min(n_rows, int(4 * math.sqrt(n_rows))))
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Return the closest centroid of every row"""
+    assignments = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], ASSIGN_CHUNK_SIZE):
+        chunk = np.asarray(vectors[start:start + ASSIGN_CHUNK_SIZE])
+        assignments[start:start + len(chunk)] = np.argmax(
+            chunk @ centroids.T,
+            axis=1,
+        )
+    return assignments
+
+
+def train_centroids(
+    vectors: np.ndarray,
+    nlist: int,
+    n_iter: int = 20,
+    sample_size: Optional[int] = None,
+    seed: int = 0,
+) -> np.ndarray:
+    """Spherical k-means on (a sample of) the rows"""
+    rng = np.random.default_rng(seed)
+    n_rows = vectors.shape[0]
+    sample_size = min(n_rows, sample_size or nlist * 64)
+    sample = np.asarray(
+        vectors[np.sort(rng.choice(n_rows, sample_size, replace=False))],
+    )
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        # re-seed empty lists with random rows
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = sample[rng.choice(sample_size, len(empty))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index over a fixed matrix of unit-normalized vectors.
+    Usage:
+        ivf = IVFIndex.train(vectors, nlist=1024)
+        ids, scores = ivf.search(vectors, query, top_n=3, nprobe=16)
+        ivf.save("ivf.npz"); ivf = IVFIndex.load("ivf.npz")
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_ids: np.ndarray,
+        nprobe: int = 16,
+    ) -> None:
+        """
+        args:
+            centroids: (nlist, dim) unit-normalized list centroids
+            list_offsets: (nlist + 1) offsets of every list in list_ids
+            list_ids: row ids, grouped by list
+            nprobe(int): default number of lists scanned per query
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.centroids.nbytes
+            + self.list_offsets.nbytes
+            + self.list_ids.nbytes
+        )
+
+    @classmethod
+    def train(
+        cls,
+        vectors: np.ndarray,
+        nlist: int = 0,
+        nprobe: int = 16,
+        n_iter: int = 20,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Cluster the rows into nlist lists (0 = default_nlist)"""
+        nlist = nlist or default_nlist(vectors.shape[0])
+        centroids = train_centroids(vectors, nlist, n_iter=n_iter, seed=seed)
+        assignments = assign_lists(vectors, centroids)
+        list_ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(assignments, minlength=nlist),
+            out=list_offsets[1:],
+        )
+        return cls(centroids, list_offsets, list_ids, nprobe)
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Row ids in the nprobe lists closest to the query"""
+        lists = top_k_indices(self.centroids @ query, nprobe)
+        return np.concatenate(
+            [
+                self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]]
+                for i in lists.tolist()
+            ],
+        )
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        query: np.ndarray,
+        top_n: int = 3,
+        nprobe: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return (row ids, cosine similarities) of the approximate top_n rows.
+        args:
+            vectors: the matrix the index was trained on
+            query: unit-normalized query vector
+            nprobe(int): lists to scan, defaults to self.nprobe
+        """
+        ids = self.candidates(query, nprobe or self.nprobe)
+        scores = vectors[ids] @ query
+        best = top_k_indices(scores, top_n)
+        return ids[best], scores[best]
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_ids=self.list_ids,
+                nprobe=np.int64(self.nprobe),
+            )
+
+    @classmethod
+    def load(cls, filepath: str, nprobe: Optional[int] = None) -> "IVFIndex":
+        with np.load(filepath) as data:
+            return cls(
+                data["centroids"],
+                data["list_offsets"],
+                data["list_ids"],
+                nprobe or int(data["nprobe"]),
+            )
+
+
+def sample_queries(
+    vectors: np.ndarray,
+    n_queries: int = 200,
+    noise: float = 0.05,
+    seed: int = 0,
+) -> np.ndarray:
+    """Noisy copies of random rows, used as evaluation queries"""
+    rng = np.random.default_rng(seed)
+    n_queries = min(n_queries, vectors.shape[0])
+    rows = np.asarray(vectors[rng.choice(vectors.shape[0], n_queries)])
+    scale = noise / math.sqrt(rows.shape[1])
+    return normalize_rows(rows + rng.normal(scale=scale, size=rows.shape))
+
+
+def recall_report(
+    ivf: IVFIndex,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 3,
+    nprobes: Optional[list[int]] = None,
+) -> list[dict]:
+    """
+    Measure recall@k of the IVF index against the exact scan
+    for several nprobe values, with the mean latency per query.
+    """
+    if nprobes is None:
+        steps = range(int(math.log2(ivf.nlist)) + 2)
+        nprobes = sorted({min(2**i, ivf.nlist) for i in steps})
+
+    start = time.perf_counter()
+    exact = [set(top_k_indices(vectors @ q, k).tolist()) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [ivf.search(vectors, q, k, nprobe)[0] for q in queries]
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(
+            len(truth.intersection(ids.tolist()))
+            for truth, ids in zip(exact, found)
+        )
+        report.append(
+            {
+                "nprobe": nprobe,
+                f"recall@{k}": hits / (k * len(queries)),
+                "ann_ms": ann_ms,
+                "exact_ms": exact_ms,
+            },
+        )
+    return report
+
+
+def build_ivf_index(
+    vectors: np.ndarray,
+    nlist: int = 0,
+    nprobe: int = 16,
+    recall_k: int = 3,
+) -> tuple[IVFIndex, list[dict]]:
+    """Train an IVF index and print its recall@k / latency per nprobe"""
+    start = time.monotonic()
+    ivf = IVFIndex.train(vectors, nlist=nlist, nprobe=nprobe)
+    print(
+        f"Built IVF index: {vectors.shape[0]} rows, {ivf.nlist} lists "
+        f"({time.monotonic() - start:.1f}s)",
+    )
+    report = recall_report(ivf, vectors, sample_queries(vectors), k=recall_k)
+    for row in report:
+        print(json.dumps(row))
+    return ivf, report
@@ -0,0 +1,71 @@
+"""
+Benchmark accent restoration engines: syllable accuracy and per-message
+latency on accented Vietnamese text (one message per line), whose accents
+are stripped before restoring them.
+
+Run from the repository root:
+    python -m benchmarks.bench_accent test.txt --engines keras lattice
+"""
+import argparse
+import statistics
+import time
+from typing import Optional
+
+from add_accent import add_accent, load_engine
+from utils import AccentEngine, remove_accent
+
+
+def read_messages(paths: list[str], limit: Optional[int] = None) -> list[str]:
+    messages = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            messages.extend(line.strip() for line in f if line.strip())
+    return messages[:limit] if limit else messages
+
+
+def evaluate(engine: AccentEngine, messages: list[str]) -> dict:
+    """Accuracy and latency numbers of one engine"""
+    engine.warm_up()
+    correct = total = 0
+    latencies = []
+    for message in messages:
+        begin = time.perf_counter()
+        restored = add_accent(remove_accent(message), engine=engine)
+        latencies.append(time.perf_counter() - begin)
+        expected = message.lower().split()
+        predicted = restored.lower().split()
+        total += len(expected)
+        correct += sum(e == p for e, p in zip(expected, predicted))
+    latencies.sort()
+    return {
+        "messages": len(messages),
+        "syllable_accuracy": correct / total if total else 0.0,
+        "mean_ms": 1000 * statistics.mean(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p95_ms": 1000 * latencies[int(len(latencies) * 0.95)],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument(
+        "files",
+        nargs="+",
+        help="accented text, one message per line",
+    )
+    parser.add_argument("--engines", nargs="+", default=["keras", "lattice"])
+    parser.add_argument("--limit", type=int, help="only the first N messages")
+    args = parser.parse_args()
+
+    messages = read_messages(args.files, args.limit)
+    for name in args.engines:
+        result = evaluate(load_engine(name), messages)
+        print(
+            f"{name:<8} accuracy {result['syllable_accuracy']:.3f}  "
+            f"mean {result['mean_ms']:.2f} ms  "
+            f"p50 {result['p50_ms']:.2f} ms  "
+            f"p95 {result['p95_ms']:.2f} ms  "
+            f"({result['messages']} messages)",
+        )
@@ -0,0 +1,103 @@
+"""
+Microbenchmark: CharacterCodec per-string encode/decode (the previous
+implementation, kept here as reference) vs. the batch encode_many/decode_many.
+
+Run from the repository root:
+    python -m benchmarks.bench_codec [--ngrams 2000] [--repeat 5]
+"""
+import argparse
+import random
+import string
+import time
+from typing import Optional
+
+import numpy as np
+
+from utils import ACCENTED_TO_BASE_CHAR_MAP, INVERT, MAXLEN, CharacterCodec
+
+ALPHABET = set(
+    "\x00 _"
+    + string.ascii_lowercase
+    + string.digits
+    + "".join(ACCENTED_TO_BASE_CHAR_MAP.keys())
+)
+
+
+class ReferenceCodec:
+    """The per-character loop implementation of CharacterCodec"""
+
+    def __init__(self, alphabet, maxlen: int) -> None:
+        self.alphabet = list(sorted(set(alphabet)))
+        self.index_alphabet = {c: i for i, c in enumerate(self.alphabet)}
+        self.maxlen = maxlen
+
+    def encode(self, C: str, maxlen: Optional[int] = None) -> np.ndarray:
+        maxlen = maxlen if maxlen else self.maxlen
+        X = np.zeros((maxlen, len(self.alphabet)))
+        for i, c in enumerate(C[:maxlen]):
+            X[i, self.index_alphabet[c]] = 1
+        return X
+
+    def decode(self, X: np.ndarray, calc_argmax: bool = True) -> str:
+        if calc_argmax:
+            X = X.argmax(axis=-1)
+        return "".join(self.alphabet[x] for x in X)
+
+
+def random_ngrams(n: int, seed: int = 0) -> list[str]:
+    """Padded (and inverted) ngram strings as fed to the accent model"""
+    rng = random.Random(seed)
+    letters = sorted(ALPHABET - {"\x00", " ", "_"})
+    texts = []
+    for _ in range(n):
+        words = [
+            "".join(rng.choice(letters) for _ in range(rng.randint(1, 5)))
+            for _ in range(5)
+        ]
+        text = " ".join(words)[:MAXLEN]
+        text += "\x00" * (MAXLEN - len(text))
+        texts.append(text[::-1] if INVERT else text)
+    return texts
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - begin)
+    return min(timings)
+
+
+def run(n_ngrams: int = 2000, repeat: int = 5) -> dict:
+    """Return {case: seconds per ngram}"""
+    texts = random_ngrams(n_ngrams)
+    reference = ReferenceCodec(ALPHABET, MAXLEN)
+    codec = CharacterCodec(ALPHABET, MAXLEN)
+    encoded = codec.encode_many(texts)
+    indices = encoded.argmax(axis=-1)
+
+    cases = {
+        "reference_encode": lambda: np.array(
+            [reference.encode(t) for t in texts],
+        ),
+        "encode_many_float32": lambda: codec.encode_many(texts),
+        "encode_many_uint8": lambda: codec.encode_many(texts, dtype=np.uint8),
+        "encode_indices_many": lambda: codec.encode_indices_many(texts),
+        "reference_decode": lambda: [
+            reference.decode(row, calc_argmax=False) for row in indices
+        ],
+        "decode_many": lambda: codec.decode_many(indices, calc_argmax=False),
+    }
+    return {name: best_of(fn, repeat) / n_ngrams for name, fn in cases.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument("--ngrams", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for name, seconds in run(args.ngrams, args.repeat).items():
+        print(f"{name:<22} {seconds * 1e6:8.2f} us/ngram")
@@ -0,0 +1,382 @@
+"""
+Offline benchmark suite: retrieval, prompt packing, document chunking,
+CharacterCodec and add_accent, with the OpenAI API replaced by the
+deterministic local fake (fake_openai.py), so no .env key or network
+access is needed.
+
+Results (seconds per operation, best of --repeat runs) can be saved as a
+JSON baseline and later runs compared against it:
+
+Run from the repository root:
+    python -m benchmarks.bench_suite --save benchmarks/baseline.json
+    python -m benchmarks.bench_suite --compare benchmarks/baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import openai
+
+import search
+from ai_configs import (
+    CONTEXT_TOP_N,
+    DELIMITER_TOKYOTECHLAB,
+    EMBEDDING_MODEL,
+    FILE_ENCODING,
+    FILE_TYPE,
+    MAX_TOKENS,
+    MODEL_NAME,
+    SERVICE,
+    TOKEN_BUDGET,
+)
+from benchmarks import bench_codec
+from cache import QueryEmbeddingCache, ResponseCache
+from embedding import format_content
+from fake_openai import FakeOpenAI, fake_embedding
+from retrieval import EmbeddingIndex
+from tokens import count_tokens
+from utils import remove_accent
+
+CASES = ["ranking", "packing", "chunking", "codec", "accent", "response"]
+DIM = 1536
+
+# accented sentences, stripped of their accents as add_accent input
+SENTENCES = [
+    "Làm sao để đổi mật khẩu tài khoản của tôi",
+    "Tôi muốn thay đổi ảnh đại diện và tên hiển thị",
+    "Cách kết nối tài khoản với Google như thế nào",
+    "Tại sao tôi không nhận được thông báo qua email",
+    "Hướng dẫn tạo dự án mới và mời thành viên tham gia",
+]
+
+WORDS = (
+    "account project task member setting profile password notification "
+    "calendar report export import permission role team workspace file "
+    "comment board sprint deadline reminder integration google email"
+).split()
+
+
+class FakeServer:
+    """FakeOpenAI served from its own event loop in a daemon thread"""
+
+    def __init__(self, **kwargs) -> None:
+        self.fake = FakeOpenAI(**kwargs)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.api_base = self._run(self.fake.start())
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self) -> None:
+        self._run(self.fake.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def use_fake_openai(server: FakeServer) -> None:
+    """Point the OpenAI client at the fake, without caching answers"""
+    openai.api_base = server.api_base
+    openai.api_key = openai.api_key or "sk-offline"
+    search.query_embedding_cache = QueryEmbeddingCache(EMBEDDING_MODEL, 0)
+    search.response_cache = ResponseCache(0)
+
+
+def best_of(fn, repeat: int, ops: int) -> float:
+    """Seconds per operation of the fastest of `repeat` runs of fn(run)"""
+    timings = []
+    for run in range(repeat):
+        begin = time.perf_counter()
+        fn(run)
+        timings.append(time.perf_counter() - begin)
+    return min(timings) / ops
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def synthetic_index(size: int, words: int = 0, seed: int = 0):
+    """Index of `size` unit vectors; texts of `words` words with counts"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((size, DIM), dtype=np.float32)
+    if words:
+        text_rng = random.Random(seed)
+        texts = [random_text(text_rng, words) for _ in range(size)]
+    else:
+        texts = [f"chunk {i}" for i in range(size)]
+    index = EmbeddingIndex(vectors, texts, version=f"bench-{size}")
+    if words:
+        index.token_counts = count_tokens(texts, MODEL_NAME)
+        index.token_encoding = search.get_encoding(MODEL_NAME).name
+    return index
+
+
+def queries(n: int, run: int) -> list[str]:
+    """Distinct queries per run, so every run embeds them again"""
+    return [f"question {i} of run {run}" for i in range(n)]
+
+
+def bench_ranking(args) -> dict:
+    results = {}
+    for size in args.sizes:
+        index = synthetic_index(size)
+        vectors = [fake_embedding(q, DIM) for q in queries(args.queries, 0)]
+        results[f"top_k_{size}"] = best_of(
+            lambda run: [index.top_k(v, CONTEXT_TOP_N) for v in vectors],
+            args.repeat,
+            len(vectors),
+        )
+        results[f"strings_ranked_by_relatedness_{size}"] = best_of(
+            lambda run: [
+                search.strings_ranked_by_relatedness(
+                    q,
+                    index,
+                    top_n=CONTEXT_TOP_N,
+                )
+                for q in queries(args.queries, run)
+            ],
+            args.repeat,
+            args.queries,
+        )
+    return results
+
+
+def bench_packing(args) -> dict:
+    index = synthetic_index(args.packing_rows, words=args.chunk_words)
+    ranked = [
+        search.rank(index, fake_embedding(q, DIM), top_n=20)
+        for q in queries(args.queries, 0)
+    ]
+    return {
+        "query_message": best_of(
+            lambda run: [
+                search.query_message(q, index, MODEL_NAME, TOKEN_BUDGET)
+                for q in queries(args.queries, run)
+            ],
+            args.repeat,
+            args.queries,
+        ),
+        "build_message": best_of(
+            lambda run: [
+                search.build_message(
+                    "question",
+                    strings,
+                    MODEL_NAME,
+                    TOKEN_BUDGET,
+                    token_counts=token_counts,
+                )
+                for strings, _, token_counts in ranked
+            ],
+            args.repeat,
+            len(ranked),
+        ),
+    }
+
+
+def write_documents(directory: str, n: int, seed: int = 0) -> None:
+    """n training files in the format of SERVICE"""
+    rng = random.Random(seed)
+    delimiter = DELIMITER_TOKYOTECHLAB if SERVICE == "TokyoTechLab" else "# "
+    for i in range(n):
+        sections = "".join(
+            f"{delimiter}Section {j}\n\n"
+            f"{random_text(rng, rng.randint(50, 800))}\n\n"
+            for j in range(rng.randint(3, 12))
+        )
+        content = (
+            f"Title: Document {i}\nURL: https://example.com/{i}\n"
+            f"Language: English\n-----\n{sections}"
+        )
+        path = os.path.join(directory, f"document_{i}{FILE_TYPE}")
+        with open(path, "w", encoding=FILE_ENCODING) as f:
+            f.write(content)
+
+
+def bench_chunking(args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        write_documents(directory, args.documents)
+        # format_content prints every file
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = best_of(
+                lambda run: format_content(directory, MAX_TOKENS, MODEL_NAME),
+                args.repeat,
+                args.documents,
+            )
+    return {"format_content": seconds}
+
+
+def bench_codec_cases(args) -> dict:
+    return {
+        f"codec_{name}": seconds
+        for name, seconds in bench_codec.run(args.ngrams, args.repeat).items()
+    }
+
+
+def bench_accent(args) -> dict:
+    from add_accent import add_accent, get_engine
+
+    try:
+        get_engine().warm_up()
+    except Exception as e:
+        print(f"accent: skipped, the accent engine did not load: {e!r}")
+        return {}
+    messages = [
+        remove_accent(SENTENCES[i % len(SENTENCES)])
+        for i in range(args.messages)
+    ]
+    return {
+        "add_accent": best_of(
+            lambda run: [add_accent(m) for m in messages],
+            args.repeat,
+            len(messages),
+        ),
+    }
+
+
+def bench_response(args) -> dict:
+    """get_response end to end: the fake's latency plus our overhead"""
+    index = synthetic_index(args.packing_rows, words=args.chunk_words)
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = best_of(
+            lambda run: [
+                search.get_response(q, index)
+                for q in queries(args.queries, run)
+            ],
+            args.repeat,
+            args.queries,
+        )
+    return {"get_response": seconds}
+
+
+BENCHMARKS = {
+    "ranking": bench_ranking,
+    "packing": bench_packing,
+    "chunking": bench_chunking,
+    "codec": bench_codec_cases,
+    "accent": bench_accent,
+    "response": bench_response,
+}
+
+
+def run(args) -> dict:
+    """Return {case: seconds per operation} of the selected benchmarks"""
+    server = FakeServer(
+        dim=DIM,
+        latency=args.latency,
+        answer_words=args.answer_words,
+    )
+    try:
+        use_fake_openai(server)
+        results = {}
+        for name in args.cases:
+            begin = time.perf_counter()
+            results.update(BENCHMARKS[name](args))
+            print(
+                f"{name} done in {time.perf_counter() - begin:.1f}s",
+                file=sys.stderr,
+            )
+        return results
+    finally:
+        server.stop()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Print new vs. baseline timings, return the regressed cases"""
+    regressions = []
+    print(f"{'case':<42} {'baseline us':>12} {'now us':>12} {'ratio':>8}")
+    for name, seconds in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<42} {'-':>12} {seconds * 1e6:>12.2f} {'new':>8}")
+            continue
+        ratio = seconds / old if old else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<42} {old * 1e6:>12.2f} {seconds * 1e6:>12.2f} "
+            f"{ratio:>8.2f}{flag}",
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[1000, 10000, 50000],
+        help="synthetic corpus sizes of the ranking benchmark",
+    )
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--packing-rows", type=int, default=2000)
+    parser.add_argument("--chunk-words", type=int, default=300)
+    parser.add_argument("--documents", type=int, default=32)
+    parser.add_argument("--ngrams", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds the fake OpenAI API adds to every request",
+    )
+    parser.add_argument("--answer-words", type=int, default=50)
+    parser.add_argument("--save", help="write the results to this baseline")
+    parser.add_argument("--compare", help="compare with this JSON baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="slowdown ratio above 1 reported as a regression",
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+    else:
+        for name, seconds in results.items():
+            print(f"{name:<42} {seconds * 1e6:10.2f} us/op")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "cpu_count": os.cpu_count(),
+                        "service": SERVICE,
+                        "args": {
+                            k: v
+                            for k, v in vars(args).items()
+                            if k not in ("save", "compare")
+                        },
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,576 @@
+"""
+Caches in front of the OpenAI API.
+
+QueryEmbeddingCache: two tiers, an in-process LRU and a persistent SQLite
+table, keyed by normalized query text and embedding model.
+ResponseCache: chat completions keyed by query embedding; exact repeats
+and near-duplicate questions reuse a stored answer.
+SingleFlight: concurrent identical calls share one in-flight call, for
+the repeats that arrive before the first answer is cached.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+# the disk tier trims itself back to max_entries every this many writes
+DISK_EVICTION_INTERVAL = 100
+# access times of disk hits are written in batches of this many
+DISK_TOUCH_BATCH = 100
+
+
+def normalize_query(text: str) -> str:
+    """Unicode NFC, lowercase, single spaces, no leading/trailing spaces"""
+    text = unicodedata.normalize("NFC", text).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class CacheStats:
+    """Hit/miss/eviction counters"""
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hit_rate,
+        }
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with an optional TTL (seconds)"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._data = OrderedDict()  # key -> (created_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.stats.misses += 1
+                return None
+            created_at, value = item
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self._data[key]
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.stats.evictions += 1
+
+    def pop(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.pop(key, None)
+            return None if item is None else item[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache:
+    """
+    Persistent key -> bytes cache in a SQLite file.
+    Least recently used rows are deleted once there are more than
+    max_entries; rows older than ttl seconds are treated as missing.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        max_entries: int,
+        ttl: Optional[float] = None,
+    ) -> None:
+        self.filepath = filepath
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._writes = 0
+        # key -> access time of hits not written yet, so a hit is a read
+        self._touched = {}
+        self._lock = threading.Lock()
+        folder = os.path.dirname(filepath)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)",
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed_at "
+            "ON cache (accessed_at)",
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            value, created_at = row
+            if self.ttl is not None and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= DISK_TOUCH_BATCH:
+                self._write_touched()
+                self._conn.commit()
+            self.stats.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._touched.pop(key, None)
+            self._writes += 1
+            if self._writes % DISK_EVICTION_INTERVAL == 0:
+                self._evict()
+            self._conn.commit()
+
+    def _write_touched(self) -> None:
+        """Write the pending access times of hits, with _lock"""
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                [(now, key) for key, now in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _evict(self) -> None:
+        # least recently used is decided on up-to-date access times
+        self._write_touched()
+        if self.ttl is not None:
+            cursor = self._conn.execute(
+                "DELETE FROM cache WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            )
+            self.stats.expirations += cursor.rowcount
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self.max_entries:
+            cursor = self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                "ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            self.stats.evictions += cursor.rowcount
+
+    def clear(self) -> None:
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._write_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+class QueryEmbeddingCache:
+    """
+    Two-tier cache of query embeddings: in-process LRU, then SQLite.
+    The async methods run the SQLite tier in a worker thread, off the
+    event loop; memory hits are answered without leaving it.
+    Usage:
+        cache = QueryEmbeddingCache("text-embedding-ada-002", 4096)
+        embedding = cache.get_or_create(query, create_embedding)
+        embedding = await cache.aget(query)
+        cache.stats()
+    """
+
+    def __init__(
+        self,
+        model: str,
+        memory_size: int,
+        disk_path: Optional[str] = None,
+        disk_size: int = 0,
+        ttl: Optional[float] = None,
+    ) -> None:
+        """
+        args:
+            model(str): embedding model, part of every key
+            memory_size(int): entries kept in memory (0 disables the tier)
+            disk_path(str): SQLite file, None disables the disk tier
+            disk_size(int): entries kept on disk
+            ttl(float): seconds before an entry expires, None = never
+        """
+        self.model = model
+        self.memory = LRUCache(memory_size, ttl)
+        self.disk = None
+        if disk_path and disk_size > 0:
+            self.disk = SQLiteCache(disk_path, disk_size, ttl)
+
+    def key(self, text: str) -> str:
+        normalized = normalize_query(text)
+        return hashlib.sha256(
+            f"{self.model}\x00{normalized}".encode("utf-8"),
+        ).hexdigest()
+
+    def _from_disk(self, key: str, value: Optional[bytes]):
+        """Decode a disk tier value and keep it in memory"""
+        if value is None:
+            return None
+        embedding = np.frombuffer(value, dtype=np.float32)
+        self.memory.put(key, embedding)
+        return embedding
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self.key(text)
+        embedding = self.memory.get(key)
+        if embedding is not None or self.disk is None:
+            return embedding
+        return self._from_disk(key, self.disk.get(key))
+
+    def put(self, text: str, embedding) -> np.ndarray:
+        key = self.key(text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self.memory.put(key, embedding)
+        if self.disk is not None:
+            self.disk.put(key, embedding.tobytes())
+        return embedding
+
+    async def aget(self, text: str) -> Optional[np.ndarray]:
+        """get, with the disk tier read in a worker thread"""
+        return (await self.aget_many([text]))[0]
+
+    async def aget_many(self, texts: list[str]) -> list:
+        """get of many texts, with one worker thread for the disk reads"""
+        keys = [self.key(text) for text in texts]
+        embeddings = [self.memory.get(key) for key in keys]
+        missing = [
+            i for i, embedding in enumerate(embeddings) if embedding is None
+        ]
+        if missing and self.disk is not None:
+            values = await asyncio.to_thread(
+                lambda: [self.disk.get(keys[i]) for i in missing],
+            )
+            for i, value in zip(missing, values):
+                embeddings[i] = self._from_disk(keys[i], value)
+        return embeddings
+
+    async def aput(self, text: str, embedding) -> np.ndarray:
+        """put, with the disk tier written in a worker thread"""
+        return (await self.aput_many([(text, embedding)]))[0]
+
+    async def aput_many(self, items: list[tuple]) -> list[np.ndarray]:
+        """put of many (text, embedding), with one worker thread"""
+        rows = []
+        for text, embedding in items:
+            key = self.key(text)
+            embedding = np.asarray(embedding, dtype=np.float32)
+            self.memory.put(key, embedding)
+            rows.append((key, embedding))
+        if self.disk is not None:
+            await asyncio.to_thread(
+                lambda: [
+                    self.disk.put(key, embedding.tobytes())
+                    for key, embedding in rows
+                ],
+            )
+        return [embedding for _, embedding in rows]
+
+    def get_or_create(
+        self,
+        text: str,
+        create: Callable[[str], Any],
+    ) -> np.ndarray:
+        """Return the cached embedding, or create(text) and cache it"""
+        embedding = self.get(text)
+        if embedding is None:
+            embedding = self.put(text, create(text))
+        return embedding
+
+    def stats(self) -> dict:
+        stats = {"memory": self.memory.stats.as_dict()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats.as_dict()
+        return stats
+
+
+def fingerprint(*parts) -> str:
+    """Stable hash of everything a cached response depends on"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class ResponseCacheStats(CacheStats):
+    """CacheStats that tells exact hits from near-duplicate hits"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.semantic_hits = 0
+
+    def as_dict(self) -> dict:
+        stats = super().as_dict()
+        stats["exact_hits"] = self.hits - self.semantic_hits
+        stats["semantic_hits"] = self.semantic_hits
+        return stats
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of responses keyed by query embedding.
+    A lookup first tries the exact (normalized) query text, then, if a
+    `threshold` is set, the most similar cached query: its response is
+    reused if the cosine similarity is at least `threshold`. Every entry carries the fingerprint of the
+    data and prompt config it was answered with (see `fingerprint`) and
+    only matches lookups with the same fingerprint.
+    Usage:
+        cache = ResponseCache(1024, threshold=None, ttl=3600)
+        response = cache.get(query, query_embedding, config_fingerprint)
+        cache.put(query, query_embedding, config_fingerprint, response)
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        threshold: Optional[float] = None,
+        ttl: Optional[float] = None,
+    ) -> None:
+        """
+        args:
+            max_size(int): entries kept (0 disables the cache)
+            threshold(float): minimum cosine similarity of a near-duplicate,
+                None only reuses exact repeats
+            ttl(float): seconds before an entry expires, None = never
+        """
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.stats = ResponseCacheStats()
+        self._lock = threading.Lock()
+        # key -> slot, in LRU order
+        self._slots = OrderedDict()
+        self._free = list(range(max_size - 1, -1, -1))
+        # per slot: unit-normalized query vector, fingerprint id, time, value
+        self._vectors = None
+        # fingerprint <-> id of the fingerprints with live slots only, so
+        # hot reloads (a new fingerprint each) do not grow them forever
+        self._config_ids = {}
+        self._config_names = {}
+        self._next_config_id = 0
+        self._slot_configs = np.full(max_size, -1, dtype=np.int64)
+        self._created_at = np.zeros(max_size)
+        self._values = [None] * max_size
+        self._keys = [None] * max_size
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _key(self, query: str, config: str) -> str:
+        return f"{config}\x00{normalize_query(query)}"
+
+    def _unit(self, embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expired(self, slot: int) -> bool:
+        if self.ttl is None:
+            return False
+        return time.time() - self._created_at[slot] > self.ttl
+
+    def _release(self, key: str) -> None:
+        slot = self._slots.pop(key)
+        config_id = int(self._slot_configs[slot])
+        self._slot_configs[slot] = -1
+        if not (self._slot_configs == config_id).any():
+            del self._config_ids[self._config_names.pop(config_id)]
+        self._values[slot] = None
+        self._keys[slot] = None
+        self._free.append(slot)
+
+    def _config_id(self, config: str) -> int:
+        if config not in self._config_ids:
+            self._config_ids[config] = self._next_config_id
+            self._config_names[self._next_config_id] = config
+            self._next_config_id += 1
+        return self._config_ids[config]
+
+    def _nearest(self, vector: np.ndarray, config: str) -> Optional[int]:
+        if self._vectors is None or config not in self._config_ids:
+            return None
+        if self._vectors.shape[1] != vector.shape[0]:
+            return None
+        mask = self._slot_configs == self._config_ids[config]
+        if not mask.any():
+            return None
+        scores = np.where(mask, self._vectors @ vector, -np.inf)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return best
+
+    def get(self, query: str, embedding, config: str) -> Optional[Any]:
+        """
+        Return the cached response for the query, None on a miss.
+        args:
+            query(str): query text
+            embedding: query embedding
+            config(str): fingerprint of the data and prompt config
+        """
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            slot = self._slots.get(self._key(query, config))
+            semantic = False
+            if slot is None and self.threshold is not None:
+                slot = self._nearest(self._unit(embedding), config)
+                semantic = slot is not None
+            if slot is not None and self._expired(slot):
+                self._release(self._keys[slot])
+                self.stats.expirations += 1
+                slot = None
+            if slot is None:
+                self.stats.misses += 1
+                return None
+            self._slots.move_to_end(self._keys[slot])
+            self.stats.hits += 1
+            self.stats.semantic_hits += semantic
+            return self._values[slot]
+
+    def put(self, query: str, embedding, config: str, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        vector = self._unit(embedding)
+        key = self._key(query, config)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros(
+                    (self.max_size, len(vector)),
+                    dtype=np.float32,
+                )
+            if key in self._slots:
+                self._release(key)
+            while not self._free:
+                self._release(next(iter(self._slots)))
+                self.stats.evictions += 1
+            slot = self._free.pop()
+            self._slots[key] = slot
+            self._keys[slot] = key
+            self._vectors[slot] = vector
+            self._slot_configs[slot] = self._config_id(config)
+            self._created_at[slot] = time.time()
+            self._values[slot] = value
+
+    def invalidate(self, config: Optional[str] = None) -> None:
+        """Drop the entries of one fingerprint, or all of them"""
+        with self._lock:
+            config_id = self._config_ids.get(config)
+            for key, slot in list(self._slots.items()):
+                if config is None or self._slot_configs[slot] == config_id:
+                    self._release(key)
+
+
+class SingleFlightStats:
+    """Calls made and calls coalesced into one already in flight"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.coalesced = 0
+
+    def as_dict(self) -> dict:
+        total = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / total if total else 0.0,
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent async calls with the same key: the first one runs,
+    the ones that arrive while it is in flight get its result (or its
+    exception) instead of running again.
+    The call runs in its own task, so a caller that is cancelled (e.g. a
+    client that went away) does not cancel it for the others.
+    Usage:
+        flight = SingleFlight()
+        response = await flight.do(key, lambda: openai...acreate(...))
+        flight.stats.as_dict()
+    """
+
+    def __init__(self) -> None:
+        self.stats = SingleFlightStats()
+        self._tasks = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def do(self, key: str, call: Callable[[], Any]) -> Any:
+        """Return the result of call(), shared with concurrent same keys"""
+        task = self._tasks.get(key)
+        if task is None:
+            self.stats.calls += 1
+            task = asyncio.ensure_future(call())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._done(key, task))
+        else:
+            self.stats.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # retrieved, even when every caller was cancelled meanwhile
+            task.exception()
@@ -1,27 +1,59 @@
+import argparse
+import ast
+import asyncio
+import base64
+import collections
+import concurrent.futures
 import configparser
+import json
+import multiprocessing
 import os
+import time
 import warnings
+from typing import Iterable, Optional, Sequence
 
+import numpy as np
 import openai
 import pandas as pd
-import tiktoken
 from ai_configs import (
-    BATCH_SIZE,
+    ANN_MIN_ROWS,
+    ANN_NLIST,
+    ANN_NPROBE,
+    ANN_RECALL_K,
+    CHUNK_POOL_MIN_FILES,
+    CHUNK_WORKERS,
     DELIMITER_TOKYOTECHLAB,
     EMBEDDING_MODEL,
     FILE_ENCODING,
     FILE_TYPE,
-    FILEPATH_EMBEDDINGS,
     FOLDERPATH_DOCUMENTS,
+    FOLDERPATH_EMBEDDING_STORE,
     MAX_TOKENS,
     MODEL_NAME,
+    QA_LOG_COMPACT_RATIO,
+    QA_LOG_MIN_ENTRIES,
     SERVICE,
 )
+from ann_index import build_ivf_index
+from embedding_scheduler import EmbeddingScheduler
+from embedding_store import (
+    HASH_COLUMN,
+    TOKENS_COLUMN,
+    EmbeddingStore,
+    StoreWriter,
+    chunk_hash,
+    store_exists,
+    write_embedding_store,
+)
+from tokens import count_tokens, get_encoding, num_tokens
 
 env = configparser.ConfigParser()
 env.read(".env")
-os.environ["OPENAI_API_KEY"] = env["OpenAI"]["OPENAI_KEY_TTL"]
-openai.api_key = os.environ["OPENAI_API_KEY"]
+# without a key in .env (or OPENAI_API_KEY) the module still imports, e.g.
+# for offline benchmarks against fake_openai.py; API calls fail instead
+if env.has_option("OpenAI", "OPENAI_KEY_TTL"):
+    os.environ["OPENAI_API_KEY"] = env["OpenAI"]["OPENAI_KEY_TTL"]
+openai.api_key = os.environ.get("OPENAI_API_KEY")
 
 
 def list_files(directory: str) -> list:
@@ -47,12 +79,6 @@ def read_file(file_path: str) -> str:
     return file_content
 
 
-def num_tokens(text: str, model: str = MODEL_NAME) -> int:
-    """Return the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
-
-
 def truncated_string(
     string: str,
     model: str,
@@ -60,9 +86,22 @@ def truncated_string(
     print_warning: bool = True,
 ) -> str:
     """Truncate a string to a maximum number of tokens."""
-    encoding = tiktoken.encoding_for_model(model)
-    encoded_string = encoding.encode(string)
-    truncated_string = encoding.decode(encoded_string[:max_tokens])
+    return truncate_tokens(
+        get_encoding(model).encode(string),
+        model,
+        max_tokens,
+        print_warning,
+    )
+
+
+def truncate_tokens(
+    encoded_string: list[int],
+    model: str,
+    max_tokens: int,
+    print_warning: bool = True,
+) -> str:
+    """Decode the first max_tokens tokens of an encoded string."""
+    truncated_string = get_encoding(model).decode(encoded_string[:max_tokens])
     if print_warning and len(encoded_string) > max_tokens:
         print(
             f"Warning: Truncated string from {len(encoded_string)} tokens to {max_tokens} tokens.",  # noqa: E501
@@ -70,6 +109,27 @@ def truncated_string(
     return truncated_string
 
 
+def fit_section(
+    titles: list[str],
+    section_content: str,
+    max_tokens: int,
+    model: str = MODEL_NAME,
+) -> str:
+    """
+    Truncate a section to max_tokens, tokenizing it at most once.
+    A token is at least one byte, so short sections are not tokenized.
+    """
+    if len(section_content.encode("utf-8")) <= max_tokens:
+        return section_content
+    encoded_section = get_encoding(model).encode(section_content)
+    if len(encoded_section) <= max_tokens:
+        return section_content
+    print(
+        f"{titles} ({len(encoded_section)}) has more than {max_tokens} tokens",  # noqa: E501
+    )
+    return truncate_tokens(encoded_section, model, max_tokens)
+
+
 def determine_delimiter(
     strings: str,
     service: str = SERVICE,
@@ -122,20 +182,14 @@ def format_content_Tokyo_Tech_Lab(
             continue
 
         # get section title (first row) and content (from 2nd row)
-        section_title = chunk.split("\n")[0]
+        section_title, _, section_content = chunk.partition("\n")
         titles = [url, section_title]
-        section_content = chunk.split("\n")[1:]
-        section_content = "\n".join(section_content)
-
-        if num_tokens(section_content) > max_tokens:
-            print(
-                f"{titles} ({num_tokens(section_content)}) has more than {max_tokens} tokens",  # noqa: E501
-            )
-            section_content = truncated_string(
-                section_content,
-                model=model,
-                max_tokens=max_tokens,
-            )
+        section_content = fit_section(
+            titles,
+            section_content,
+            max_tokens,
+            model,
+        )
 
         string = "\n\n".join(titles + [section_content])
         strings.extend([string])
@@ -195,20 +249,14 @@ def format_content_Teamhub(
             continue
 
         # get section title (first row) and content (from 2nd row)
-        section_title = chunk.split("\n")[0]
+        section_title, _, section_content = chunk.partition("\n")
         titles = [title + " > " + section_title, url]
-        section_content = chunk.split("\n")[1:]
-        section_content = "\n".join(section_content)
-
-        if num_tokens(section_content) > max_tokens:
-            print(
-                f"{titles} ({num_tokens(section_content)}) has more than {max_tokens} tokens",  # noqa: E501
-            )
-            section_content = truncated_string(
-                section_content,
-                model=model,
-                max_tokens=max_tokens,
-            )
+        section_content = fit_section(
+            titles,
+            section_content,
+            max_tokens,
+            model,
+        )
 
         string = "\n\n".join(titles + [section_content])
         # print(f"----------\n{string}\n")
@@ -216,6 +264,88 @@ def format_content_Teamhub(
     return strings
 
 
+def format_file(
+    file_content: str,
+    max_tokens: int = 1000,
+    model: str = MODEL_NAME,
+) -> list[str]:
+    """Format the content of one document file into chunks"""
+    if SERVICE == "TokyoTechLab":
+        return format_content_Tokyo_Tech_Lab(
+            [],
+            file_content,
+            max_tokens,
+            model,
+        )
+    elif SERVICE == "Teamhub":
+        return format_content_Teamhub(
+            [],
+            file_content,
+            max_tokens,
+            model,
+        )
+    return []
+
+
+def format_path(
+    file_path: str,
+    max_tokens: int = 1000,
+    model: str = MODEL_NAME,
+) -> list[str]:
+    """Read and format one document file (run in the formatting processes)"""
+    print(f"File: {os.path.basename(file_path)}")
+    return format_file(read_file(file_path), max_tokens, model)
+
+
+def format_files(
+    directory: str,
+    files: list[str],
+    max_tokens: int = 1000,
+    model: str = MODEL_NAME,
+    workers: int = CHUNK_WORKERS,
+):
+    """
+    Yield (file, chunks) of every file, in the order of files.
+    With CHUNK_POOL_MIN_FILES files or more, the files are formatted by a
+    pool of `workers` processes (0 = one per CPU core), a bounded number of
+    files ahead of the consumer.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(files) < CHUNK_POOL_MIN_FILES:
+        for file in files:
+            yield file, format_path(
+                os.path.join(directory, file),
+                max_tokens,
+                model,
+            )
+        return
+
+    # spawn: the caller may have threads running (e.g. the event loop)
+    with concurrent.futures.ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        pending = collections.deque()
+        for file in files:
+            pending.append(
+                (
+                    file,
+                    pool.submit(
+                        format_path,
+                        os.path.join(directory, file),
+                        max_tokens,
+                        model,
+                    ),
+                ),
+            )
+            if len(pending) >= 4 * workers:
+                file, future = pending.popleft()
+                yield file, future.result()
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result()
+
+
 def format_content(
     directory: str,
     max_tokens: int = 1000,
@@ -223,67 +353,427 @@ def format_content(
 ) -> list[str]:
     strings = []
 
-    # read files
+    # read and format files
     files = list_files(directory)
-    for file in files:
-        print(f"File: {file}")
-        file_content = read_file(
-            os.path.join(
-                FOLDERPATH_DOCUMENTS,
-                file,
-            ),
+    for _, chunks in format_files(directory, files, max_tokens, model):
+        strings.extend(chunks)
+
+    return strings
+
+
+def create_embeddings(
+    strings: list[str],
+    checkpoint_path: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Embed strings via OpenAI API: concurrent, rate-limited batches
+    (see embedding_scheduler.py), resumed from checkpoint_path if given.
+    For scripts; from a running event loop, await acreate_embeddings.
+    """
+    scheduler = EmbeddingScheduler(checkpoint_path=checkpoint_path)
+    return scheduler.embed(strings)
+
+
+async def acreate_embeddings(
+    strings: list[str],
+    checkpoint_path: Optional[str] = None,
+) -> np.ndarray:
+    """create_embeddings, from a running event loop"""
+    scheduler = EmbeddingScheduler(checkpoint_path=checkpoint_path)
+    return await scheduler.aembed(strings)
+
+
+def file_snapshot(directory: str) -> dict:
+    """Return file name -> (mtime_ns, size) of the documents in directory"""
+    snapshot = {}
+    for file in list_files(directory):
+        stat = os.stat(os.path.join(directory, file))
+        snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def open_previous_store(store_path: str) -> Optional[EmbeddingStore]:
+    """Return the current store if its vectors can be reused by hash"""
+    if not store_exists(store_path):
+        return None
+    store = EmbeddingStore(store_path)
+    if HASH_COLUMN not in store.columns:
+        # written before chunk hashes were stored
+        return None
+    return store
+
+
+# row: row of the chunk in the previous store version, None = not embedded
+Chunk = collections.namedtuple("Chunk", ["hash", "text", "n_tokens", "row"])
+
+
+class StageStats:
+    """
+    Items processed and seconds spent by one stage of the pipeline.
+    The seconds of a concurrent stage are the wall time from its first
+    start to its last finish, not the sum of its overlapping calls.
+    """
+
+    def __init__(self, name: str, unit: str, concurrent: bool = False) -> None:
+        self.name = name
+        self.unit = unit
+        self.concurrent = concurrent
+        self.items = 0
+        self.seconds = 0.0
+        self._first_start = None
+
+    def add(self, items: int, start: float) -> None:
+        """Count items processed since start (a time.perf_counter())"""
+        end = time.perf_counter()
+        self.items += items
+        if not self.concurrent:
+            self.seconds += end - start
+            return
+        if self._first_start is None or start < self._first_start:
+            self._first_start = start
+        self.seconds = max(self.seconds, end - self._first_start)
+
+    def __str__(self) -> str:
+        rate = self.items / self.seconds if self.seconds else 0.0
+        return (
+            f"{self.name}: {self.items} {self.unit} in {self.seconds:.2f}s "
+            f"({rate:.1f} {self.unit}/s)"
         )
-        
-        if SERVICE == "TokyoTechLab":
-            
-            strings = format_content_Tokyo_Tech_Lab(
-                strings,
-                file_content,
-                max_tokens,
-                model,
-            )
-        elif SERVICE == "Teamhub":
-            strings = format_content_Teamhub(
-                strings,
-                file_content,
-                max_tokens,
-                model,
+
+
+class IngestionPipeline:
+    """
+    Streams the documents into a new version of the embedding store:
+        format_documents -> chunk_documents -> batch_chunks -> embed -> write
+    The stages are generators and at most max_in_flight batches are held
+    between the batcher and the writer (StoreWriter appends to disk), so
+    memory stays flat however large the corpus is.
+
+    The update is incremental: files whose mtime and size match the store's
+    manifest are not read again, and only chunks whose content hash is not
+    in the previous version are embedded. Chunks that no longer exist are
+    dropped. Set full to re-embed everything.
+
+    Usage:
+        version = IngestionPipeline(FOLDERPATH_DOCUMENTS, store_path).run()
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        store_path: str,
+        full: bool = False,
+        scheduler: Optional[EmbeddingScheduler] = None,
+    ) -> None:
+        """
+        args:
+            directory(str): folder of the documents
+            store_path(str): embedding store folder
+            full(bool): re-embed every chunk
+            scheduler(EmbeddingScheduler): sends the embedding requests,
+                by default checkpointed to <store_path>.checkpoint
+        """
+        self.directory = directory
+        self.store_path = store_path
+        self.scheduler = scheduler or EmbeddingScheduler(
+            checkpoint_path=store_path + ".checkpoint",
+        )
+        self.settings = {
+            "service": SERVICE,
+            "max_tokens": MAX_TOKENS,
+            "model": EMBEDDING_MODEL,
+        }
+        self.previous = None if full else open_previous_store(store_path)
+        self.previous_files = {}
+        self.previous_rows = {}
+        self.previous_tokens = None
+        if self.previous is not None:
+            manifest = self.previous.manifest()
+            if manifest.get("settings") == self.settings:
+                self.previous_files = manifest.get("files", {})
+            self.previous_rows = {
+                h.decode(): row
+                for row, h in enumerate(
+                    self.previous.column(HASH_COLUMN).tolist(),
+                )
+            }
+            if (
+                TOKENS_COLUMN in self.previous.columns
+                and self.previous.meta.get("token_encoding")
+                == get_encoding(MODEL_NAME).name
+            ):
+                self.previous_tokens = self.previous.column(TOKENS_COLUMN)
+        self.snapshot = file_snapshot(directory)
+        self.files = {}  # manifest of the new version
+        self.changed = 0
+        self.embedded = 0
+        self.reused = 0
+        self.kept = np.zeros(len(self.previous or ()), dtype=bool)
+        self.stats = {
+            "format": StageStats("format", "files"),
+            "chunk": StageStats("chunk", "chunks"),
+            "embed": StageStats("embed", "chunks", concurrent=True),
+            "write": StageStats("write", "chunks"),
+        }
+
+    def is_unchanged(self, file: str) -> bool:
+        """Whether the file is as in the previous version's manifest"""
+        entry = self.previous_files.get(file)
+        return (
+            entry is not None
+            and [entry["mtime_ns"], entry["size"]] == list(self.snapshot[file])
+            and all(h in self.previous_rows for h in entry["chunks"])
+        )
+
+    def is_up_to_date(self) -> bool:
+        return (
+            bool(self.previous_files)
+            and set(self.previous_files) == set(self.snapshot)
+            and all(self.is_unchanged(file) for file in self.snapshot)
+        )
+
+    def format_documents(self):
+        """
+        Yield (file, chunk texts), texts is None for unchanged files.
+        Changed files are read and formatted by format_files.
+        """
+        stats = self.stats["format"]
+        changed = [
+            file for file in self.snapshot if not self.is_unchanged(file)
+        ]
+        formatted = format_files(self.directory, changed, MAX_TOKENS)
+        changed = set(changed)
+        for file in self.snapshot:
+            if file not in changed:
+                yield file, None
+                continue
+            # time spent waiting for the formatter
+            start = time.perf_counter()
+            _, texts = next(formatted)
+            stats.add(1, start)
+            yield file, texts
+
+    def previous_chunk(self, h: str) -> Chunk:
+        row = self.previous_rows[h]
+        text = self.previous.texts[row]
+        if self.previous_tokens is not None:
+            n_tokens = int(self.previous_tokens[row])
+        else:
+            n_tokens = num_tokens(text)
+        return Chunk(h, text, n_tokens, row)
+
+    def chunk_documents(self, documents):
+        """Yield the Chunks of the documents"""
+        stats = self.stats["chunk"]
+        for file, texts in documents:
+            start = time.perf_counter()
+            if texts is None:
+                chunks = [
+                    self.previous_chunk(h)
+                    for h in self.previous_files[file]["chunks"]
+                ]
+            else:
+                self.changed += 1
+                chunks = []
+                for text, n_tokens in zip(texts, count_tokens(texts)):
+                    h = chunk_hash(text)
+                    if h in self.previous_rows:
+                        chunks.append(self.previous_chunk(h))
+                    else:
+                        chunks.append(Chunk(h, text, int(n_tokens), None))
+            mtime_ns, size = self.snapshot[file]
+            self.files[file] = {
+                "mtime_ns": mtime_ns,
+                "size": size,
+                "chunks": [chunk.hash for chunk in chunks],
+            }
+            stats.add(len(chunks), start)
+            yield from chunks
+
+    def batch_chunks(self, chunks):
+        """Yield lists of chunks that need at most one embedding request"""
+        batch, tokens = [], 0
+        for chunk in chunks:
+            cost = chunk.n_tokens if chunk.row is None else 0
+            if batch and (
+                len(batch) >= self.scheduler.max_batch_size
+                or tokens + cost > self.scheduler.max_batch_tokens
+            ):
+                yield batch
+                batch, tokens = [], 0
+            batch.append(chunk)
+            tokens += cost
+        if batch:
+            yield batch
+
+    async def embed(
+        self,
+        batch: list[Chunk],
+    ) -> tuple[list[Chunk], np.ndarray]:
+        """Return the batch and its vectors, embedding the new chunks"""
+        start = time.perf_counter()
+        new = [i for i, chunk in enumerate(batch) if chunk.row is None]
+        reused = [i for i, chunk in enumerate(batch) if chunk.row is not None]
+        parts = []
+        if new:
+            parts.append(
+                await self.scheduler.aembed_batch(
+                    [batch[i].text for i in new],
+                    [batch[i].n_tokens for i in new],
+                    [batch[i].hash for i in new],
+                ),
             )
+        if reused:
+            rows = [batch[i].row for i in reused]
+            parts.append(self.previous.vectors[rows])
+        vectors = np.empty((len(batch), parts[0].shape[1]), dtype=np.float32)
+        vectors[new + reused] = np.concatenate(parts)
+        self.stats["embed"].add(len(new), start)
+        return batch, vectors
 
-    return strings
+    def write(
+        self,
+        writer: StoreWriter,
+        batch: list[Chunk],
+        vectors: np.ndarray,
+    ) -> None:
+        start = time.perf_counter()
+        writer.append(
+            [chunk.text for chunk in batch],
+            vectors,
+            **{
+                HASH_COLUMN: np.array(
+                    [chunk.hash for chunk in batch],
+                    dtype="S32",
+                ),
+                TOKENS_COLUMN: [chunk.n_tokens for chunk in batch],
+            },
+        )
+        for chunk in batch:
+            if chunk.row is None:
+                self.embedded += 1
+            else:
+                self.reused += 1
+                self.kept[self.previous_rows[chunk.hash]] = True
+        self.stats["write"].add(len(batch), start)
+
+    async def arun(self) -> str:
+        """Run the pipeline, returns the store version with the documents"""
+        if self.is_up_to_date():
+            print(f"Embedding store {self.previous.version} is up to date")
+            return self.previous.version
+
+        started = time.perf_counter()
+        writer = StoreWriter(
+            self.store_path,
+            EMBEDDING_MODEL,
+            columns={HASH_COLUMN: "S32", TOKENS_COLUMN: np.int32},
+        )
+        chunks = self.chunk_documents(self.format_documents())
+        batches = self.batch_chunks(chunks)
+        pending = collections.deque()
+        try:
+            async with self.scheduler:
+                while True:
+                    # read and chunk in a worker thread, so the event loop
+                    # keeps serving the requests in flight
+                    batch = await asyncio.to_thread(next, batches, None)
+                    if batch is None:
+                        break
+                    pending.append(asyncio.create_task(self.embed(batch)))
+                    if len(pending) >= self.scheduler.max_in_flight:
+                        self.write(writer, *await pending.popleft())
+                while pending:
+                    self.write(writer, *await pending.popleft())
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            writer.abort()
+            raise
+
+        build_ann = None
+        if writer.count >= ANN_MIN_ROWS:
+            def build_ann(vectors):
+                return build_ivf_index(
+                    vectors,
+                    nlist=ANN_NLIST,
+                    nprobe=ANN_NPROBE,
+                    recall_k=ANN_RECALL_K,
+                )
+
+        # save document chunks and embeddings
+        version = writer.commit(
+            build_ann=build_ann,
+            manifest={"settings": self.settings, "files": self.files},
+        )
+        # the batches of this run are in the store now
+        self.scheduler.clear_checkpoint()
+        pruned = len(set(self.previous_rows.values())) - int(self.kept.sum())
+        deleted = len(set(self.previous_files) - set(self.files))
+        print(
+            f"Embedding store {version}: {self.changed} changed, "
+            f"{len(self.files) - self.changed} unchanged, {deleted} deleted "
+            f"files; {self.reused} chunks reused, {self.embedded} embedded, "
+            f"{pruned} pruned ({time.perf_counter() - started:.1f}s)",
+        )
+        for stats in self.stats.values():
+            print(f"  {stats}")
+        return version
+
+    def run(self) -> str:
+        return asyncio.run(self.arun())
 
 
-def embed_data():
+def embed_data(
+    directory: str = FOLDERPATH_DOCUMENTS,
+    store_path: str = FOLDERPATH_EMBEDDING_STORE,
+    full: bool = False,
+) -> str:
     """
     Main function to create embbeding data from raw data
-    Embedding file will be saved into FILEPATH_EMBEDDINGS
-    Main flow:
+    Embedding store will be saved into FOLDERPATH_EMBEDDING_STORE
+    Main flow (streamed, see IngestionPipeline):
     1. Read crawl data from a folder
     2. Format raw data into standard data
     3. Embed data in 3 into embedding data via OpenAI API
     4. Save embedding data into file
+    5. Build an ANN index for large stores (ANN_MIN_ROWS chunks or more)
+    Only new or changed chunks are embedded unless full is set.
+    returns:
+        version(str): the store version holding the documents
     """
+    return IngestionPipeline(directory, store_path, full=full).run()
 
-    formatted_strings = format_content(FOLDERPATH_DOCUMENTS, MAX_TOKENS)
-   
-    embeddings = []
-    for batch_start in range(0, len(formatted_strings), BATCH_SIZE):
-        batch_end = batch_start + BATCH_SIZE
-        batch = formatted_strings[batch_start:batch_end]
-        print(f"Batch {batch_start} to {batch_end-1}")
-        response = openai.Embedding.create(model=EMBEDDING_MODEL, input=batch)
-        for i, be in enumerate(response["data"]):
-            assert (
-                i == be["index"]
-            )  # double check embeddings are in same order as input
-        batch_embeddings = [e["embedding"] for e in response["data"]]
-        embeddings.extend(batch_embeddings)
 
-    df = pd.DataFrame({"text": formatted_strings, "embedding": embeddings})
+def watch_documents(
+    directory: str = FOLDERPATH_DOCUMENTS,
+    store_path: str = FOLDERPATH_EMBEDDING_STORE,
+    interval: float = 5.0,
+) -> None:
+    """
+    Poll directory every interval seconds and update the embedding store
+    once added, changed or removed files stop changing.
+    """
+    applied = file_snapshot(directory)
+    last = applied
+    while True:
+        time.sleep(interval)
+        snapshot = file_snapshot(directory)
+        # wait for one quiet interval so half-written files are not embedded
+        if snapshot != applied and snapshot == last:
+            embed_data(directory, store_path)
+            applied = snapshot
+        last = snapshot
+
 
-    # save document chunks and embeddings
-    SAVE_PATH = FILEPATH_EMBEDDINGS
-    df.to_csv(SAVE_PATH, index=False)
+def format_qa(question: str, answer: str, category: str = "") -> str:
+    """Format a QA pair the way it is embedded"""
+    formatted_category = "Category: " + category + "\n" if category else ""
+    return (
+        formatted_category
+        + "Question: " + question + "\n"
+        + "Answer: " + answer + "\n"
+    )
 
 
 class Embedding:
@@ -291,7 +781,9 @@ class Embedding:
     A class is a service (e.g., TT, Teamhub, etc.)
     Usage:
     - Init class (__init__)
-    - Add/update/remove embeddings in the class
+    - Add/update/remove embeddings in the class, one by one or in bulk
+      (the bulk APIs embed all QAs with a few batched requests; from a
+      running event loop use aadd_embeddings / aupdate_embeddings)
     - Save the modifications to file (save_embedding)
 
     Example:
@@ -300,13 +792,21 @@ class Embedding:
         ttl.add_embedding(1, "how are u?", "Good!")
         ttl.update_embedding(1, "how are you?", "Good!", "Typo")
         ttl.remove_embedding(0)
+        ttl.add_embeddings([(2, "hi?", "Hello!"), (3, "bye?", "Bye!", "Chat")])
+        ttl.remove_embeddings([2, 3])
         ttl.save_embedding()
+
+    save_embedding appends the changes to {service}_embedding.log and only
+    rewrites the store (compaction) once the log has grown past
+    QA_LOG_MIN_ENTRIES and QA_LOG_COMPACT_RATIO entries per QA.
     """
 
     def __init__(self, service: str, path: str) -> None:
         """
         Init a class for each service (e.g., TTL, Teamhub, etc.)
-            Embedding file: {path}/{service}.csv
+            Embedding store: {path}/{service}_embedding.store
+            Changes since the store was written: {path}/{service}_embedding.log
+            Legacy embedding file (read only): {path}/{service}_embedding.csv
         args:
             service(str): service's name
             path(str): path to embedding file
@@ -318,12 +818,40 @@ class Embedding:
             path,
             f"{service}_embedding.csv",
         )
-        if os.path.isfile(self.filepath):
-            self.df = pd.read_csv(self.filepath)
-        else:
-            self.df = pd.DataFrame(
-                columns=["index", "formatted_strings", "embeddings"],
+        self.store_path = os.path.join(
+            path,
+            f"{service}_embedding.store",
+        )
+        self.log_path = os.path.join(
+            path,
+            f"{service}_embedding.log",
+        )
+        # QA id -> row; removed rows are None until the next compaction
+        self.rows = {}
+        self.ids = []
+        self.texts = []
+        self.vectors = []
+        self.pending = []  # log entries not saved yet
+        self.log_entries = 0
+
+        if store_exists(self.store_path):
+            store = EmbeddingStore(self.store_path)
+            self._load_rows(
+                store.column("index").tolist(),
+                list(store.texts),
+                np.array(store.vectors),
+            )
+        elif os.path.isfile(self.filepath):
+            df = pd.read_csv(self.filepath)
+            self._load_rows(
+                df["index"].tolist(),
+                df["formatted_strings"].tolist(),
+                [
+                    np.array(ast.literal_eval(e), dtype=np.float32)
+                    for e in df["embeddings"]
+                ],
             )
+        self._replay_log()
 
         self.question = ""
         self.answer = ""
@@ -331,6 +859,68 @@ class Embedding:
         self.formatted_qa = ""
         self.embedding = []
 
+    def _load_rows(self, ids: list, texts: list, vectors) -> None:
+        for index, text, vector in zip(ids, texts, vectors):
+            self._put(int(index), text, vector)
+
+    def _put(self, index: int, text: str, vector) -> None:
+        row = self.rows.get(index)
+        if row is None:
+            self.rows[index] = len(self.ids)
+            self.ids.append(index)
+            self.texts.append(text)
+            self.vectors.append(vector)
+        else:
+            self.texts[row] = text
+            self.vectors[row] = vector
+
+    def _delete(self, index: int) -> None:
+        row = self.rows.pop(index)
+        self.ids[row] = self.texts[row] = self.vectors[row] = None
+
+    def _replay_log(self) -> None:
+        """Apply the changes saved since the store was written"""
+        if not os.path.isfile(self.log_path):
+            return
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # an entry cut short by a crash
+                    continue
+                self.log_entries += 1
+                if entry["op"] == "put":
+                    vector = np.frombuffer(
+                        base64.b64decode(entry["embedding"]),
+                        dtype=np.float32,
+                    )
+                    self._put(entry["index"], entry["text"], vector)
+                elif entry["index"] in self.rows:
+                    self._delete(entry["index"])
+
+    def _live_rows(self) -> list[int]:
+        return [row for row, index in enumerate(self.ids) if index is not None]
+
+    @property
+    def df(self) -> pd.DataFrame:
+        """The QAs as a DataFrame (index, formatted_strings, embeddings)"""
+        live = self._live_rows()
+        return pd.DataFrame(
+            {
+                "index": [self.ids[row] for row in live],
+                "formatted_strings": [self.texts[row] for row in live],
+                "embeddings": [self.vectors[row].tolist() for row in live],
+            },
+            columns=["index", "formatted_strings", "embeddings"],
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.rows
+
     def format_input(
         self,
         question: str,
@@ -365,67 +955,126 @@ class Embedding:
 
         # batch_embeddings = [e["embedding"] for e in response["data"]]
         # embeddings.extend(batch_embeddings)
-        print(response["data"][0]["embedding"])
-        self.embedding = str(response["data"][0]["embedding"])
+        self.embedding = response["data"][0]["embedding"]
 
-    def add_embedding(
-        self,
-        index: int,
-        question: str,
-        answer: str,
-        category: str = "",
-    ) -> None:
-        if index in list(self.df["index"]):
+    def _embed_qas(self, qas: Iterable[Sequence]) -> None:
+        """Embed (index, question, answer[, category]) QAs and store them"""
+        qas = {int(qa[0]): format_qa(*qa[1:]) for qa in qas}
+        if qas:
+            self._put_qas(qas, create_embeddings(list(qas.values())))
+
+    async def _aembed_qas(self, qas: Iterable[Sequence]) -> None:
+        """_embed_qas, from a running event loop"""
+        qas = {int(qa[0]): format_qa(*qa[1:]) for qa in qas}
+        if qas:
+            self._put_qas(qas, await acreate_embeddings(list(qas.values())))
+
+    def _put_qas(self, qas: dict[int, str], vectors) -> None:
+        """Store embedded QAs (index -> formatted text) as pending puts"""
+        for index, text, vector in zip(qas, qas.values(), vectors):
+            self._put(index, text, vector)
+            self.pending.append(
+                {
+                    "op": "put",
+                    "index": index,
+                    "text": text,
+                    "embedding": base64.b64encode(vector.tobytes()).decode(),
+                },
+            )
+
+    def _warn_existing(self, qas: list) -> None:
+        existing = [qa[0] for qa in qas if qa[0] in self.rows]
+        if existing:
             msg = (
-                f"'index: {index}' is avalable. "
-                "Switch to 'update_embedding()' automatically."
+                f"'index: {existing}' is avalable. "
+                "Switch to 'update_embeddings()' automatically."
             )
             warnings.warn(msg)
-            self.update_embedding(index, question, answer, category)
-            return
 
-        self.format_input(question, answer, category)
-        self.get_embedding()
+    def _warn_missing(self, qas: list) -> None:
+        missing = [qa[0] for qa in qas if qa[0] not in self.rows]
+        if missing:
+            msg = (
+                f"'index: {missing}' is not avalable. "
+                "Switch to 'add_embeddings()' automatically"
+            )
+            warnings.warn(msg)
 
-        if len(self.embedding) > 0:
-            dict = {
-                "index": index,
-                "formatted_strings": self.formatted_qa,
-                "embeddings": self.embedding,
-            }
-            self.df = pd.concat(
-                [
-                    self.df,
-                    pd.DataFrame([dict]),
-                ],
-                ignore_index=True,
+    def add_embeddings(self, qas: Iterable[Sequence]) -> None:
+        """
+        Add QAs, embedded with batched requests. For scripts; from a
+        running event loop (e.g. a FastAPI handler) await aadd_embeddings.
+        args:
+            qas: (index, question, answer) or
+                (index, question, answer, category) tuples
+        """
+        qas = list(qas)
+        self._warn_existing(qas)
+        self._embed_qas(qas)
+
+    async def aadd_embeddings(self, qas: Iterable[Sequence]) -> None:
+        """add_embeddings, from a running event loop"""
+        qas = list(qas)
+        self._warn_existing(qas)
+        await self._aembed_qas(qas)
+
+    def update_embeddings(self, qas: Iterable[Sequence]) -> None:
+        """
+        Update QAs based on index, embedded with batched requests. For
+        scripts; from a running event loop await aupdate_embeddings.
+        args:
+            qas: (index, question, answer) or
+                (index, question, answer, category) tuples
+        """
+        qas = list(qas)
+        self._warn_missing(qas)
+        self._embed_qas(qas)
+
+    async def aupdate_embeddings(self, qas: Iterable[Sequence]) -> None:
+        """update_embeddings, from a running event loop"""
+        qas = list(qas)
+        self._warn_missing(qas)
+        await self._aembed_qas(qas)
+
+    def remove_embeddings(self, indexes: Iterable[int]) -> None:
+        """
+        Remove QAs based on index
+        args:
+            indexes: indexes of the QAs
+        """
+        missing = []
+        for index in indexes:
+            if index not in self.rows:
+                missing.append(index)
+                continue
+            self._delete(index)
+            self.pending.append({"op": "del", "index": index})
+        if missing:
+            msg = (
+                f"'index: {missing}' is not avalable. "
+                "Nothing will be removed."
             )
-            self.reset_values()
-        else:
-            msg = f"'Couldn't receive any embedding for 'index: {index}'."
             warnings.warn(msg)
 
+    def add_embedding(
+        self,
+        index: int,
+        question: str,
+        answer: str,
+        category: str = "",
+    ) -> None:
+        self.add_embeddings([(index, question, answer, category)])
+
     def remove_embedding(
         self,
         index: int,
-        # question:str="",
-        # answer:str = "",
-        # category:str="",
     ) -> None:
         """
-        Update an embedding based on index
+        Remove an embedding based on index
         args:
             index(int): index of the QA
         """
-        if index not in list(self.df["index"]):
-            msg = (
-                f"'index: {index}' is not avalable. "
-                "Nothing will be removed."
-            )
-            warnings.warn(msg)
-            return
-
-        self.df = self.df[self.df["index"] != index]
+        self.remove_embeddings([index])
 
     def update_embedding(
         self,
@@ -442,36 +1091,47 @@ class Embedding:
             answer(str): answer string
             category(str): category string
         """
-        if index not in list(self.df["index"]):
-            msg = (
-                f"'index: {index}' is not avalable. "
-                "Switch to 'add_embedding()' automatically"
-            )
-            warnings.warn(msg)
-            self.add_embedding(index, question, answer, category)
-            return
-
-        self.format_input(question, answer, category)
-        self.get_embedding()
-
-        if len(self.embedding) > 0:
-            self.df.loc[
-                self.df["index"] == index,
-                ["formatted_strings", "embeddings"],
-            ] = [
-                self.formatted_qa,
-                self.embedding,
-            ]
-            self.reset_values()
-        else:
-            msg = f"'Couldn't receive any embedding for 'index: {index}'."
-            warnings.warn(msg)
+        self.update_embeddings([(index, question, answer, category)])
 
     def save_embedding(self) -> None:
         """
-        Save document chunks and embeddings
+        Save the changes: append them to the log, and compact the log into
+        a new store version once it is large enough
         """
-        self.df.to_csv(self.filepath, index=False)
+        if self.pending:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                for entry in self.pending:
+                    f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.log_entries += len(self.pending)
+            self.pending = []
+        if self.log_entries >= max(
+            QA_LOG_MIN_ENTRIES,
+            QA_LOG_COMPACT_RATIO * len(self.rows),
+        ) or not store_exists(self.store_path):
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Write the current QAs as a new store version and clear the log
+        """
+        live = self._live_rows()
+        self.ids = [self.ids[row] for row in live]
+        self.texts = [self.texts[row] for row in live]
+        self.vectors = [self.vectors[row] for row in live]
+        self.rows = {index: row for row, index in enumerate(self.ids)}
+        write_embedding_store(
+            self.store_path,
+            self.texts,
+            self.vectors if self.vectors else np.empty((0, 0)),
+            model=self.model,
+            columns={"index": np.array(self.ids, dtype=np.int64)},
+        )
+        # the store has every logged change now (replaying it is harmless)
+        if os.path.isfile(self.log_path):
+            os.remove(self.log_path)
+        self.log_entries = 0
 
     def reset_values(self) -> None:
         """
@@ -483,4 +1143,36 @@ class Embedding:
 
 
 if __name__ == "__main__":
-    embed_data()
+    parser = argparse.ArgumentParser(
+        description="Embed FOLDERPATH_DOCUMENTS into the embedding store",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="re-embed every chunk instead of only new/changed ones",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and apply document changes as they happen",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=5.0,
+        help="seconds between two checks of the documents in --watch mode",
+    )
+    parser.add_argument(
+        "--api-base",
+        help="OpenAI API URL, e.g. a local fake_openai.py server",
+    )
+    args = parser.parse_args()
+
+    if args.api_base:
+        openai.api_base = args.api_base
+    embed_data(full=args.full)
+    if args.watch:
+        try:
+            watch_documents(interval=args.interval)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,355 @@
+"""
+Concurrent, rate-limited embedding of many chunks.
+
+Chunks are packed into batches of at most BATCH_SIZE chunks and
+EMBEDDING_BATCH_TOKENS tokens. Up to EMBEDDING_MAX_IN_FLIGHT batches are
+requested at once, within the EMBEDDING_RPM / EMBEDDING_TPM budgets, and a
+failed request is retried with exponential backoff.
+
+Every finished batch is saved to the checkpoint folder, keyed by the
+content hashes of its chunks, so a run that is interrupted (or fails after
+its retries) resumes from the saved batches instead of starting over. Only
+their hashes are kept in memory; the vectors of a saved batch are read
+when a batch that contains its chunks is embedded again.
+
+Usage:
+    scheduler = EmbeddingScheduler(checkpoint_path="Teamhub.checkpoint")
+    vectors = scheduler.embed(strings)  # (len(strings), dim) float32
+    scheduler.clear_checkpoint()  # once the vectors are saved elsewhere
+
+or batch by batch, e.g. from a streaming pipeline:
+    async with scheduler:
+        vectors = await scheduler.aembed_batch(batch)
+
+Run against a local fake endpoint (see fake_openai.py) with
+EmbeddingScheduler(api_base="http://127.0.0.1:8808/v1").
+"""
+import asyncio
+import collections
+import os
+import random
+import shutil
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+import openai
+from ai_configs import (
+    BATCH_SIZE,
+    EMBEDDING_BATCH_TOKENS,
+    EMBEDDING_MAX_IN_FLIGHT,
+    EMBEDDING_MAX_RETRIES,
+    EMBEDDING_MODEL,
+    EMBEDDING_RPM,
+    EMBEDDING_TPM,
+)
+from embedding_store import chunk_hash
+from openai_pool import OpenAIPool
+from tokens import count_tokens
+
+# errors worth another try, anything else fails the run right away
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    asyncio.TimeoutError,
+)
+BACKOFF_BASE = 1.0  # seconds before the first retry
+BACKOFF_MAX = 60.0  # cap of the (doubling) backoff
+
+
+class RateLimiter:
+    """Requests and tokens in a sliding one-minute window"""
+
+    WINDOW = 60.0
+
+    def __init__(
+        self,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+    ) -> None:
+        """
+        args:
+            rpm(int): requests per minute, None = no limit
+            tpm(int): tokens per minute, None = no limit
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self._events = collections.deque()  # (time, tokens)
+        self._tokens = 0
+        self._lock = asyncio.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._events and self._events[0][0] <= now - self.WINDOW:
+            _, tokens = self._events.popleft()
+            self._tokens -= tokens
+
+    def _fits(self, tokens: int) -> bool:
+        if not self._events:
+            # a request larger than the budget still goes out on its own
+            return True
+        if self.rpm is not None and len(self._events) >= self.rpm:
+            return False
+        if self.tpm is not None and self._tokens + tokens > self.tpm:
+            return False
+        return True
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until a request of `tokens` tokens fits in both budgets"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                if self._fits(tokens):
+                    self._events.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                await asyncio.sleep(self._events[0][0] + self.WINDOW - now)
+
+
+def make_batches(
+    token_counts,
+    max_size: int = BATCH_SIZE,
+    max_tokens: int = EMBEDDING_BATCH_TOKENS,
+) -> list[range]:
+    """
+    Split consecutive chunks into batches of at most max_size chunks and
+    max_tokens tokens (a single larger chunk gets a batch of its own).
+    """
+    batches = []
+    start = tokens = 0
+    for i, n in enumerate(token_counts):
+        if i > start and (i - start >= max_size or tokens + n > max_tokens):
+            batches.append(range(start, i))
+            start, tokens = i, 0
+        tokens += int(n)
+    if start < len(token_counts):
+        batches.append(range(start, len(token_counts)))
+    return batches
+
+
+class EmbeddingScheduler:
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        max_batch_size: int = BATCH_SIZE,
+        max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+        max_in_flight: int = EMBEDDING_MAX_IN_FLIGHT,
+        rpm: Optional[int] = EMBEDDING_RPM,
+        tpm: Optional[int] = EMBEDDING_TPM,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        checkpoint_path: Optional[str] = None,
+        api_base: Optional[str] = None,
+    ) -> None:
+        """
+        args:
+            model(str): embedding model
+            max_batch_size(int): chunks per request
+            max_batch_tokens(int): tokens per request
+            max_in_flight(int): requests sent concurrently
+            rpm(int), tpm(int): requests/tokens per minute, None = no limit
+            max_retries(int): retries of a failed request
+            checkpoint_path(str): folder of finished batches, None = off
+            api_base(str): OpenAI API URL, None = openai.api_base
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_in_flight = max_in_flight
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.checkpoint_path = checkpoint_path
+        self.api_base = api_base
+        self.stats = collections.Counter()
+        self._limiter: Optional[RateLimiter] = None
+        self._pool: Optional[OpenAIPool] = None
+        self._done = {}
+
+    def load_checkpoint(self) -> dict[str, tuple[str, int]]:
+        """
+        Return chunk hash -> (batch file, row) of the saved batches. Only
+        the hashes are read: the vectors stay on disk until read_checkpoint
+        reads those of a batch being embedded.
+        """
+        saved = {}
+        if not self.checkpoint_path or not os.path.isdir(self.checkpoint_path):
+            return saved
+        for name in sorted(os.listdir(self.checkpoint_path)):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.checkpoint_path, name)
+            with np.load(path) as batch:
+                for row, h in enumerate(batch["hashes"]):
+                    saved[h.decode()] = (path, row)
+        return saved
+
+    def read_checkpoint(self, hashes: list[str]) -> dict[str, np.ndarray]:
+        """Return chunk hash -> saved vector, reading every file once"""
+        rows = collections.defaultdict(list)
+        for h in hashes:
+            path, row = self._done[h]
+            rows[path].append((h, row))
+        vectors = {}
+        for path, items in rows.items():
+            with np.load(path) as batch:
+                saved = batch["vectors"]
+            for h, row in items:
+                vectors[h] = saved[row]
+        return vectors
+
+    def save_batch(self, hashes: list[str], vectors: np.ndarray) -> None:
+        """Save a finished batch to the checkpoint folder"""
+        if not self.checkpoint_path:
+            return
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        name = uuid.uuid4().hex
+        tmp_path = os.path.join(self.checkpoint_path, name + ".npz.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                hashes=np.array(hashes, dtype="S32"),
+                vectors=vectors,
+            )
+        # a batch file is either complete or absent
+        os.replace(tmp_path, os.path.join(self.checkpoint_path, name + ".npz"))
+
+    def clear_checkpoint(self) -> None:
+        if self.checkpoint_path:
+            shutil.rmtree(self.checkpoint_path, ignore_errors=True)
+
+    async def __aenter__(self) -> "EmbeddingScheduler":
+        self._limiter = RateLimiter(self.rpm, self.tpm)
+        self._pool = OpenAIPool(
+            max_connections=self.max_in_flight,
+            max_concurrency=self.max_in_flight,
+        )
+        self._done = self.load_checkpoint()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self._pool.close()
+        self._done = {}
+
+    async def _request(self, texts: list[str], tokens: int) -> np.ndarray:
+        """One embedding request, retried with exponential backoff"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._pool.slot():
+                    await self._limiter.acquire(tokens)
+                    response = await openai.Embedding.acreate(
+                        model=self.model,
+                        input=texts,
+                        api_base=self.api_base,
+                    )
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats["retries"] += 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+                # jitter, so concurrent batches do not retry in lockstep
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Retrying in {delay:.1f}s after {e!r}")
+                await asyncio.sleep(delay)
+                continue
+            data = sorted(response["data"], key=lambda e: e["index"])
+            # double check every input got its embedding
+            assert [e["index"] for e in data] == list(range(len(texts)))
+            return np.array([e["embedding"] for e in data], dtype=np.float32)
+
+    async def aembed_batch(
+        self,
+        texts: list[str],
+        token_counts: Optional[list[int]] = None,
+        hashes: Optional[list[str]] = None,
+    ) -> np.ndarray:
+        """
+        Embed one batch with (at most) one request, inside `async with`.
+        Chunks found in the checkpoint are not requested again.
+        args:
+            texts(list): at most max_batch_size chunks
+            token_counts(list): tokens of every chunk, counted if None
+            hashes(list): chunk_hash of every chunk, computed if None
+        returns:
+            (len(texts), dim) float32 matrix
+        """
+        if hashes is None:
+            hashes = [chunk_hash(text, self.model) for text in texts]
+        todo = [i for i, h in enumerate(hashes) if h not in self._done]
+        self.stats["resumed"] += len(texts) - len(todo)
+        vectors = {}
+        if len(todo) < len(hashes):
+            vectors = await asyncio.to_thread(
+                self.read_checkpoint,
+                [h for h in hashes if h in self._done],
+            )
+        if todo:
+            if token_counts is None:
+                counts = count_tokens([texts[i] for i in todo], self.model)
+            else:
+                counts = [token_counts[i] for i in todo]
+            tokens = int(sum(counts))
+            todo_hashes = [hashes[i] for i in todo]
+            embedded = await self._request([texts[i] for i in todo], tokens)
+            self.save_batch(todo_hashes, embedded)
+            vectors.update(zip(todo_hashes, embedded))
+            self.stats["requests"] += 1
+            self.stats["tokens"] += tokens
+        return np.array([vectors[h] for h in hashes], dtype=np.float32)
+
+    async def aembed(self, strings: list[str]) -> np.ndarray:
+        """Embed strings, returns a (len(strings), dim) float32 matrix"""
+        if not strings:
+            return np.empty((0, 0), dtype=np.float32)
+        token_counts = count_tokens(strings, self.model)
+        batches = make_batches(
+            token_counts,
+            self.max_batch_size,
+            self.max_batch_tokens,
+        )
+        results = [None] * len(batches)
+
+        async def run(number: int, batch: range) -> None:
+            results[number] = await self.aembed_batch(
+                strings[batch.start:batch.stop],
+                token_counts[batch.start:batch.stop].tolist(),
+            )
+            print(
+                f"Batch {number + 1}/{len(batches)}: {len(batch)} chunks, "
+                f"{token_counts[batch.start:batch.stop].sum()} tokens",
+            )
+
+        async with self:
+            # the pool limits the requests in flight; the first error
+            # cancels the other batches (finished ones are checkpointed)
+            tasks = [
+                asyncio.ensure_future(run(number, batch))
+                for number, batch in enumerate(batches)
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException as e:
+                for task in tasks:
+                    task.cancel()
+                outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+                # the first error is raised, the others are reported here
+                for outcome in outcomes:
+                    if isinstance(outcome, Exception) and outcome is not e:
+                        print(f"Another batch failed too: {outcome!r}")
+                raise
+        return np.concatenate(results)
+
+    def embed(self, strings: list[str]) -> np.ndarray:
+        """Synchronous aembed, for scripts (not from a running loop)"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.aembed(strings))
+        raise RuntimeError(
+            "EmbeddingScheduler.embed() called from a running event loop, "
+            "await aembed() instead",
+        )
@@ -0,0 +1,543 @@
+"""
+Binary, memory-mappable embedding store.
+
+Layout of a store folder (e.g. models/Teamhub/embeddings/Teamhub.store):
+    CURRENT             name of the active version folder
+    <version>/
+        meta.json       count, dim, embedding model, extra column names,
+                        tiktoken encoding of n_tokens
+        vectors.npy     (count, dim) unit-normalized float32 matrix
+        texts.bin       utf-8 chunk texts, concatenated
+        offsets.npy     (count + 1) int64 byte offsets into texts.bin
+        <column>.npy    optional per-chunk columns (e.g. QA index,
+                        n_tokens: token count of every chunk)
+        manifest.json   optional source files -> chunk hashes of the version
+                        (see embedding.embed_data)
+        ivf.npz         optional ANN index (see ann_index.py)
+        ann_report.json recall@k / latency of the ANN index per nprobe
+
+vectors.npy is memory-mapped, and a chunk text is only decoded when it is
+accessed, so opening a store costs the same for 10 or 100k chunks.
+A new version is written next to the old one and published by atomically
+replacing CURRENT, so readers never see a half-written store.
+
+Convert existing CSV embedding files:
+    python embedding_store.py models/Teamhub/embeddings/Teamhub.csv
+    python embedding_store.py --service Teamhub
+"""
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import os
+import shutil
+import struct
+import time
+import uuid
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from ai_configs import ANN_ENABLED, ANN_NPROBE, EMBEDDING_MODEL, MODEL_NAME
+from ann_index import IVFIndex
+from retrieval import EmbeddingIndex, normalize_rows
+from tokens import count_tokens, get_encoding
+
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT"
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.npy"
+TEXTS_FILE = "texts.bin"
+OFFSETS_FILE = "offsets.npy"
+ANN_FILE = "ivf.npz"
+ANN_REPORT_FILE = "ann_report.json"
+MANIFEST_FILE = "manifest.json"
+# per-chunk token counts, tokenized with meta["token_encoding"]
+TOKENS_COLUMN = "n_tokens"
+# per-chunk content hashes (see chunk_hash)
+HASH_COLUMN = "content_hash"
+# number of old versions kept for readers that still hold them open
+KEEP_VERSIONS = 2
+
+
+class StoreTexts(Sequence):
+    """Read-only sequence of chunk texts, decoded lazily from texts.bin"""
+
+    def __init__(self, texts_path: str, offsets_path: str) -> None:
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        if os.path.getsize(texts_path) > 0:
+            self.data = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.empty(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"text index {i} out of range")
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.data[start:end].tobytes().decode("utf-8")
+
+
+class EmbeddingStore:
+    """
+    An opened (read-only) version of an embedding store.
+    Usage:
+        store = EmbeddingStore("models/Teamhub/embeddings/Teamhub.store")
+        index = store.to_index()
+        store.texts[0], store.column("index")
+    """
+
+    def __init__(self, path: str, version: Optional[str] = None) -> None:
+        """
+        args:
+            path(str): store folder
+            version(str): version folder to open, defaults to CURRENT
+        """
+        self.path = path
+        self.version = version or current_version(path)
+        if self.version is None:
+            raise FileNotFoundError(f"No embedding store found in {path}")
+        self.folder = os.path.join(path, self.version)
+        with open(os.path.join(self.folder, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported store format: {self.meta.get('format_version')}",
+            )
+        self.vectors = np.load(
+            os.path.join(self.folder, VECTORS_FILE),
+            mmap_mode="r",
+        )
+        self.texts = StoreTexts(
+            os.path.join(self.folder, TEXTS_FILE),
+            os.path.join(self.folder, OFFSETS_FILE),
+        )
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def manifest(self) -> dict:
+        """Return the version's manifest.json, {} if it has none"""
+        filepath = os.path.join(self.folder, MANIFEST_FILE)
+        if not os.path.isfile(filepath):
+            return {}
+        with open(filepath, encoding="utf-8") as f:
+            return json.load(f)
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.meta.get("columns", []))
+
+    def column(self, name: str) -> np.ndarray:
+        """Return an extra per-chunk column (memory-mapped)"""
+        if name not in self.columns:
+            raise KeyError(f"Column '{name}' not in store {self.folder}")
+        return np.load(os.path.join(self.folder, f"{name}.npy"), mmap_mode="r")
+
+    @property
+    def has_ann(self) -> bool:
+        return os.path.isfile(os.path.join(self.folder, ANN_FILE))
+
+    def load_ann(self, nprobe: Optional[int] = None) -> Optional[IVFIndex]:
+        """Return the store's ANN index, None if it was not built"""
+        if not self.has_ann:
+            return None
+        return IVFIndex.load(os.path.join(self.folder, ANN_FILE), nprobe)
+
+    def to_index(self, use_ann: bool = ANN_ENABLED) -> EmbeddingIndex:
+        """
+        Return an EmbeddingIndex backed by the memory-mapped vectors,
+        using the ANN index if there is one and use_ann is set.
+        """
+        ann = self.load_ann(ANN_NPROBE) if use_ann else None
+        token_counts = None
+        if TOKENS_COLUMN in self.columns:
+            token_counts = self.column(TOKENS_COLUMN)
+        return EmbeddingIndex(
+            self.vectors,
+            self.texts,
+            normalized=True,
+            ann=ann,
+            version=self.version,
+            token_counts=token_counts,
+            token_encoding=self.meta.get("token_encoding"),
+        )
+
+
+def current_version(path: str) -> Optional[str]:
+    """Return the active version of a store, None if there is none"""
+    try:
+        with open(os.path.join(path, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def store_exists(path: str) -> bool:
+    return current_version(path) is not None
+
+
+class NpyAppender:
+    """
+    Writes a .npy file block by block, without holding the array in memory.
+    The header (with the final row count) is written by close().
+    """
+
+    # magic string, version, header length and padded header dict
+    HEADER_SIZE = 128
+
+    def __init__(self, filepath: str, dtype, row_shape: tuple = ()) -> None:
+        self.filepath = filepath
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.count = 0
+        self._file = open(filepath, "wb")
+        self._file.write(b"\0" * self.HEADER_SIZE)
+
+    def append(self, rows) -> None:
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError(
+                f"Got rows of shape {rows.shape[1:]} for {self.row_shape}",
+            )
+        self._file.write(rows.tobytes())
+        self.count += rows.shape[0]
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (self.count,) + self.row_shape,
+            },
+        )
+        prefix = np.lib.format.MAGIC_PREFIX + bytes([1, 0])
+        header = header.ljust(self.HEADER_SIZE - len(prefix) - 3) + "\n"
+        self._file.seek(0)
+        self._file.write(prefix + struct.pack("<H", len(header)))
+        self._file.write(header.encode("latin1"))
+        self._file.close()
+
+
+class StoreWriter:
+    """
+    Appends chunks to a new store version, block by block, so memory stays
+    flat however many chunks are written. Readers keep seeing the previous
+    version until commit() publishes the new one.
+    Usage:
+        writer = StoreWriter(path, model, columns={"index": np.int64})
+        writer.append(texts, embeddings, index=[0, 1])
+        version = writer.commit()
+    """
+
+    def __init__(
+        self,
+        path: str,
+        model: str,
+        columns: Optional[dict] = None,
+        token_model: Optional[str] = MODEL_NAME,
+    ) -> None:
+        """
+        args:
+            path(str): store folder
+            model(str): embedding model that produces the vectors
+            columns(dict): dtype of every extra per-chunk column, by name
+            token_model(str): chat model whose encoding counts the tokens of
+                every chunk (TOKENS_COLUMN), None = no token counts
+        """
+        self.path = path
+        self.model = model
+        self.token_model = token_model
+        self.column_dtypes = dict(columns or {})
+        if token_model is not None:
+            self.column_dtypes.setdefault(TOKENS_COLUMN, np.int32)
+        self.version = (
+            time.strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        )
+        self.folder = os.path.join(path, self.version)
+        os.makedirs(self.folder)
+        self.count = 0
+        self._vectors = None  # created with the dimension of the first rows
+        self._texts = open(os.path.join(self.folder, TEXTS_FILE), "wb")
+        self._offsets = NpyAppender(
+            os.path.join(self.folder, OFFSETS_FILE),
+            np.int64,
+        )
+        self._offsets.append([0])
+        self._offset = 0
+        self._columns = {
+            name: NpyAppender(os.path.join(self.folder, f"{name}.npy"), dtype)
+            for name, dtype in self.column_dtypes.items()
+        }
+
+    def append(self, texts: Sequence[str], embeddings, **columns) -> None:
+        """
+        Append chunks: texts[i] belongs to embeddings[i], and to
+        columns[name][i] of every column given at init (token counts are
+        computed if not given)
+        """
+        if not len(texts):
+            return
+        vectors = normalize_rows(embeddings)
+        if vectors.shape[0] != len(texts):
+            raise ValueError(
+                f"Got {len(texts)} texts for {vectors.shape[0]} embeddings",
+            )
+        if self._vectors is None:
+            self._vectors = NpyAppender(
+                os.path.join(self.folder, VECTORS_FILE),
+                np.float32,
+                vectors.shape[1:],
+            )
+        if TOKENS_COLUMN in self._columns and TOKENS_COLUMN not in columns:
+            columns[TOKENS_COLUMN] = count_tokens(texts, self.token_model)
+        for name in self._columns:
+            if name not in columns:
+                raise ValueError(f"Missing column '{name}'")
+            if len(columns[name]) != len(texts):
+                raise ValueError(
+                    f"Column '{name}' has {len(columns[name])} rows",
+                )
+
+        self._vectors.append(vectors)
+        offsets = np.empty(len(texts), dtype=np.int64)
+        for i, text in enumerate(texts):
+            data = text.encode("utf-8")
+            self._texts.write(data)
+            self._offset += len(data)
+            offsets[i] = self._offset
+        self._offsets.append(offsets)
+        for name, appender in self._columns.items():
+            appender.append(columns[name])
+        self.count += len(texts)
+
+    def _close(self) -> None:
+        if self._vectors is None:
+            self._vectors = NpyAppender(
+                os.path.join(self.folder, VECTORS_FILE),
+                np.float32,
+                (0,),
+            )
+        self._vectors.close()
+        self._offsets.close()
+        for appender in self._columns.values():
+            appender.close()
+        self._texts.close()
+
+    def commit(self, build_ann=None, manifest: Optional[dict] = None) -> str:
+        """
+        Finish the version and make it the current one.
+        args:
+            build_ann: optional callable(vectors) -> (IVFIndex, report),
+                run on the normalized vectors before the version is published
+            manifest(dict): optional JSON data saved as manifest.json
+        returns:
+            version(str): name of the written version
+        """
+        self._close()
+        folder = self.folder
+        if build_ann is not None and self.count:
+            vectors = np.load(
+                os.path.join(folder, VECTORS_FILE),
+                mmap_mode="r",
+            )
+            ann, report = build_ann(vectors)
+            ann.save(os.path.join(folder, ANN_FILE))
+            with open(
+                os.path.join(folder, ANN_REPORT_FILE),
+                "w",
+                encoding="utf-8",
+            ) as f:
+                json.dump(report, f, indent=2)
+        if manifest is not None:
+            with open(
+                os.path.join(folder, MANIFEST_FILE),
+                "w",
+                encoding="utf-8",
+            ) as f:
+                json.dump(manifest, f)
+
+        token_encoding = None
+        if self.token_model is not None:
+            token_encoding = get_encoding(self.token_model).name
+        meta = {
+            "format_version": FORMAT_VERSION,
+            "version": self.version,
+            "count": self.count,
+            "dim": int(self._vectors.row_shape[0]),
+            "model": self.model,
+            "columns": list(self.column_dtypes),
+            "token_encoding": token_encoding,
+            "created_at": time.time(),
+        }
+        with open(os.path.join(folder, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+
+        # publish the new version atomically
+        tmp_current = os.path.join(self.path, CURRENT_FILE + ".tmp")
+        with open(tmp_current, "w", encoding="utf-8") as f:
+            f.write(self.version)
+        os.replace(tmp_current, os.path.join(self.path, CURRENT_FILE))
+
+        prune_versions(self.path)
+        return self.version
+
+    def abort(self) -> None:
+        """Drop the unpublished version"""
+        self._close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def write_embedding_store(
+    path: str,
+    texts: Sequence[str],
+    embeddings,
+    model: str,
+    columns: Optional[dict] = None,
+    build_ann=None,
+    token_model: Optional[str] = MODEL_NAME,
+    manifest: Optional[dict] = None,
+) -> str:
+    """
+    Write a new version of a store and make it the current one.
+    args:
+        path(str): store folder
+        texts(list): chunk texts
+        embeddings: (n, dim) embeddings, texts[i] belongs to embeddings[i]
+        model(str): embedding model that produced the vectors
+        columns(dict): optional extra per-chunk arrays, by column name
+        build_ann: optional callable(vectors) -> (IVFIndex, report),
+            run on the normalized vectors before the version is published
+        token_model(str): chat model whose encoding counts the tokens of
+            every chunk (TOKENS_COLUMN), None = no token counts.
+            Counts already given in columns[TOKENS_COLUMN] are kept.
+        manifest(dict): optional JSON data saved as manifest.json
+    returns:
+        version(str): name of the written version
+    """
+    columns = {
+        name: np.asarray(values) for name, values in (columns or {}).items()
+    }
+    writer = StoreWriter(
+        path,
+        model,
+        columns={name: values.dtype for name, values in columns.items()},
+        token_model=token_model,
+    )
+    try:
+        writer.append(texts, embeddings, **columns)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit(build_ann=build_ann, manifest=manifest)
+
+
+def prune_versions(path: str, keep: int = KEEP_VERSIONS) -> None:
+    """Remove all but the newest `keep` versions (never the current one)"""
+    current = current_version(path)
+    versions = sorted(
+        name
+        for name in os.listdir(path)
+        if os.path.isfile(os.path.join(path, name, META_FILE))
+    )
+    stale = versions[:-keep] if keep > 0 else versions
+    for name in stale:
+        if name != current:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def chunk_hash(text: str, model: str = EMBEDDING_MODEL) -> str:
+    """Content hash of a chunk, the same text embedded by the same model"""
+    data = f"{model}\n{text}".encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def parse_embedding(value: str) -> list[float]:
+    """Parse an embedding saved as a string in CSV"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+def convert_csv(
+    csv_path: str,
+    store_path: Optional[str] = None,
+    model: str = EMBEDDING_MODEL,
+) -> str:
+    """
+    Convert a CSV embedding file into a store.
+    Supports both the embed_data layout (text, embedding) and the
+    Embedding QA layout (index, formatted_strings, embeddings).
+    returns:
+        store_path(str): folder of the written store
+    """
+    store_path = store_path or os.path.splitext(csv_path)[0] + ".store"
+    df = pd.read_csv(csv_path)
+    if {"text", "embedding"}.issubset(df.columns):
+        text_column, embedding_column = "text", "embedding"
+        columns = {}
+    elif {"formatted_strings", "embeddings"}.issubset(df.columns):
+        text_column, embedding_column = "formatted_strings", "embeddings"
+        columns = {"index": df["index"].to_numpy(dtype=np.int64)}
+    else:
+        raise ValueError(f"Unknown embedding CSV layout: {list(df.columns)}")
+
+    embeddings = [parse_embedding(e) for e in df[embedding_column]]
+    write_embedding_store(
+        store_path,
+        df[text_column].astype(str).tolist(),
+        embeddings,
+        model=model,
+        columns=columns,
+    )
+    return store_path
+
+
+def _csv_files(paths: Iterable[str], service: Optional[str]) -> list[str]:
+    files = list(paths)
+    if service:
+        files += sorted(
+            glob.glob(os.path.join("models", service, "embeddings", "*.csv")),
+        )
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert CSV embedding files into binary stores",
+    )
+    parser.add_argument("csv", nargs="*", help="CSV embedding files")
+    parser.add_argument(
+        "--service",
+        help="convert every models/<SERVICE>/embeddings/*.csv",
+    )
+    parser.add_argument(
+        "--output",
+        help="store folder (only with a single CSV file)",
+    )
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    args = parser.parse_args()
+
+    files = _csv_files(args.csv, args.service)
+    if not files:
+        parser.error("no CSV files given")
+    if args.output and len(files) > 1:
+        parser.error("--output needs exactly one CSV file")
+    for file in files:
+        start = time.monotonic()
+        output = convert_csv(file, args.output, model=args.model)
+        print(f"{file} -> {output} ({time.monotonic() - start:.2f}s)")
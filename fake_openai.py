@@ -0,0 +1,246 @@
+"""
+Local stand-in for the OpenAI embeddings and chat completions APIs, for
+tests and benchmarks without an API key or network access.
+
+Vectors and answers are deterministic (seeded by the input text), and
+latency and failures (429 rate limit / 500 server errors) can be injected.
+Chat completions can be streamed (stream=True), one word per chunk.
+
+Run:
+    python fake_openai.py --port 8808 --latency 0.05 --failure-rate 0.1
+then point the client at it:
+    openai.api_base = "http://127.0.0.1:8808/v1"
+or from async code:
+    fake = FakeOpenAI(latency=0.05)
+    api_base = await fake.start()
+    ...
+    await fake.stop()
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import random
+import time
+from typing import Optional
+
+import numpy as np
+from aiohttp import web
+
+
+def fake_embedding(text: str, dim: int) -> np.ndarray:
+    """Deterministic unit-length float32 vector of a text"""
+    seed = int.from_bytes(
+        hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(),
+        "little",
+    )
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+
+def fake_answer(prompt: str, words: int) -> str:
+    """
+    Deterministic answer of `words` words to a prompt, ending with a link
+    in the form clean_response corrects
+    """
+    rng = random.Random(
+        hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).digest(),
+    )
+    vocabulary = prompt.split() or ["answer"]
+    text = " ".join(rng.choice(vocabulary) for _ in range(words))
+    return f"{text} [Doc](https://example.com/help/document/{rng.randrange(1000)})"  # noqa: E501
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        dim: int = 1536,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: int = 0,
+        answer_words: int = 50,
+        chunk_latency: float = 0.0,
+    ) -> None:
+        """
+        args:
+            dim(int): embedding dimension
+            latency(float): seconds added to every request
+            failure_rate(float): fraction of requests that fail
+                (alternately 429 and 500)
+            seed(int): seed of the injected failures
+            answer_words(int): words of a chat completion
+            chunk_latency(float): seconds between streamed chunks
+        """
+        self.dim = dim
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.answer_words = answer_words
+        self.chunk_latency = chunk_latency
+        self.stats = collections.Counter()
+        self._random = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        return app
+
+    async def _inject(self) -> Optional[web.Response]:
+        """Sleep for the latency, return an error response to fail with"""
+        self.stats["requests"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._random.random() >= self.failure_rate:
+            return None
+        self.stats["failures"] += 1
+        if self.stats["failures"] % 2:
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Rate limit reached",
+                        "type": "requests",
+                    },
+                },
+                status=429,
+                headers={"Retry-After": "1"},
+            )
+        return web.json_response(
+            {"error": {"message": "Injected failure", "type": "server_error"}},
+            status=500,
+        )
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        error = await self._inject()
+        if error is not None:
+            return error
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        as_base64 = body.get("encoding_format") == "base64"
+        data = []
+        for i, text in enumerate(inputs):
+            vector = fake_embedding(text, self.dim)
+            if as_base64:
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append(
+                {"object": "embedding", "index": i, "embedding": embedding},
+            )
+        tokens = sum(len(text.split()) for text in inputs)
+        self.stats["inputs"] += len(inputs)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            },
+        )
+
+    async def chat_completions(
+        self,
+        request: web.Request,
+    ) -> web.StreamResponse:
+        body = await request.json()
+        error = await self._inject()
+        if error is not None:
+            return error
+        prompt = "\n".join(m["content"] for m in body["messages"])
+        answer = fake_answer(prompt, self.answer_words)
+        prompt_tokens = len(prompt.split())
+        completion_tokens = len(answer.split())
+        self.stats["completions"] += 1
+        completion = {
+            "id": f"chatcmpl-{self.stats['completions']}",
+            "created": int(time.time()),
+            "model": body.get("model"),
+        }
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    **completion,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": answer,
+                            },
+                            "finish_reason": "stop",
+                        },
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+            )
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"},
+        )
+        await response.prepare(request)
+        words = answer.split(" ")
+        deltas = [{"role": "assistant"}] + [
+            {"content": word if i == 0 else " " + word}
+            for i, word in enumerate(words)
+        ]
+        for i, delta in enumerate(deltas + [{}]):
+            if i and self.chunk_latency:
+                await asyncio.sleep(self.chunk_latency)
+            chunk = {
+                **completion,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": None if delta else "stop",
+                    },
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve in the running event loop, returns the API base URL"""
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--answer-words", type=int, default=50)
+    parser.add_argument("--chunk-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(
+        args.dim,
+        args.latency,
+        args.failure_rate,
+        answer_words=args.answer_words,
+        chunk_latency=args.chunk_latency,
+    )
+    web.run_app(fake.app(), host=args.host, port=args.port)
@@ -0,0 +1,124 @@
+"""
+Background warm-up of the server's heavy components.
+
+Every component can also be created lazily on first use, so requests are
+served (slower) while the warm-up is still running. The warm-up status is
+what the readiness endpoint reports.
+
+A component that fails is retried a few times. Only the required
+components make the server ready: while optional ones (e.g. the accent
+model, without which questions are still answered) are loading or after
+they failed, it reports "degraded" instead.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+PENDING, LOADING, READY, FAILED = "pending", "loading", "ready", "failed"
+MAX_ATTEMPTS = 3  # loads of a failing component
+RETRY_DELAY = 10.0  # seconds before the failed components are retried
+
+
+class Warmup:
+    """
+    Usage:
+        warmup = Warmup(
+            {"embedding_index": get_embedding_data, ...},
+            optional={"accent_model"},
+        )
+        warmup.start()
+        warmup.status()  # {"ready": ..., "degraded": ..., "components": ...}
+    """
+
+    def __init__(
+        self,
+        components: dict[str, Callable[[], object]],
+        optional: set[str] = frozenset(),
+        max_attempts: int = MAX_ATTEMPTS,
+        retry_delay: float = RETRY_DELAY,
+    ) -> None:
+        """
+        args:
+            components(dict): name -> function that loads/warms it,
+                run one after the other in this order
+            optional(set): components the server is ready without
+            max_attempts(int): loads of a failing component
+            retry_delay(float): seconds between rounds of retries
+        """
+        self.components = components
+        self.optional = set(optional)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.states = {name: {"state": PENDING} for name in components}
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Warm the components up in a daemon thread"""
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(
+            target=self.run,
+            name="warmup",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _load(self, name: str, attempt: int) -> bool:
+        """Load one component, returns whether it succeeded"""
+        with self._lock:
+            self.states[name] = {"state": LOADING, "attempts": attempt}
+        start = time.monotonic()
+        try:
+            self.components[name]()
+        except Exception as e:
+            state = {"state": FAILED, "error": repr(e)}
+            logger.exception(
+                "Warm-up of %s failed (attempt %d/%d)",
+                name,
+                attempt,
+                self.max_attempts,
+            )
+        else:
+            state = {"state": READY}
+        state["attempts"] = attempt
+        state["seconds"] = time.monotonic() - start
+        with self._lock:
+            self.states[name] = state
+        logger.info("Warm-up of %s: %s", name, state)
+        return state["state"] == READY
+
+    def run(self) -> None:
+        failed = list(self.components)
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt > 1:
+                time.sleep(self.retry_delay)
+            failed = [name for name in failed if not self._load(name, attempt)]
+            if self.finished_at is None:
+                # the first round, reported even while failures are retried
+                self.finished_at = time.monotonic()
+            if not failed:
+                break
+
+    def status(self) -> dict:
+        with self._lock:
+            components = {name: dict(s) for name, s in self.states.items()}
+        required = [
+            s for name, s in components.items() if name not in self.optional
+        ]
+        optional = [
+            s for name, s in components.items() if name in self.optional
+        ]
+        status = {
+            "ready": all(s["state"] == READY for s in required),
+            # still loading or failed: served without them meanwhile
+            "degraded": any(s["state"] != READY for s in optional),
+            "components": components,
+        }
+        if self.started_at is not None and self.finished_at is not None:
+            status["warmup_seconds"] = self.finished_at - self.started_at
+        return status
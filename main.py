@@ -1,45 +1,674 @@
-from fastapi.responses import JSONResponse
+import time
+_import_started = time.monotonic()
+
+import asyncio
+import json
+import logging
+import secrets
+from contextlib import asynccontextmanager
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from search import *
-from add_accent import add_accent
-from fastapi import FastAPI, status
-from schema import Message
-from ai_configs import ERROR_MESSAGE
+from add_accent import (
+    add_accent,
+    inference_stats,
+    warm_up as warm_up_accent_model,
+)
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, status
+from schema import BatchMessage, Message
+from ai_configs import (
+    ADMIN_TOKEN,
+    CHAT_BATCH_MAX_SIZE,
+    ERROR_MESSAGE,
+    INDEX_RELOAD_INTERVAL,
+    MODEL_NAME,
+    PROFILE_FOLDERPATH,
+    PROFILE_MAX_SECONDS,
+    SERVICE,
+    SPECULATIVE_ACCENT,
+)
+from cache import SingleFlight, normalize_query
+import profiler
+from lifecycle import Warmup
+from metrics import (
+    CONTENT_TYPE,
+    REGISTRY,
+    TTFT_SECONDS,
+    record_request,
+    stage,
+    start_request,
+    track_request,
+)
+from utils import is_unaccented_vietnamese
+
+logger = logging.getLogger(__name__)
+# concurrent identical /chat requests share one answer
+chat_flight = SingleFlight()
+import_seconds = time.monotonic() - _import_started
+
+# heavy components, created in the background after startup
+# (or on first use by a request, whichever comes first)
+warmup = Warmup(
+    {
+        "embedding_index": get_embedding_data,
+        "tiktoken_encoder": lambda: get_encoding(MODEL_NAME),
+        "accent_model": warm_up_accent_model,
+    },
+    # questions are answered without restored accents if it fails
+    optional={"accent_model"},
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup.start()
+    reloader = None
+    if INDEX_RELOAD_INTERVAL:
+        # pick up a re-embedded knowledge base without a restart
+        reloader = asyncio.create_task(
+            watch_embedding_data(INDEX_RELOAD_INTERVAL),
+        )
+    yield
+    if reloader is not None:
+        reloader.cancel()
+    await openai_pool.close()
+
 
 app = FastAPI(
-    "khanhdo",
+    title="khanhdo",
     summary="chatbot base on chatgpt of Khanh Do",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
+
+def require_admin(x_admin_token: str | None = Header(default=None)):
+    """Let a request through only with the ADMIN_TOKEN header"""
+    if ADMIN_TOKEN is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin endpoints are disabled, set ADMIN_TOKEN",
+        )
+    if x_admin_token is None or not secrets.compare_digest(
+        x_admin_token,
+        ADMIN_TOKEN,
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid admin token",
+        )
+
+
+def server_timing(timings: dict) -> str:
+    """Format stage durations (seconds) as a Server-Timing header"""
+    return ", ".join(
+        f"{name};dur={duration * 1000:.1f}"
+        for name, duration in timings.items()
+    )
+
+
+async def speculative_retrieve(
+    text: str,
+    index: EmbeddingIndex,
+    timings: dict,
+) -> tuple:
+    """
+    Retrieve for the raw text and, concurrently, restore its accents and
+    retrieve for the accented text.
+    returns:
+        (query, query embedding, strings, relatednesses, token counts) of
+        the variant whose best article scores higher, or of the raw text
+        if restoring the accents fails
+    """
+
+    async def raw_path():
+        start = time.perf_counter()
+        result = await aretrieve(text, index)
+        timings["raw_retrieval"] = time.perf_counter() - start
+        return (text,) + result
+
+    async def accented_path():
+        with stage("accent"):
+            # the Keras model is CPU bound, keep it off the event loop
+            accented = await asyncio.to_thread(add_accent, text)
+        start = time.perf_counter()
+        result = await aretrieve(accented, index)
+        timings["accented_retrieval"] = time.perf_counter() - start
+        return (accented,) + result
+
+    raw, accented = await asyncio.gather(
+        raw_path(),
+        accented_path(),
+        return_exceptions=True,
+    )
+    if isinstance(raw, BaseException):
+        raise raw
+    if isinstance(accented, BaseException):
+        # answer from the raw text rather than fail the request
+        logger.warning("Accented retrieval failed: %r", accented)
+        return raw
+    candidates = [raw, accented]
+    return max(
+        candidates,
+        key=lambda candidate: candidate[3][0] if candidate[3] else -1.0,
+    )
+
+
+async def speculative_response(
+    text: str,
+    index: EmbeddingIndex,
+    timings: dict,
+) -> str:
+    """
+    Answer the raw or the accented text, whichever retrieves the better
+    scoring articles (see speculative_retrieve), with a single chat
+    completion.
+    """
+    query, query_embedding, strings, _, token_counts = (
+        await speculative_retrieve(text, index, timings)
+    )
+    response, _ = await aanswer(
+        query,
+        query_embedding,
+        strings,
+        index,
+        model="gpt-3.5-turbo",
+        token_counts=token_counts,
+    )
+    return response
+
+
+async def sequential_response(
+    text: str,
+    index: EmbeddingIndex,
+    timings: dict,
+) -> str:
+    """Answer the raw text, retry with restored accents on ERROR_MESSAGE"""
+    start = time.perf_counter()
+    response, _ = await aget_response(
+            query=text,
+            df=index,
+            model="gpt-3.5-turbo",
+        )
+    timings["response"] = time.perf_counter() - start
+    if ERROR_MESSAGE in response:
+        try:
+            with stage("fallback"):
+                with stage("accent"):
+                    request = await asyncio.to_thread(add_accent, text)
+                response_, _ = await aget_response(
+                    query=request,
+                    df=index,
+                    model="gpt-3.5-turbo",
+                )
+        except Exception:
+            # degraded (e.g. no accent model): keep the raw text's answer
+            logger.exception("Retry with restored accents failed")
+        else:
+            if ERROR_MESSAGE not in response_:
+                response = response_
+    return response
+
+
+def check_service(service: str) -> None:
+    """404 for a service that is not in SERVED_SERVICES"""
+    if service not in registry:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Unknown service {service!r}",
+        )
+
+
+async def service_index(service: str) -> EmbeddingIndex:
+    """
+    The embedding index of a served service: 404 for an unknown service or
+    one without embedding data, 503 if its data fails to load
+    """
+    check_service(service)
+    try:
+        return await aget_embedding_data(service)
+    except FileNotFoundError as e:
+        logger.warning("No embedding data for %s: %r", service, e)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Service {service!r} has no embedding data",
+        )
+    except Exception:
+        logger.exception("Loading the embedding data of %s failed", service)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Embedding data of {service!r} could not be loaded",
+        )
+
+
 @app.post(
     "/chat"
 )
 async def get_response_from_chatgpt(
     message: Message
 ):
-    response, _ = get_response(
-            query=message,
-            df=embedding_data,
-            model="gpt-3.5-turbo",
-        )   
-    if ERROR_MESSAGE in response:
-        request = add_accent(message)
-        response_, _ = get_response(
-            query=request,
-            df=embedding_data,
-            model="gpt-3.5-turbo",
-        )   
-        if ERROR_MESSAGE not in response_:
-            content = {
-                "http_code": status.HTTP_200_OK,
-                "data": response_
-            }
-            return JSONResponse(status_code = status.HTTP_200_OK, content = content
+    return await chat(message, message.service or SERVICE)
+
+
+@app.post(
+    "/{service}/chat"
 )
+async def get_service_response_from_chatgpt(
+    service: str,
+    message: Message
+):
+    return await chat(message, service)
+
+
+async def chat(message: Message, service: str) -> JSONResponse:
+    """
+    Answer a message from the knowledge base of a service. Concurrent
+    requests with the same (normalized) message share one answer.
+    """
+    start = time.perf_counter()
+    index = await service_index(service)
+
+    async def answer():
+        # stages (see metrics.stage) add their durations to timings
+        timings = start_request()
+        if SPECULATIVE_ACCENT and is_unaccented_vietnamese(message.message):
+            response = await speculative_response(
+                message.message,
+                index,
+                timings,
+            )
+        else:
+            response = await sequential_response(
+                message.message,
+                index,
+                timings,
+            )
+        return response, timings
+
+    with track_request("/chat"):
+        response, stage_timings = await chat_flight.do(
+            fingerprint(service, normalize_query(message.message)),
+            answer,
+        )
+    # a coalesced request reports the stages of the answer it waited for
+    timings = dict(stage_timings)
+    timings["total"] = time.perf_counter() - start
+    logger.info("chat timings: %s", server_timing(timings))
+
     content = {
                 "http_code": status.HTTP_200_OK,
-                "data": response_
+                "data": response
             }
-           
-    return JSONResponse(status_code = status.HTTP_200_OK, content = content
+
+    return JSONResponse(
+        status_code=status.HTTP_200_OK,
+        content=content,
+        headers={"Server-Timing": server_timing(timings)},
+    )
+
+
+async def batch_responses(texts: list[str], index: EmbeddingIndex) -> list:
+    """
+    Answer texts together (see aget_responses), then the texts answered
+    with ERROR_MESSAGE again with restored accents, as sequential_response
+    does. Returns the response or the exception of every text, in order.
+    """
+    results = await aget_responses(texts, index, model="gpt-3.5-turbo")
+    responses = [
+        result if isinstance(result, Exception) else result[0]
+        for result in results
+    ]
+    retry = [
+        i
+        for i, response in enumerate(responses)
+        if isinstance(response, str) and ERROR_MESSAGE in response
+    ]
+    if not retry:
+        return responses
+    # a text whose accents cannot be restored only fails its own item
+    accented = await asyncio.gather(
+        *(asyncio.to_thread(add_accent, texts[i]) for i in retry),
+        return_exceptions=True,
+    )
+    for i, request in zip(retry, accented):
+        if isinstance(request, Exception):
+            responses[i] = request
+    retry = [
+        (i, request)
+        for i, request in zip(retry, accented)
+        if not isinstance(request, Exception)
+    ]
+    if retry:
+        results = await aget_responses(
+            [request for _, request in retry],
+            index,
+            model="gpt-3.5-turbo",
+        )
+        for (i, _), result in zip(retry, results):
+            if not isinstance(result, Exception) and (
+                ERROR_MESSAGE not in result[0]
+            ):
+                responses[i] = result[0]
+    return responses
+
+
+@app.post(
+    "/chat/batch"
 )
+async def get_batch_responses_from_chatgpt(
+    batch: BatchMessage
+):
+    """
+    Answer up to CHAT_BATCH_MAX_SIZE messages: one embedding request for
+    all of them, then concurrent chat completions. "data" has one item per
+    message, in order, with the answer or the error of that message.
+    """
+    if len(batch.messages) > CHAT_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {CHAT_BATCH_MAX_SIZE} messages per batch",
+        )
+    timings = start_request()
+    start = time.perf_counter()
+    index = await service_index(batch.service or SERVICE)
+    with track_request("/chat/batch"):
+        responses = await batch_responses(batch.messages, index)
+    timings["total"] = time.perf_counter() - start
+    logger.info(
+        "chat batch of %d timings: %s",
+        len(batch.messages),
+        server_timing(timings),
+    )
+    items = []
+    for response in responses:
+        if isinstance(response, Exception):
+            logger.error("Batch item failed: %r", response)
+            items.append(
+                {
+                    "http_code": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    "error": f"{ERROR_MESSAGE} ({type(response).__name__})",
+                },
+            )
+        else:
+            items.append({"http_code": status.HTTP_200_OK, "data": response})
+    content = {
+        "http_code": status.HTTP_200_OK,
+        "data": items,
+    }
+    return JSONResponse(
+        status_code=status.HTTP_200_OK,
+        content=content,
+        headers={"Server-Timing": server_timing(timings)},
+    )
+
+
+def sse(data: dict, event: str | None = None) -> str:
+    """Format a server-sent event"""
+    event = f"event: {event}\n" if event else ""
+    return f"{event}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post(
+    "/chat/stream"
+)
+async def stream_response_from_chatgpt(
+    message: Message
+):
+    return await stream_chat(message, message.service or SERVICE)
+
+
+@app.post(
+    "/{service}/chat/stream"
+)
+async def stream_service_response_from_chatgpt(
+    service: str,
+    message: Message
+):
+    return await stream_chat(message, service)
+
+
+async def stream_chat(message: Message, service: str) -> StreamingResponse:
+    """
+    Answer a message as server-sent events: "data: {"delta": ...}" events
+    with the answer as it is generated, then a "done" event with the stage
+    timings, including the time to the first answer token ("ttft").
+    Unlike /chat, an ERROR_MESSAGE answer is not retried with restored
+    accents (the answer is already sent by then).
+    """
+    # before the response starts, so a missing index is still a 404/503
+    index = await service_index(service)
+
+    async def events():
+        timings = start_request()
+        start = time.perf_counter()
+        text = message.message
+        try:
+            if SPECULATIVE_ACCENT and is_unaccented_vietnamese(text):
+                query, query_embedding, strings, _, token_counts = (
+                    await speculative_retrieve(text, index, timings)
+                )
+            else:
+                query = text
+                query_embedding, strings, _, token_counts = await aretrieve(
+                    text,
+                    index,
+                )
+                timings["retrieval"] = time.perf_counter() - start
+            async for piece in astream_answer(
+                query,
+                query_embedding,
+                strings,
+                index,
+                model="gpt-3.5-turbo",
+                token_counts=token_counts,
+            ):
+                if "ttft" not in timings:
+                    timings["ttft"] = time.perf_counter() - start
+                    TTFT_SECONDS.observe(timings["ttft"])
+                yield sse({"delta": piece})
+        except Exception:
+            logger.exception("Streaming an answer failed")
+            record_request(
+                "/chat/stream",
+                time.perf_counter() - start,
+                "error",
+            )
+            yield sse({"error": ERROR_MESSAGE}, event="error")
+            return
+        timings["total"] = time.perf_counter() - start
+        record_request("/chat/stream", timings["total"], "ok")
+        logger.info("chat stream timings: %s", server_timing(timings))
+        yield sse(timings, event="done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # no buffering by proxies, events are sent as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get(
+    "/ready"
+)
+async def readiness():
+    """
+    200 once every heavy component is loaded, 503 while warming up or if
+    a required one failed. A failed optional component (the accent model)
+    is reported as "degraded" with a 200. The body has the startup-time
+    breakdown.
+    """
+    content = warmup.status()
+    content["import_seconds"] = import_seconds
+    if content["ready"]:
+        code = status.HTTP_200_OK
+    else:
+        code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return JSONResponse(status_code=code, content=content)
+
+
+@app.get(
+    "/stats"
+)
+async def statistics():
+    """Cache hit rates, coalesced calls and accent inference stats"""
+    content = {
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "response_cache": response_cache.stats.as_dict(),
+        "coalescing": {
+            "chat": chat_flight.stats.as_dict(),
+            "embedding": embedding_flight.stats.as_dict(),
+            "completion": completion_flight.stats.as_dict(),
+        },
+        "accent_inference": inference_stats(),
+    }
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
+
+
+def collect_metrics() -> list:
+    """Cache, coalescing and index stats for GET /metrics (see metrics.py)"""
+    caches = {
+        f"query_embedding_{layer}": stats
+        for layer, stats in query_embedding_cache.stats().items()
+    }
+    caches["response"] = response_cache.stats.as_dict()
+    flights = {
+        "chat": chat_flight.stats.as_dict(),
+        "embedding": embedding_flight.stats.as_dict(),
+        "completion": completion_flight.stats.as_dict(),
+    }
+    services = index_status()["services"]
+    return [
+        (
+            f"cache_{key}_total",
+            "counter",
+            f"Cache {key} by cache",
+            [({"cache": name}, stats[key]) for name, stats in caches.items()],
+        )
+        for key in ("hits", "misses", "evictions")
+    ] + [
+        (
+            "cache_hit_ratio",
+            "gauge",
+            "Cache hits / lookups since startup",
+            [
+                ({"cache": name}, stats["hit_rate"])
+                for name, stats in caches.items()
+            ],
+        ),
+        (
+            "singleflight_calls_total",
+            "counter",
+            "Calls through a single-flight layer",
+            [({"layer": name}, s["calls"]) for name, s in flights.items()],
+        ),
+        (
+            "singleflight_coalesced_total",
+            "counter",
+            "Calls that waited for an identical call in flight",
+            [({"layer": name}, s["coalesced"]) for name, s in flights.items()],
+        ),
+        (
+            "embedding_index_rows",
+            "gauge",
+            "Rows of a loaded embedding index",
+            [
+                ({"service": name}, state["rows"])
+                for name, state in services.items()
+                if state["loaded"]
+            ],
+        ),
+        (
+            "embedding_index_mapped_bytes",
+            "gauge",
+            "Bytes of a loaded embedding index, memory-mapped ones included",
+            [
+                ({"service": name}, state["mapped_bytes"])
+                for name, state in services.items()
+            ],
+        ),
+    ]
+
+
+REGISTRY.add_collector(collect_metrics)
+
+
+@app.get(
+    "/metrics"
+)
+async def prometheus_metrics():
+    """
+    Prometheus metrics: latency histograms of the request stages, token
+    usage, OpenAI requests, cache hit rates and coalesced calls
+    """
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get(
+    "/index"
+)
+async def embedding_index_status():
+    """
+    Version, size and (re)load timings of every service's embedding index
+    """
+    return JSONResponse(status_code=status.HTTP_200_OK, content=index_status())
+
+
+@app.post(
+    "/admin/reload",
+    dependencies=[Depends(require_admin)],
+)
+async def reload_embedding_index(service: str = SERVICE, force: bool = False):
+    """
+    Load the embedding index of a service again if its version changed (or
+    if force is set) and swap it in. Requests are served from the current
+    index until the new one is loaded.
+    """
+    check_service(service)
+    reloaded = await asyncio.to_thread(reload_embedding_data, service, force)
+    content = {"reloaded": reloaded, **index_status()}
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
+
+
+@app.post(
+    "/admin/profile",
+    dependencies=[Depends(require_admin)],
+)
+async def capture_profile(
+    seconds: float = 10,
+    fmt: str = Query(default="collapsed", alias="format"),
+):
+    """
+    Sample the stacks of this worker process for `seconds` (see
+    profiler.py) and save them as a collapsed-stack ("collapsed") or
+    speedscope ("speedscope") file. Returns the profile with the chat
+    requests served meanwhile; with several workers, only the worker that
+    received this request is profiled.
+    """
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}]",
+        )
+    if fmt not in profiler.FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"format must be one of {list(profiler.FORMATS)}",
+        )
+    try:
+        profile = await asyncio.to_thread(profiler.capture, seconds)
+    except profiler.ProfilerBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
+        )
+    data = await asyncio.to_thread(profile.render, fmt)
+    path = await asyncio.to_thread(
+        profile.save,
+        PROFILE_FOLDERPATH,
+        fmt,
+        data,
+    )
+    logger.info("Saved a %.0fs profile to %s", profile.seconds, path)
+    content = {**profile.meta(), "path": path, "format": fmt, "data": data}
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
@@ -0,0 +1,307 @@
+"""
+Server metrics in the Prometheus text exposition format, without a client
+library: counters, histograms and collectors that read stats kept
+elsewhere (caches, index registry, ...) at scrape time.
+
+Stage timings: `with stage("ranking"):` observes the stage's duration in
+the chat_stage_seconds histogram and, inside a request started with
+start_request(), adds it to that request's timings dict (e.g. for the
+Server-Timing header). The dict is found through a ContextVar, so the
+stages of concurrent tasks of one request (asyncio.gather, to_thread)
+are added to the same dict.
+
+Usage:
+    timings = start_request()
+    with stage("embedding"):
+        ...
+    TOKENS.inc(120, model="gpt-3.5-turbo", kind="prompt")
+    text = REGISTRY.render()  # GET /metrics
+"""
+import contextlib
+import contextvars
+import functools
+import inspect
+import math
+import threading
+import time
+from typing import Callable, Optional
+
+# seconds, for stages from a sub-millisecond ranking to a long completion
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, got {labels}",
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> dict:
+        """label values -> count, e.g. to diff two snapshots"""
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> list[str]:
+        values = self.values()
+        return [
+            f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} "
+            f"{_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key,
+                ([0] * (len(self.buckets) + 1), 0.0),
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._values.items()
+            }
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = _format_labels(
+                    {**labels, "le": _format_value(bound)},
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{_format_labels(labels)} "
+                f"{_format_value(total)}",
+            )
+            lines.append(
+                f"{self.name}_count{_format_labels(labels)} {cumulative}",
+            )
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = []
+        # functions returning [(name, kind, documentation, samples)], with
+        # samples as [(labels dict, value)], called on every render
+        self.collectors = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect: Callable[[], list]) -> None:
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.header() + metric.samples()
+        for collect in self.collectors:
+            for name, kind, documentation, samples in collect():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(
+                        f"{name}{_format_labels(labels)} "
+                        f"{_format_value(value)}",
+                    )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "chat_stage_seconds",
+    "Duration of a stage of answering a question",
+    ("stage",),
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "chat_request_seconds",
+    "Duration of a chat request",
+    ("endpoint",),
+)
+TTFT_SECONDS = REGISTRY.histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from a streamed chat request to its first answer text",
+)
+REQUESTS = REGISTRY.counter(
+    "chat_requests_total",
+    "Chat requests by endpoint and outcome",
+    ("endpoint", "outcome"),
+)
+OPENAI_REQUESTS = REGISTRY.counter(
+    "openai_requests_total",
+    "OpenAI API requests",
+    ("api",),
+)
+TOKENS = REGISTRY.counter(
+    "openai_tokens_total",
+    "Tokens used by chat completions",
+    ("model", "kind"),
+)
+
+_request_timings: contextvars.ContextVar[Optional[dict]] = (
+    contextvars.ContextVar("request_timings", default=None)
+)
+
+
+def start_request() -> dict:
+    """Collect the stage timings of the current request in a new dict"""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Time a stage (see the module docstring)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def timed(name: str):
+    """Decorator: time every call of a (sync or async) function as a stage"""
+
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with stage(name):
+                    return await function(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with stage(name):
+                    return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def record_request(endpoint: str, seconds: float, outcome: str) -> None:
+    """Count a request ("ok" or "error") and observe its duration"""
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+
+
+@contextlib.contextmanager
+def track_request(endpoint: str):
+    """record_request the block, "error" if it raises"""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        record_request(endpoint, time.perf_counter() - start, outcome)
+
+
+def record_usage(response, model: str) -> None:
+    """Count the tokens of a chat completion response"""
+    usage = response.get("usage") or {}
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if kind in usage:
+            TOKENS.inc(usage[kind], model=model, kind=kind[:-len("_tokens")])
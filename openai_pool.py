@@ -0,0 +1,73 @@
+"""
+Pooled, bounded access to the async OpenAI client.
+
+openai 0.28 opens a new aiohttp session (and TCP/TLS connection) for every
+`acreate` call unless `openai.aiosession` is set. OpenAIPool keeps one
+keep-alive session per event loop and caps the number of requests in
+flight with a semaphore.
+
+Usage:
+    async with openai_pool.slot():
+        response = await openai.ChatCompletion.acreate(...)
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import aiohttp
+import openai
+
+
+class OpenAIPool:
+    def __init__(
+        self,
+        max_connections: int,
+        max_concurrency: int,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        args:
+            max_connections(int): keep-alive connections kept by the session
+            max_concurrency(int): OpenAI requests allowed in flight at once
+            timeout(float): total seconds per request, None = no timeout
+        """
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.in_flight = 0
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+
+    def _bind(self) -> None:
+        """Create the session and semaphore for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not self._session.closed:
+            return
+        self._loop = loop
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=30,
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Wait for a free request slot and route openai calls to the pool"""
+        self._bind()
+        async with self._semaphore:
+            token = openai.aiosession.set(self._session)
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+                openai.aiosession.reset(token)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._loop = self._session = self._semaphore = None
@@ -0,0 +1,244 @@
+"""
+On-demand sampling profiler of a running server process.
+
+A capture samples the Python stack of every thread (the event loop, the
+asyncio.to_thread workers running add_accent, ...) every PROFILE_INTERVAL
+seconds for a few seconds, from a thread of its own: nothing is installed
+in the interpreter, so there is no overhead when no capture is running.
+
+The stacks are written as a collapsed-stack file (one "thread;frame;...
+count" line per stack, the input of flamegraph.pl and speedscope) or as a
+speedscope JSON file, next to a ".meta.json" file with the chat requests
+(see metrics.REQUESTS) the process served during the capture.
+
+Usage:
+    profile = capture(10)
+    data = profile.render("speedscope")
+    path = profile.save(PROFILE_FOLDERPATH, "speedscope", data)
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+from ai_configs import PROFILE_INTERVAL
+from metrics import REQUESTS
+
+FORMATS = {"collapsed": ".collapsed", "speedscope": ".speedscope.json"}
+
+# held during a capture, so one runs at a time
+_capture_lock = threading.Lock()
+
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+
+def frame_name(code) -> str:
+    """function (file:line) of a code object, without ';' for collapsed"""
+    name = getattr(code, "co_qualname", code.co_name)
+    filename = os.path.basename(code.co_filename)
+    return f"{name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+def thread_stacks(skip: int) -> dict:
+    """thread name -> stack of code objects (outermost first), but skip"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = {}
+    for ident, frame in sys._current_frames().items():
+        if ident == skip:
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack.reverse()
+        stacks[names.get(ident, f"thread-{ident}")] = tuple(stack)
+    return stacks
+
+
+def request_mix(before: dict, after: dict) -> dict:
+    """endpoint -> outcome -> requests between two REQUESTS snapshots"""
+    mix = collections.defaultdict(dict)
+    for (endpoint, outcome), count in after.items():
+        served = count - before.get((endpoint, outcome), 0)
+        if served:
+            mix[endpoint][outcome] = int(served)
+    return dict(mix)
+
+
+class Profile:
+    def __init__(
+        self,
+        stacks: collections.Counter,
+        samples: int,
+        started_at: float,
+        seconds: float,
+        interval: float,
+        requests: dict,
+    ) -> None:
+        """
+        args:
+            stacks(Counter): (thread name, code objects) -> samples
+            samples(int): sampling rounds, one sample per thread each
+            started_at(float): epoch time of the first sample
+            seconds(float): duration of the capture
+            interval(float): seconds between samples, as configured
+            requests(dict): request mix served during the capture
+        """
+        self.stacks = stacks
+        self.samples = samples
+        self.started_at = started_at
+        self.seconds = seconds
+        self.interval = interval
+        self.requests = requests
+
+    @property
+    def sample_seconds(self) -> float:
+        """measured seconds between samples, > interval under load"""
+        return self.seconds / self.samples if self.samples else self.interval
+
+    def meta(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "started_at": time.strftime(
+                "%Y-%m-%dT%H:%M:%S",
+                time.localtime(self.started_at),
+            ),
+            "seconds": self.seconds,
+            "interval": self.interval,
+            "samples": self.samples,
+            "requests": self.requests,
+        }
+
+    def collapsed(self) -> str:
+        """flamegraph.pl input: "thread;outer;...;inner count" per stack"""
+        lines = [
+            ";".join([thread] + [frame_name(code) for code in stack])
+            + f" {count}"
+            for (thread, stack), count in self.stacks.most_common()
+        ]
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self) -> dict:
+        """speedscope file, one sampled profile per thread"""
+        frames = []
+        frame_ids = {}
+        threads = collections.defaultdict(list)
+        for (thread, stack), count in self.stacks.items():
+            ids = []
+            for code in stack:
+                if code not in frame_ids:
+                    frame_ids[code] = len(frames)
+                    frames.append(
+                        {
+                            "name": getattr(code, "co_qualname", code.co_name),
+                            "file": code.co_filename,
+                            "line": code.co_firstlineno,
+                        },
+                    )
+                ids.append(frame_ids[code])
+            threads[thread].append((ids, count * self.sample_seconds))
+        requests = ", ".join(
+            f"{endpoint} {outcome}={count}"
+            for endpoint, outcomes in sorted(self.requests.items())
+            for outcome, count in sorted(outcomes.items())
+        )
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"pid {os.getpid()}, {self.seconds:.1f}s, "
+            f"requests: {requests or 'none'}",
+            "exporter": "profiler.py",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": thread,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weight for _, weight in samples),
+                    "samples": [ids for ids, _ in samples],
+                    "weights": [weight for _, weight in samples],
+                }
+                for thread, samples in sorted(threads.items())
+            ],
+        }
+
+    def render(self, fmt: str = "collapsed"):
+        """The profile in a FORMATS format: collapsed str or speedscope dict"""
+        if fmt == "speedscope":
+            return self.speedscope()
+        return self.collapsed()
+
+    def save(self, folder: str, fmt: str = "collapsed", data=None) -> str:
+        """
+        Write the profile and its .meta.json file to a folder
+        args:
+            folder(str): folder of the profiles
+            fmt(str): "collapsed" or "speedscope"
+            data: render(fmt) if already rendered, None = render it here
+        returns:
+            path of the profile
+        """
+        if data is None:
+            data = self.render(fmt)
+        os.makedirs(folder, exist_ok=True)
+        name = time.strftime(
+            f"profile-%Y%m%d-%H%M%S-{os.getpid()}",
+            time.localtime(self.started_at),
+        )
+        path = os.path.join(folder, name + FORMATS[fmt])
+        with open(path, "w", encoding="utf-8") as f:
+            if fmt == "speedscope":
+                json.dump(data, f)
+            else:
+                f.write(data)
+        with open(
+            os.path.join(folder, name + ".meta.json"),
+            "w",
+            encoding="utf-8",
+        ) as f:
+            json.dump({**self.meta(), "profile": path}, f, indent=2)
+        return path
+
+
+def capture(seconds: float, interval: Optional[float] = None) -> Profile:
+    """
+    Sample the stacks of the other threads for `seconds`, blocking the
+    calling thread (run it with asyncio.to_thread from the event loop).
+    Raises ProfilerBusyError while another capture runs.
+    """
+    if interval is None:
+        interval = PROFILE_INTERVAL
+    if not _capture_lock.acquire(blocking=False):
+        raise ProfilerBusyError("A profile is already being captured")
+    try:
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        samples = 0
+        requests_before = REQUESTS.values()
+        started_at = time.time()
+        start = time.perf_counter()
+        deadline = start + seconds
+        next_sample = start
+        while True:
+            for thread, stack in thread_stacks(skip=me).items():
+                stacks[thread, stack] += 1
+            samples += 1
+            next_sample += interval
+            now = time.perf_counter()
+            if next_sample >= deadline:
+                break
+            if next_sample > now:
+                time.sleep(next_sample - now)
+            else:
+                # fell behind (e.g. a busy GIL), skip the missed samples
+                next_sample = now
+        elapsed = time.perf_counter() - start
+        requests = request_mix(requests_before, REQUESTS.values())
+    finally:
+        _capture_lock.release()
+    return Profile(stacks, samples, started_at, elapsed, interval, requests)
@@ -0,0 +1,192 @@
+import sys
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+def normalize_rows(matrix) -> np.ndarray:
+    """Return a C-contiguous float32 copy of matrix with unit-length rows."""
+    matrix = np.array(matrix, dtype=np.float32, order="C", ndmin=2)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Return the indices of the k highest scores, best first.
+    Uses a partial selection (argpartition) so only the k winners get sorted.
+    """
+    n = scores.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(n)
+    # stable sort keeps the original row order between equal scores
+    order = np.argsort(-scores[candidates], kind="stable")
+    return candidates[order]
+
+
+class EmbeddingIndex:
+    """
+    Holds pre-normalized float32 embeddings in one contiguous matrix.
+    A query is scored against every row with a single matrix-vector product.
+
+    Example:
+        index = EmbeddingIndex.from_dataframe(df)
+        strings, relatednesses = index.search(query_embedding, top_n=3)
+    """
+
+    def __init__(
+        self,
+        vectors,
+        texts: Sequence[str],
+        normalized: bool = False,
+        ann=None,
+        version: Optional[str] = None,
+        token_counts: Optional[np.ndarray] = None,
+        token_encoding: Optional[str] = None,
+        service: Optional[str] = None,
+    ) -> None:
+        """
+        args:
+            vectors: (n, dim) embeddings, one row per text
+            texts: chunk texts, texts[i] belongs to vectors[i]
+            normalized(bool): set if vectors already have unit-length rows
+            ann: optional approximate index (ann_index.IVFIndex) over vectors
+            version(str): identifies the data the index was loaded from
+            token_counts: optional number of tokens of every text
+            token_encoding(str): tiktoken encoding of token_counts
+            service(str): chatbot service the texts belong to
+        """
+        if normalized:
+            self.vectors = vectors
+        else:
+            self.vectors = normalize_rows(vectors)
+        self.texts = texts
+        self.ann = ann
+        self.version = version
+        self.token_counts = token_counts
+        self.token_encoding = token_encoding
+        self.service = service
+        if len(self.texts) != self.vectors.shape[0]:
+            raise ValueError(
+                f"Got {len(self.texts)} texts for {self.vectors.shape[0]} embeddings",  # noqa: E501
+            )
+
+    @classmethod
+    def from_dataframe(
+        cls,
+        df: pd.DataFrame,
+        text_column: str = "text",
+        embedding_column: str = "embedding",
+    ) -> "EmbeddingIndex":
+        """Build an index from a DataFrame with list-typed embeddings."""
+        texts = df[text_column].tolist()
+        if len(texts) == 0:
+            return cls(np.empty((0, 0), dtype=np.float32), texts, True)
+        vectors = np.array(df[embedding_column].tolist(), dtype=np.float32)
+        return cls(vectors, texts)
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory footprint (memory-mapped data included)"""
+        size = self.vectors.nbytes
+        if hasattr(self.texts, "nbytes"):
+            size += self.texts.nbytes
+        else:
+            size += sum(sys.getsizeof(text) for text in self.texts)
+        if self.token_counts is not None:
+            size += self.token_counts.nbytes
+        if self.ann is not None:
+            size += self.ann.nbytes
+        return size
+
+    def scores(self, query_embedding) -> np.ndarray:
+        """Cosine similarity between the query and every row."""
+        query = normalize_rows(query_embedding)[0]
+        return self.vectors @ query
+
+    def top_k(
+        self,
+        query_embedding,
+        top_n: int = 3,
+        exact: bool = False,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return (row ids, cosine similarities) of the top_n rows.
+        Uses the ANN index when there is one, unless exact is set.
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.ann is not None and not exact:
+            query = normalize_rows(query_embedding)[0]
+            return self.ann.search(self.vectors, query, top_n)
+        scores = self.scores(query_embedding)
+        ids = top_k_indices(scores, top_n)
+        return ids, scores[ids]
+
+    def top_k_batch(
+        self,
+        query_embeddings,
+        top_n: int = 3,
+        exact: bool = False,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        top_k of every query: all queries are scored with one
+        matrix-matrix product (or searched one by one in the ANN index
+        when there is one, unless exact is set).
+        """
+        queries = normalize_rows(query_embeddings)
+        if len(self) == 0:
+            return [self.top_k(query, top_n) for query in queries]
+        if self.ann is not None and not exact:
+            return [
+                self.ann.search(self.vectors, query, top_n)
+                for query in queries
+            ]
+        # (m, n): row j holds the scores of query j
+        scores = queries @ self.vectors.T
+        results = []
+        for row in scores:
+            ids = top_k_indices(row, top_n)
+            results.append((ids, row[ids]))
+        return results
+
+    def search(
+        self,
+        query_embedding,
+        top_n: int = 3,
+        relatedness_fn: Optional[Callable] = None,
+        exact: bool = False,
+    ) -> tuple[tuple[str, ...], tuple[float, ...]]:
+        """
+        Return the top_n texts and relatednesses, most related first.
+        A custom relatedness_fn(query_embedding, row_embedding) is applied
+        row by row (always exact), but top_n is still picked by
+        partial selection.
+        Note: the index only keeps unit-normalized rows, so relatedness_fn
+        gets normalized row embeddings, not the raw ones it got from the
+        DataFrame before. Cosine-based functions score the same; functions
+        that depend on the vector length (dot product, euclidean distance)
+        do not.
+        """
+        if relatedness_fn is None:
+            ids, scores = self.top_k(query_embedding, top_n, exact=exact)
+        else:
+            scores = np.array(
+                [relatedness_fn(query_embedding, row) for row in self.vectors],
+                dtype=np.float64,
+            )
+            ids = top_k_indices(scores, top_n)
+            scores = scores[ids]
+        strings = tuple(self.texts[i] for i in ids.tolist())
+        return strings, tuple(scores.tolist())
@@ -1,8 +1,18 @@
+from typing import Optional
+
 from pydantic import BaseModel,  Field
 
 class Message(BaseModel):
     message: str = Field(examples="")
+    # one of SERVED_SERVICES, None = SERVICE
+    service: Optional[str] = None
     class Config:
         schema_extra = {
             "message": ""
-        }
\ No newline at end of file
+        }
+
+
+class BatchMessage(BaseModel):
+    messages: list[str] = Field(examples=[""])
+    # one of SERVED_SERVICES, None = SERVICE
+    service: Optional[str] = None
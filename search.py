@@ -1,78 +1,399 @@
-import ast  # for converting embeddings saved as strings back to arrays
+import asyncio
 import configparser
+import functools
+import json  # for converting embeddings saved as strings back to lists
+import logging
 import os
 import time
 
-import gradio as gr
 import openai  # for calling the OpenAI API
 import pandas as pd  # for storing text and embeddings data
-import tiktoken  # for counting tokens
 from ai_configs import (
+    BATCH_SIZE,
+    CHAT_BATCH_MAX_CONCURRENCY,
+    CONTEXT_TOP_N,
+    EMBEDDING_CACHE_DISK_SIZE,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_TTL,
     EMBEDDING_MODEL,
     FILEPATH_EMBEDDINGS,
+    FOLDERPATH_EMBEDDING_STORE,
+    INDEX_MEMORY_BUDGET,
     INTRODUCTION_MESSAGE,
+    INTRODUCTION_TEMPLATE,
     MODEL_NAME,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_TIMEOUT,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_THRESHOLD,
+    RESPONSE_CACHE_TTL,
+    SERVED_SERVICES,
+    SERVICE,
     SYSTEM_CONTENT,
+    SYSTEM_CONTENT_TEMPLATE,
+    TEMPERATURE,
     TOKEN_BUDGET,
 )
-from scipy import spatial  # for calculating vector similarities for search
+from cache import (
+    QueryEmbeddingCache,
+    ResponseCache,
+    SingleFlight,
+    fingerprint,
+)
+from embedding_store import EmbeddingStore, current_version, store_exists
+from metrics import OPENAI_REQUESTS, record_usage, stage, timed
+from openai_pool import OpenAIPool
+from retrieval import EmbeddingIndex  # for vectorized top-k search
+from service_registry import ServiceRegistry, embedding_paths
+from tokens import count_tokens, get_encoding, num_tokens
+
+logger = logging.getLogger(__name__)
 
 env = configparser.ConfigParser()
 env.read(".env")
-os.environ["OPENAI_API_KEY"] = env["OpenAI"]["OPENAI_KEY_TTL"]
-openai.api_key = os.environ["OPENAI_API_KEY"]
+# without a key in .env (or OPENAI_API_KEY) the module still imports, e.g.
+# for offline benchmarks against fake_openai.py; API calls fail instead
+if env.has_option("OpenAI", "OPENAI_KEY_TTL"):
+    os.environ["OPENAI_API_KEY"] = env["OpenAI"]["OPENAI_KEY_TTL"]
+openai.api_key = os.environ.get("OPENAI_API_KEY")
 
 model_name = MODEL_NAME
-# Read embbeding file
-embedding_data = pd.read_csv(FILEPATH_EMBEDDINGS)
-# Convert embeddings from CSV str type back to list type
-embedding_data["embedding"] = embedding_data["embedding"].apply(
-    ast.literal_eval,
+
+
+def load_embedding_data(
+    store_path: str = FOLDERPATH_EMBEDDING_STORE,
+    csv_path: str = FILEPATH_EMBEDDINGS,
+) -> EmbeddingIndex:
+    """
+    Load the embedding index from the binary store (memory-mapped).
+    Falls back to the legacy CSV file, which is parsed in full.
+    """
+    if store_exists(store_path):
+        return EmbeddingStore(store_path).to_index()
+    logger.warning(
+        "No embedding store in %s, parsing %s. Run 'python "
+        "embedding_store.py --service <SERVICE>' to convert it.",
+        store_path,
+        csv_path,
+    )
+    df = pd.read_csv(csv_path)
+    # Convert embeddings from CSV str type back to list type ("[0.1, ...]"
+    # is valid JSON, and json.loads parses it far faster than literal_eval)
+    df["embedding"] = df["embedding"].apply(json.loads)
+    # Keep pre-normalized float32 vectors in one contiguous matrix
+    index = EmbeddingIndex.from_dataframe(df)
+    index.version = f"csv-{os.path.getmtime(csv_path)}"
+    # count chunk tokens once here rather than on every query
+    index.token_counts = count_tokens(index.texts, MODEL_NAME)
+    index.token_encoding = get_encoding(MODEL_NAME).name
+    return index
+
+
+def embedding_data_version(
+    store_path: str = FOLDERPATH_EMBEDDING_STORE,
+    csv_path: str = FILEPATH_EMBEDDINGS,
+) -> str | None:
+    """
+    Version of the embedding data on disk, as in EmbeddingIndex.version:
+    the store's CURRENT version, else the CSV file's mtime
+    """
+    if store_exists(store_path):
+        return current_version(store_path)
+    if os.path.isfile(csv_path):
+        return f"csv-{os.path.getmtime(csv_path)}"
+    return None
+
+
+# requests take a reference to an index once, so a reload swaps it for new
+# requests while in-flight ones finish on the old snapshot
+registry = ServiceRegistry(
+    SERVED_SERVICES,
+    load=lambda service: load_embedding_data(*embedding_paths(service)),
+    version=lambda service: embedding_data_version(*embedding_paths(service)),
+    memory_budget=INDEX_MEMORY_BUDGET,
+)
+
+
+def get_embedding_data(service: str = SERVICE) -> EmbeddingIndex:
+    """Return the embedding index of a service, loading it on first use"""
+    return registry.get(service)
+
+
+async def aget_embedding_data(service: str = SERVICE) -> EmbeddingIndex:
+    """get_embedding_data, loading in a worker thread if not loaded yet"""
+    index = registry.loaded(service)
+    if index is None:
+        return await asyncio.to_thread(get_embedding_data, service)
+    registry.touch(service)
+    return index
+
+
+def reload_embedding_data(
+    service: str = SERVICE,
+    force: bool = False,
+) -> bool:
+    """
+    Load the embedding data of a service again if its version on disk
+    changed (or if force is set) and swap it in. Requests keep being served
+    from the current index meanwhile.
+    returns:
+        whether a new index was swapped in
+    """
+    return registry.reload(service, force)
+
+
+def index_status() -> dict:
+    """Version, size and (re)load timings of every service's index"""
+    return registry.status()
+
+
+async def watch_embedding_data(interval: float) -> None:
+    """Check the loaded services for a new data version every interval"""
+    while True:
+        await asyncio.sleep(interval)
+        for service in registry.services:
+            if registry.loaded(service) is None:
+                continue
+            try:
+                await asyncio.to_thread(registry.reload, service)
+            except Exception as e:
+                logger.error(
+                    "Reloading %s embedding data failed: %r",
+                    service,
+                    e,
+                )
+
+
+def __getattr__(name: str):
+    # keep `search.embedding_data` working, loaded lazily
+    if name == "embedding_data":
+        return get_embedding_data()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def as_embedding_index(df: pd.DataFrame | EmbeddingIndex) -> EmbeddingIndex:
+    """Return df as an EmbeddingIndex, converting a DataFrame if needed."""
+    if isinstance(df, EmbeddingIndex):
+        return df
+    return EmbeddingIndex.from_dataframe(df)
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    EMBEDDING_MODEL,
+    memory_size=EMBEDDING_CACHE_SIZE,
+    disk_path=EMBEDDING_CACHE_PATH,
+    disk_size=EMBEDDING_CACHE_DISK_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+)
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE,
+    threshold=RESPONSE_CACHE_THRESHOLD,
+    ttl=RESPONSE_CACHE_TTL,
+)
+# concurrent identical embedding / chat completion requests share one call
+embedding_flight = SingleFlight()
+completion_flight = SingleFlight()
+# keep-alive HTTP session and concurrency cap for the async OpenAI calls
+openai_pool = OpenAIPool(
+    max_connections=OPENAI_MAX_CONNECTIONS,
+    max_concurrency=OPENAI_MAX_CONCURRENCY,
+    timeout=OPENAI_TIMEOUT,
 )
-print("Finished loading embedding data!")
+
+
+def create_query_embedding(query: str) -> list[float]:
+    """Embed a query via OpenAI API"""
+    OPENAI_REQUESTS.inc(api="embedding")
+    query_embedding_response = openai.Embedding.create(
+        model=EMBEDDING_MODEL,
+        input=query,
+    )
+    return query_embedding_response["data"][0]["embedding"]
+
+
+@timed("embedding")
+def get_query_embedding(query: str):
+    """Return the embedding of a query, from the cache when possible"""
+    return query_embedding_cache.get_or_create(query, create_query_embedding)
+
+
+async def acreate_query_embedding(query: str):
+    """Embed a query via the async OpenAI API and cache it"""
+    OPENAI_REQUESTS.inc(api="embedding")
+    async with openai_pool.slot():
+        response = await openai.Embedding.acreate(
+            model=EMBEDDING_MODEL,
+            input=query,
+        )
+    return await query_embedding_cache.aput(
+        query,
+        response["data"][0]["embedding"],
+    )
+
+
+@timed("embedding")
+async def aget_query_embedding(query: str):
+    """Async get_query_embedding, a cache miss awaits the OpenAI API"""
+    embedding = await query_embedding_cache.aget(query)
+    if embedding is None:
+        # the same (normalized) query already being embedded is awaited
+        embedding = await embedding_flight.do(
+            query_embedding_cache.key(query),
+            functools.partial(acreate_query_embedding, query),
+        )
+    return embedding
+
+
+@timed("embedding")
+async def aget_query_embeddings(queries: list[str]) -> list:
+    """
+    aget_query_embedding of many queries: the cache misses are embedded
+    with one OpenAI request per BATCH_SIZE distinct queries (not coalesced
+    with identical requests in flight, see embedding_flight)
+    """
+    embeddings = await query_embedding_cache.aget_many(queries)
+    missing = {}  # cache key -> query, one query per normalized text
+    for query, embedding in zip(queries, embeddings):
+        if embedding is None:
+            missing.setdefault(query_embedding_cache.key(query), query)
+    todo = list(missing.values())
+    found = {}
+    for start in range(0, len(todo), BATCH_SIZE):
+        batch = todo[start:start + BATCH_SIZE]
+        OPENAI_REQUESTS.inc(api="embedding")
+        async with openai_pool.slot():
+            response = await openai.Embedding.acreate(
+                model=EMBEDDING_MODEL,
+                input=batch,
+            )
+        items = [
+            (batch[item["index"]], item["embedding"])
+            for item in response["data"]
+        ]
+        stored = await query_embedding_cache.aput_many(items)
+        for (query, _), embedding in zip(items, stored):
+            found[query_embedding_cache.key(query)] = embedding
+    return [
+        found[query_embedding_cache.key(query)] if embedding is None
+        else embedding
+        for query, embedding in zip(queries, embeddings)
+    ]
 
 
 # search function
 def strings_ranked_by_relatedness(
     query: str,
-    df: pd.DataFrame,
-    relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y),
+    df: pd.DataFrame | EmbeddingIndex,
+    relatedness_fn=None,
     top_n: int = 3,
+    exact: bool = False,
 ) -> tuple[list[str], list[float]]:
     """Returns a list of strings and relatednesses,
     sorted from most related to least.
+    By default relatedness is the cosine similarity, computed for all rows
+    with one matrix-vector product, or for the rows of the nearest IVF lists
+    when the index has an ANN index (set exact to force a full scan).
+    A custom relatedness_fn(x, y) is called with the query embedding and
+    each (unit-normalized) row embedding.
     """
-    query_embedding_response = openai.Embedding.create(
-        model=EMBEDDING_MODEL,
-        input=query,
+    query_embedding = get_query_embedding(query)
+    return as_embedding_index(df).search(
+        query_embedding,
+        top_n=top_n,
+        relatedness_fn=relatedness_fn,
+        exact=exact,
     )
-    query_embedding = query_embedding_response["data"][0]["embedding"]
-    strings_and_relatednesses = [
-        (row["text"], relatedness_fn(query_embedding, row["embedding"]))
-        for i, row in df.iterrows()
-    ]
-    strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
-    strings, relatednesses = zip(*strings_and_relatednesses)
 
-    return strings[:top_n], relatednesses[:top_n]
+
+async def astrings_ranked_by_relatedness(
+    query: str,
+    df: pd.DataFrame | EmbeddingIndex,
+    relatedness_fn=None,
+    top_n: int = 3,
+    exact: bool = False,
+) -> tuple[list[str], list[float]]:
+    """Async strings_ranked_by_relatedness"""
+    query_embedding = await aget_query_embedding(query)
+    return as_embedding_index(df).search(
+        query_embedding,
+        top_n=top_n,
+        relatedness_fn=relatedness_fn,
+        exact=exact,
+    )
+
+
+def ranked_rows(
+    index: EmbeddingIndex,
+    ids,
+    scores,
+) -> tuple[list[str], list[float], list[int] | None]:
+    """(strings, relatednesses, token counts) of top_k row ids and scores"""
+    ids = ids.tolist()
+    strings = [index.texts[i] for i in ids]
+    token_counts = None
+    if index.token_counts is not None:
+        token_counts = [int(index.token_counts[i]) for i in ids]
+    return strings, scores.tolist(), token_counts
+
+
+@timed("ranking")
+def rank(
+    index: EmbeddingIndex,
+    query_embedding,
+    top_n: int = CONTEXT_TOP_N,
+) -> tuple[list[str], list[float], list[int] | None]:
+    """
+    Return the top_n strings, their relatednesses and their stored token
+    counts (None if the index has none), most related first.
+    """
+    ids, scores = index.top_k(query_embedding, top_n)
+    return ranked_rows(index, ids, scores)
+
+
+@timed("ranking")
+def rank_batch(
+    index: EmbeddingIndex,
+    query_embeddings: list,
+    top_n: int = CONTEXT_TOP_N,
+) -> list[tuple[list[str], list[float], list[int] | None]]:
+    """rank() of every query, scored with one matrix-matrix product"""
+    return [
+        ranked_rows(index, ids, scores)
+        for ids, scores in index.top_k_batch(query_embeddings, top_n)
+    ]
 
 
-def num_tokens(text: str, model: str = MODEL_NAME) -> int:
-    """Return the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+def usable_token_counts(
+    index: EmbeddingIndex,
+    token_counts: list[int] | None,
+    model: str,
+) -> list[int] | None:
+    """token_counts, or None if they were counted with another encoding"""
+    if token_counts is None:
+        return None
+    if index.token_encoding != get_encoding(model).name:
+        return None
+    return token_counts
 
 
 def query_message(
     query: str,
-    df: pd.DataFrame,
+    df: pd.DataFrame | EmbeddingIndex,
     model: str,
     token_budget: int,
+    top_n: int = CONTEXT_TOP_N,
 ) -> str:
     """Return a message for GPT,
     with relevant source texts pulled from a dataframe.
     """
-    strings, _ = strings_ranked_by_relatedness(query, df)
+    index = as_embedding_index(df)
+    strings, _, token_counts = rank(
+        index,
+        get_query_embedding(query),
+        top_n=top_n,
+    )
 
     """ example:
     #strings, relatednesses = strings_ranked_by_relatedness(
@@ -84,58 +405,502 @@ def query_message(
     #    print(f"{relatedness=:.3f}\n{string}\n")
     """
 
-    question = f"\n\nQuestion: {query}"
-    message = INTRODUCTION_MESSAGE
-    for string in strings:
-        next_article = f"\nTT article section:\n--\n{string}\n--"
-        if (
-            num_tokens(message + next_article + question, model=model)
-            > token_budget
-        ):
+    return build_message(
+        query,
+        strings,
+        model,
+        token_budget,
+        token_counts=usable_token_counts(index, token_counts, model),
+        introduction=introduction_message(index.service),
+    )
+
+
+async def aquery_message(
+    query: str,
+    df: pd.DataFrame | EmbeddingIndex,
+    model: str,
+    token_budget: int,
+    top_n: int = CONTEXT_TOP_N,
+) -> str:
+    """Async query_message"""
+    index = as_embedding_index(df)
+    strings, _, token_counts = rank(
+        index,
+        await aget_query_embedding(query),
+        top_n=top_n,
+    )
+    return build_message(
+        query,
+        strings,
+        model,
+        token_budget,
+        token_counts=usable_token_counts(index, token_counts, model),
+        introduction=introduction_message(index.service),
+    )
+
+
+ARTICLE_PREFIX = "\nTT article section:\n--\n"
+ARTICLE_SUFFIX = "\n--"
+QUESTION_PREFIX = "\n\nQuestion: "
+
+
+def introduction_message(service: str | None) -> str:
+    """INTRODUCTION_MESSAGE of a service (None = SERVICE)"""
+    if service is None or service == SERVICE:
+        return INTRODUCTION_MESSAGE
+    return INTRODUCTION_TEMPLATE.format(service=service)
+
+
+def system_content(service: str | None) -> str:
+    """SYSTEM_CONTENT of a service (None = SERVICE)"""
+    if service is None or service == SERVICE:
+        return SYSTEM_CONTENT
+    return SYSTEM_CONTENT_TEMPLATE.format(service=service)
+
+
+@functools.lru_cache(maxsize=None)
+def fixed_token_counts(
+    model: str,
+    introduction: str = INTRODUCTION_MESSAGE,
+) -> tuple[int, int]:
+    """
+    Tokens of the introduction and of the wrapper around every article,
+    counted once per model and introduction.
+    """
+    return (
+        num_tokens(introduction, model=model),
+        num_tokens(ARTICLE_PREFIX, model=model)
+        + num_tokens(ARTICLE_SUFFIX, model=model),
+    )
+
+
+@timed("packing")
+def build_message(
+    query: str,
+    strings: list[str],
+    model: str,
+    token_budget: int,
+    token_counts: list[int] | None = None,
+    introduction: str = INTRODUCTION_MESSAGE,
+) -> str:
+    """Pack the most related strings and the query into a GPT message
+    within token_budget, after the introduction.
+    The message size is tracked as a running sum of token counts: the
+    cached counts of the fixed parts, the question (tokenized once) and
+    token_counts[i] of strings[i] (tokenized here when not given).
+    Tokens are counted per part, so the total can differ from tokenizing
+    the whole message by a token at a part boundary.
+    """
+    question = f"{QUESTION_PREFIX}{query}"
+    introduction_tokens, article_tokens = fixed_token_counts(
+        model,
+        introduction,
+    )
+    if token_counts is None:
+        token_counts = count_tokens(strings, model=model).tolist()
+    used = introduction_tokens + num_tokens(question, model=model)
+    articles = []
+    for string, string_tokens in zip(strings, token_counts):
+        used += article_tokens + string_tokens
+        if used > token_budget:
             break
-        else:
-            message += next_article
-    return message + question
+        articles.append(f"{ARTICLE_PREFIX}{string}{ARTICLE_SUFFIX}")
+    return introduction + "".join(articles) + question
+
+
+def chat_messages(
+    message: str,
+    system: str = SYSTEM_CONTENT,
+) -> list[dict]:
+    """Return the chat messages sent to GPT for a query message"""
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": message},
+    ]
+
+
+# URL corrections of a GPT answer, applied in this order
+URL_REWRITES = (("help/document/", "wiki/1-"), (">>", ">"))
+
+
+def clean_response(response_message: str) -> str:
+    """Correct URLs in a GPT answer"""
+    for old, new in URL_REWRITES:
+        response_message = response_message.replace(old, new)
+    return response_message
+
+
+class StreamingRewriter:
+    """
+    clean_response for an answer that arrives in pieces: the output of
+    feed() and flush() joins up to clean_response of the joined pieces.
+    The end of a piece that may start a URL to rewrite is held back until
+    the next piece shows whether it does.
+
+    Usage:
+        rewriter = StreamingRewriter()
+        for piece in pieces:
+            send(rewriter.feed(piece))
+        send(rewriter.flush())
+    """
+
+    def __init__(self, rewrites=URL_REWRITES) -> None:
+        self.rewrites = rewrites
+        # text held back by every rewrite
+        self._pending = [""] * len(rewrites)
+
+    def feed(self, text: str) -> str:
+        """Rewrite a piece, returns the text that is final so far"""
+        for i, (old, new) in enumerate(self.rewrites):
+            # split as str.replace matches: left to right, non-overlapping
+            parts = (self._pending[i] + text).split(old)
+            tail = parts[-1]
+            # longest end of the text after the last match that is the
+            # start of `old`
+            keep = next(
+                (
+                    n
+                    for n in range(min(len(old) - 1, len(tail)), 0, -1)
+                    if tail.endswith(old[:n])
+                ),
+                0,
+            )
+            self._pending[i] = tail[len(tail) - keep:]
+            parts[-1] = tail[:len(tail) - keep]
+            text = new.join(parts)
+        return text
+
+    def flush(self) -> str:
+        """Return the text still held back, at the end of the answer"""
+        text = ""
+        for i, (old, new) in enumerate(self.rewrites):
+            text = (self._pending[i] + text).replace(old, new)
+            self._pending[i] = ""
+        return text
+
+
+def response_config(
+    df: EmbeddingIndex,
+    model: str,
+    token_budget: int,
+) -> str | None:
+    """
+    Fingerprint of everything a response depends on besides the query:
+    the embedding data version and the prompt config.
+    None if the embedding data has no version (e.g. an ad-hoc DataFrame).
+    """
+    if df.version is None:
+        return None
+    return fingerprint(
+        df.version,
+        model,
+        token_budget,
+        CONTEXT_TOP_N,
+        system_content(df.service),
+        introduction_message(df.service),
+    )
 
 
 def get_response(
     query: str,
-    df: pd.DataFrame,
+    df: pd.DataFrame | EmbeddingIndex,
     model: str = MODEL_NAME,
     token_budget: int = TOKEN_BUDGET,
     print_message: bool = False,
 ) -> str:
     """Answers a query using GPT and a dataframe of
     relevant texts and embeddings.
+    Answers are reused from response_cache for repeated or near-duplicate
+    queries against the same embedding data and prompt config.
     """
+    df = as_embedding_index(df)
+    config = response_config(df, model, token_budget)
+    if config is not None:
+        query_embedding = get_query_embedding(query)
+        cached = response_cache.get(query, query_embedding, config)
+        if cached is not None:
+            return cached
+
     message = query_message(query, df, model=model, token_budget=token_budget)
 
     if print_message:
         print(message)
-    messages = [
-        {"role": "system", "content": SYSTEM_CONTENT},
-        {"role": "user", "content": message},
+
+    OPENAI_REQUESTS.inc(api="completion")
+    with stage("completion"):
+        response = openai.ChatCompletion.create(
+            model=model,
+            messages=chat_messages(message, system_content(df.service)),
+            temperature=TEMPERATURE,
+        )
+    record_usage(response, model)
+    response_message = response["choices"][0]["message"]["content"]
+    response_message = clean_response(response_message)
+    if config is not None:
+        response_cache.put(
+            query,
+            query_embedding,
+            config,
+            (response_message, message),
+        )
+    return response_message, message
+
+
+async def aretrieve(
+    query: str,
+    df: pd.DataFrame | EmbeddingIndex,
+    top_n: int = CONTEXT_TOP_N,
+) -> tuple[list[float], list[str], list[float], list[int] | None]:
+    """
+    Embed a query and return
+    (query embedding, strings, relatednesses, token counts of the strings)
+    """
+    query_embedding = await aget_query_embedding(query)
+    strings, relatednesses, token_counts = rank(
+        as_embedding_index(df),
+        query_embedding,
+        top_n=top_n,
+    )
+    return query_embedding, strings, relatednesses, token_counts
+
+
+async def aretrieve_batch(
+    queries: list[str],
+    df: pd.DataFrame | EmbeddingIndex,
+    top_n: int = CONTEXT_TOP_N,
+) -> list[tuple[list[float], list[str], list[float], list[int] | None]]:
+    """aretrieve of many queries, with one embedding request and one
+    matrix-matrix product
+    """
+    if not queries:
+        return []
+    query_embeddings = await aget_query_embeddings(queries)
+    ranked = rank_batch(as_embedding_index(df), query_embeddings, top_n)
+    return [
+        (query_embedding, strings, relatednesses, token_counts)
+        for query_embedding, (strings, relatednesses, token_counts) in zip(
+            query_embeddings,
+            ranked,
+        )
     ]
 
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=0,
+
+async def aanswer(
+    query: str,
+    query_embedding,
+    strings: list[str],
+    df: pd.DataFrame | EmbeddingIndex,
+    model: str = MODEL_NAME,
+    token_budget: int = TOKEN_BUDGET,
+    print_message: bool = False,
+    token_counts: list[int] | None = None,
+) -> tuple[str, str]:
+    """Answer a query from already retrieved strings with one chat completion
+    (or from response_cache).
+    token_counts are the token counts of strings as returned by aretrieve.
+    """
+    df = as_embedding_index(df)
+    config = response_config(df, model, token_budget)
+    if config is not None:
+        cached = response_cache.get(query, query_embedding, config)
+        if cached is not None:
+            return cached
+
+    message = build_message(
+        query,
+        strings,
+        model,
+        token_budget,
+        token_counts=usable_token_counts(df, token_counts, model),
+        introduction=introduction_message(df.service),
     )
+    if print_message:
+        print(message)
+
+    messages = chat_messages(message, system_content(df.service))
+
+    async def complete():
+        OPENAI_REQUESTS.inc(api="completion")
+        async with openai_pool.slot():
+            response = await openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                temperature=TEMPERATURE,
+            )
+        # counted once, not by every coalesced caller
+        record_usage(response, model)
+        return response
+
+    # an identical prompt already being answered is awaited
+    with stage("completion"):
+        response = await completion_flight.do(
+            fingerprint(
+                model,
+                TEMPERATURE,
+                *(m["content"] for m in messages),
+            ),
+            complete,
+        )
     response_message = response["choices"][0]["message"]["content"]
-    print(f'Total used tokens: {response["usage"]["total_tokens"]}')
-    response_message = response_message.replace("help/document/", "wiki/1-")
-    response_message = response_message.replace(">>", ">")
-    print("1 ====", response_message, message)
+    response_message = clean_response(response_message)
+    if config is not None:
+        response_cache.put(
+            query,
+            query_embedding,
+            config,
+            (response_message, message),
+        )
     return response_message, message
 
-message = "askjdfaqskfaqsfn fiqfoiqw fiqwfhoqiw rjfqwjrqw"
-response, _ = get_response(
-            query=message,
-            df=embedding_data,
-            model="gpt-3.5-turbo",
+
+async def astream_answer(
+    query: str,
+    query_embedding,
+    strings: list[str],
+    df: pd.DataFrame | EmbeddingIndex,
+    model: str = MODEL_NAME,
+    token_budget: int = TOKEN_BUDGET,
+    token_counts: list[int] | None = None,
+):
+    """aanswer, yielding the (URL-corrected) answer in pieces as the chat
+    completion streams in. A cached answer is yielded in one piece.
+    """
+    df = as_embedding_index(df)
+    config = response_config(df, model, token_budget)
+    if config is not None:
+        cached = response_cache.get(query, query_embedding, config)
+        if cached is not None:
+            yield cached[0]
+            return
+
+    message = build_message(
+        query,
+        strings,
+        model,
+        token_budget,
+        token_counts=usable_token_counts(df, token_counts, model),
+        introduction=introduction_message(df.service),
+    )
+    # the upstream stream is read into a queue by a task of its own, so
+    # the pool slot and the completion stage end with the upstream stream,
+    # however slowly the client reads the answer
+    deltas = asyncio.Queue()
+
+    async def read_completion() -> None:
+        """Put the streamed deltas, an exception if it fails, then None"""
+        try:
+            with stage("completion"):
+                async with openai_pool.slot():
+                    response = await openai.ChatCompletion.acreate(
+                        model=model,
+                        messages=chat_messages(
+                            message,
+                            system_content(df.service),
+                        ),
+                        temperature=TEMPERATURE,
+                        stream=True,
+                    )
+                    async for chunk in response:
+                        delta = chunk["choices"][0]["delta"].get("content")
+                        if delta:
+                            deltas.put_nowait(delta)
+        except Exception as e:
+            deltas.put_nowait(e)
+        finally:
+            deltas.put_nowait(None)
+
+    rewriter = StreamingRewriter()
+    pieces = []
+    OPENAI_REQUESTS.inc(api="completion")
+    reader = asyncio.create_task(read_completion())
+    try:
+        while True:
+            delta = await deltas.get()
+            if delta is None:
+                break
+            if isinstance(delta, Exception):
+                raise delta
+            piece = rewriter.feed(delta)
+            if piece:
+                pieces.append(piece)
+                yield piece
+    finally:
+        # the client went away: stop reading the upstream stream
+        reader.cancel()
+    piece = rewriter.flush()
+    if piece:
+        pieces.append(piece)
+        yield piece
+    if config is not None:
+        response_cache.put(
+            query,
+            query_embedding,
+            config,
+            ("".join(pieces), message),
         )
 
+
+async def aget_response(
+    query: str,
+    df: pd.DataFrame | EmbeddingIndex,
+    model: str = MODEL_NAME,
+    token_budget: int = TOKEN_BUDGET,
+    print_message: bool = False,
+) -> tuple[str, str]:
+    """Async get_response: the event loop is free while the embedding and
+    chat completion requests are in flight.
+    """
+    df = as_embedding_index(df)
+    query_embedding, strings, _, token_counts = await aretrieve(query, df)
+    return await aanswer(
+        query,
+        query_embedding,
+        strings,
+        df,
+        model=model,
+        token_budget=token_budget,
+        print_message=print_message,
+        token_counts=token_counts,
+    )
+
+async def aget_responses(
+    queries: list[str],
+    df: pd.DataFrame | EmbeddingIndex,
+    model: str = MODEL_NAME,
+    token_budget: int = TOKEN_BUDGET,
+    max_concurrency: int = CHAT_BATCH_MAX_CONCURRENCY,
+) -> list:
+    """aget_response of many queries: they are retrieved together (see
+    aretrieve_batch) and answered with at most max_concurrency chat
+    completions at a time.
+    Returns (response, message) of every query, in order, or the exception
+    the query failed with.
+    """
+    df = as_embedding_index(df)
+    try:
+        retrieved = await aretrieve_batch(queries, df)
+    except Exception as e:
+        return [e] * len(queries)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def answer(query, retrieval):
+        query_embedding, strings, _, token_counts = retrieval
+        async with semaphore:
+            return await aanswer(
+                query,
+                query_embedding,
+                strings,
+                df,
+                model=model,
+                token_budget=token_budget,
+                token_counts=token_counts,
+            )
+
+    return await asyncio.gather(
+        *(answer(query, r) for query, r in zip(queries, retrieved)),
+        return_exceptions=True,
+    )
+
 # Code for getting chatbot's response ends here. Below code is for UI only.
 def format_response(responses: dict):
     """
@@ -188,7 +953,7 @@ def format_response(responses: dict):
 #         # Get the response from OpenAI
 #         response, _ = get_response(
 #             query=message,
-#             df=embedding_data,
+#             df=get_embedding_data(),
 #             model=model,
 #         )
 
@@ -0,0 +1,224 @@
+"""
+Embedding indexes of several chatbot services in one server process.
+
+Every service's index is loaded on first use. Once the loaded indexes
+take more than the memory budget, the least recently used ones are
+unloaded (a request that still holds one finishes with it), and loaded
+again on their next use. An index's size is the size of its arrays, the
+memory-mapped ones included ("mapped_bytes"): an upper bound of its
+resident memory, as the OS only pages in what the searches touch.
+
+A loaded index is reloaded when its version on disk changes (see
+reload()): the new version is loaded while requests are still served
+from the old one, then swapped in.
+
+Usage:
+    registry = ServiceRegistry(
+        ["TokyoTechLab", "Teamhub"],
+        load=lambda service: load_embedding_data(*embedding_paths(service)),
+        version=lambda service: embedding_data_version(...),
+        memory_budget=2 * 1024**3,
+    )
+    index = registry.get("Teamhub")
+    registry.status()["services"]["Teamhub"]  # {"mapped_bytes": ...}
+"""
+import collections
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from retrieval import EmbeddingIndex
+
+logger = logging.getLogger(__name__)
+
+
+def embedding_paths(service: str) -> tuple[str, str]:
+    """
+    (embedding store folder, legacy CSV file) of a service, laid out as
+    FOLDERPATH_EMBEDDING_STORE and FILEPATH_EMBEDDINGS in ai_configs.py
+    """
+    folder = os.path.join("models", service, "embeddings")
+    return (
+        os.path.join(folder, f"{service}.store"),
+        os.path.join(folder, f"{service}.csv"),
+    )
+
+
+class UnknownServiceError(KeyError):
+    pass
+
+
+class ServiceRegistry:
+    def __init__(
+        self,
+        services: list[str],
+        load: Callable[[str], EmbeddingIndex],
+        version: Callable[[str], Optional[str]],
+        memory_budget: Optional[int] = None,
+    ) -> None:
+        """
+        args:
+            services(list): names of the services served
+            load(function): service -> its EmbeddingIndex
+            version(function): service -> version of its data on disk
+            memory_budget(int): bytes of loaded indexes, None = no limit
+        """
+        self.services = list(services)
+        self.load = load
+        self.version = version
+        self.memory_budget = memory_budget
+        self.indexes = {service: None for service in self.services}
+        self.states = {
+            service: {
+                "loaded": False,
+                "version": None,
+                "rows": None,
+                "mapped_bytes": 0,
+                "loaded_at": None,
+                "load_seconds": None,
+                "loads": 0,
+                "reloads": 0,
+                "evictions": 0,
+                "last_used": None,
+                "last_check": None,
+                "last_error": None,
+            }
+            for service in self.services
+        }
+        # loaded services, least recently used first
+        self._lru = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # held while loading a service, so it is loaded once at a time
+        self._load_locks = {
+            service: threading.Lock() for service in self.services
+        }
+
+    def __contains__(self, service: str) -> bool:
+        return service in self.indexes
+
+    def _check(self, service: str) -> None:
+        if service not in self.indexes:
+            raise UnknownServiceError(
+                f"Unknown service {service!r}, must be in {self.services}",
+            )
+
+    def touch(self, service: str) -> None:
+        """Mark a service as recently used"""
+        with self._lock:
+            if service in self._lru:
+                self._lru.move_to_end(service)
+            self.states[service]["last_used"] = time.time()
+
+    def _load(self, service: str) -> EmbeddingIndex:
+        """Load a service's index and swap it in, with its load lock"""
+        state = self.states[service]
+        start = time.perf_counter()
+        try:
+            index = self.load(service)
+        except Exception as e:
+            state["last_error"] = repr(e)
+            raise
+        load_seconds = time.perf_counter() - start
+        index.service = service
+        # memory-mapped arrays count in full, resident in RAM or not
+        mapped_bytes = index.nbytes
+        with self._lock:
+            previous = self.indexes[service]
+            self.indexes[service] = index
+            self._lru[service] = mapped_bytes
+            self._lru.move_to_end(service)
+            state.update(
+                loaded=True,
+                version=index.version,
+                rows=len(index),
+                mapped_bytes=mapped_bytes,
+                loaded_at=time.time(),
+                load_seconds=load_seconds,
+                last_used=time.time(),
+                last_error=None,
+            )
+            state["loads"] += 1
+            if previous is not None:
+                state["reloads"] += 1
+            self._evict(keep=service)
+        if previous is not None:
+            logger.info(
+                "Reloaded %s embedding data %s -> %s in %.2fs",
+                service,
+                previous.version,
+                index.version,
+                load_seconds,
+            )
+        else:
+            logger.info(
+                "Loaded %s embedding data %s (%.1f MiB) in %.2fs",
+                service,
+                index.version,
+                mapped_bytes / 2**20,
+                load_seconds,
+            )
+        return index
+
+    def _evict(self, keep: str) -> None:
+        """Unload least recently used indexes over the budget, with _lock"""
+        if self.memory_budget is None:
+            return
+        while sum(self._lru.values()) > self.memory_budget:
+            service = next((s for s in self._lru if s != keep), None)
+            if service is None:
+                # a single index over the budget stays loaded
+                return
+            del self._lru[service]
+            self.indexes[service] = None
+            self.states[service].update(loaded=False, mapped_bytes=0)
+            self.states[service]["evictions"] += 1
+            logger.info("Unloaded %s embedding data (memory budget)", service)
+
+    def get(self, service: str) -> EmbeddingIndex:
+        """Return the index of a service, loading it if needed"""
+        self._check(service)
+        index = self.indexes[service]
+        if index is None:
+            with self._load_locks[service]:
+                index = self.indexes[service]
+                if index is None:
+                    return self._load(service)
+        self.touch(service)
+        return index
+
+    def loaded(self, service: str) -> Optional[EmbeddingIndex]:
+        """The index of a service if it is loaded, without loading it"""
+        self._check(service)
+        return self.indexes[service]
+
+    def reload(self, service: str, force: bool = False) -> bool:
+        """
+        Load a service's index again if its version on disk changed (or if
+        force is set). Services that are not loaded are skipped: their
+        next use loads the latest version.
+        returns:
+            whether a new index was swapped in
+        """
+        self._check(service)
+        with self._load_locks[service]:
+            self.states[service]["last_check"] = time.time()
+            index = self.indexes[service]
+            if index is None:
+                return False
+            if not force and self.version(service) == index.version:
+                return False
+            self._load(service)
+            return True
+
+    def status(self) -> dict:
+        """Per-service state, load latency and mapped size"""
+        with self._lock:
+            services = {s: dict(state) for s, state in self.states.items()}
+            mapped_bytes = sum(self._lru.values())
+        return {
+            "memory_budget": self.memory_budget,
+            "mapped_bytes": mapped_bytes,
+            "services": services,
+        }
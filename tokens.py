@@ -0,0 +1,29 @@
+"""
+Token counting with cached tiktoken encoders.
+
+tiktoken.encoding_for_model builds (or looks up) an encoder on every call;
+get_encoding keeps one per model for the lifetime of the process.
+"""
+import functools
+from typing import Iterable
+
+import numpy as np
+import tiktoken
+from ai_configs import MODEL_NAME
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = MODEL_NAME) -> tiktoken.Encoding:
+    """Return the (cached) tiktoken encoding of a model."""
+    return tiktoken.encoding_for_model(model)
+
+
+def num_tokens(text: str, model: str = MODEL_NAME) -> int:
+    """Return the number of tokens in a string."""
+    return len(get_encoding(model).encode(text))
+
+
+def count_tokens(texts: Iterable[str], model: str = MODEL_NAME) -> np.ndarray:
+    """Return the number of tokens of every text as an int32 array"""
+    encoded = get_encoding(model).encode_batch(list(texts))
+    return np.array([len(tokens) for tokens in encoded], dtype=np.int32)
@@ -57,6 +57,36 @@ BASE_ALPHABET = set('\x00 _' + string.ascii_lowercase + string.digits)
 ALPHABET = BASE_ALPHABET.union(set(''.join(ACCENTED_TO_BASE_CHAR_MAP.keys())))
 
 
+### Những ký tự chỉ xuất hiện trong chữ có dấu
+ACCENT_ONLY_CHARS = set(ACCENTED_TO_BASE_CHAR_MAP) - BASE_ALPHABET
+
+
+def is_unaccented(text):
+	""" True if text has letters but none of them carries a Vietnamese accent """
+	text = text.lower()
+	return any(c.isalpha() for c in text) and not any(c in ACCENT_ONLY_CHARS for c in text)
+
+
+### Âm tiết tiếng Việt không dấu: phụ âm đầu + vần + phụ âm cuối
+VIETNAMESE_SYLLABLE = re.compile(
+	'(?:ngh|ng|nh|ch|gh|gi|kh|ph|qu|th|tr|[bcdghklmnprstvx])?'
+	'(?:oai|oay|oao|oeo|ieu|yeu|uoi|uou|uay|uya|uye|uyu'
+	'|ai|ao|au|ay|eo|eu|ia|ie|iu|oa|oe|oi|oo|ua|ue|ui|uo|uu|uy|ye'
+	'|[aeiouy])'
+	'(?:ch|ng|nh|[cmnpt])?'
+)
+
+
+def is_unaccented_vietnamese(text, min_ratio=0.7):
+	""" True if text is unaccented and at least min_ratio of its words are
+	Vietnamese syllables, so English questions are not sent to add_accent """
+	if not is_unaccented(text):
+		return False
+	words = re.findall(r'[^\W\d_]+', text.lower())
+	syllables = sum(1 for word in words if VIETNAMESE_SYLLABLE.fullmatch(word))
+	return syllables >= min_ratio * len(words)
+
+
 def is_words(text):
 	return re.fullmatch('\w[\w ]*', text)
 
@@ -99,18 +129,61 @@ def timing(label):
 		duration = time.monotonic() - begin
 	print(': took {:.2f}s'.format(duration))
 
+class AccentEngine(object):
+    """ accent restoration backend used by add_accent.add_accent """
+    name = None
+
+    def restore_phrases(self, phrases):
+        """ map unaccented lowercase phrases (words separated by spaces)
+        to accented phrases of the same length """
+        raise NotImplementedError
+
+    def warm_up(self):
+        """ load models and run a first prediction """
+        self.restore_phrases(['xin chao'])
+
+
+# right-pads strings in CharacterCodec.encode_indices_many,
+# encoded as "no character" (an all-zero one-hot row)
+PAD_SENTINEL = '\uffff'
+
 class CharacterCodec(object):
     def __init__(self, alphabet, maxlen):
         self.alphabet = list(sorted(set(alphabet)))
         self.index_alphabet = dict((c, i) for i, c in enumerate(self.alphabet))
         self.maxlen = maxlen
-
-    def encode(self, C, maxlen=None):
+        # code point -> alphabet index (-1 if not in alphabet), covers the BMP
+        self.lookup = np.full(0x10000, -1, dtype=np.int32)
+        for i, c in enumerate(self.alphabet):
+            self.lookup[ord(c)] = i
+        # alphabet index -> code point
+        self.codes = np.array([ord(c) for c in self.alphabet], dtype=np.uint32)
+        # alphabet index -> one-hot row, the extra last row (index -1) is empty
+        self.one_hot = np.zeros((len(self.alphabet) + 1, len(self.alphabet)), dtype=np.uint8)
+        self.one_hot[np.arange(len(self.alphabet)), np.arange(len(self.alphabet))] = 1
+
+    def encode(self, C, maxlen=None, dtype=np.float32):
+        return self.encode_many([C], maxlen, dtype)[0]
+
+    def encode_indices_many(self, strings, maxlen=None):
+        """ encode strings as a (n, maxlen) int32 array of alphabet indices,
+        -1 after the end of a string; raise KeyError on unknown characters """
         maxlen = maxlen if maxlen else self.maxlen
-        X = np.zeros((maxlen, len(self.alphabet)))
-        for i, c in enumerate(C[:maxlen]):
-            X[i, self.index_alphabet[c]] = 1
-        return X
+        buf = ''.join(s[:maxlen].ljust(maxlen, PAD_SENTINEL) for s in strings)
+        codes = np.frombuffer(buf.encode('utf-32-le'), dtype=np.uint32).reshape(len(strings), maxlen)
+        in_table = codes < len(self.lookup)
+        indices = np.where(in_table, self.lookup[np.where(in_table, codes, 0)], -1)
+        padding = codes == ord(PAD_SENTINEL)
+        unknown = (indices < 0) & ~padding
+        if unknown.any():
+            raise KeyError(chr(codes[unknown][0]))
+        return indices
+
+    def encode_many(self, strings, maxlen=None, dtype=np.float32):
+        """ one-hot encode strings into a (n, maxlen, len(alphabet)) array,
+        use dtype=np.uint8 for the most compact output """
+        indices = self.encode_indices_many(strings, maxlen)
+        return self.one_hot.astype(dtype, copy=False)[indices]
 
     def try_encode(self, C, maxlen=None):
         try:
@@ -119,6 +192,15 @@ class CharacterCodec(object):
             return None
 
     def decode(self, X, calc_argmax=True):
+        return self.decode_many(np.asarray(X)[np.newaxis], calc_argmax)[0]
+
+    def decode_many(self, X, calc_argmax=True):
+        """ decode a (n, maxlen[, len(alphabet)]) batch into n strings """
         if calc_argmax:
             X = X.argmax(axis=-1)
-        return ''.join(self.alphabet[x] for x in X)
+        X = np.asarray(X)
+        if X.shape[-1] == 0:
+            return [''] * X.shape[0]
+        text = self.codes[X].tobytes().decode('utf-32-le')
+        length = X.shape[-1]
+        return [text[i:i + length] for i in range(0, len(text), length)]